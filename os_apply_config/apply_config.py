@@ -14,22 +14,35 @@
 # limitations under the License.
 
 import argparse
+import contextlib
+import itertools
 import json
 import logging
 import os
 import subprocess
 import sys
-import tempfile
+import time
 
 from pystache import context
 import yaml
 
 from os_apply_config import collect_config
 from os_apply_config import config_exception as exc
+from os_apply_config import fingerprint
+from os_apply_config import key_index
+from os_apply_config import limits
+from os_apply_config import manifest
+from os_apply_config import metrics
 from os_apply_config import oac_file
+from os_apply_config import plugins
 from os_apply_config import renderers
+from os_apply_config import report
+from os_apply_config import schema
+from os_apply_config import state
+from os_apply_config import template_source
 from os_apply_config import value_types
 from os_apply_config import version
+from os_apply_config import writer
 
 DEFAULT_TEMPLATES_DIR = '/usr/libexec/os-apply-config/templates'
 
@@ -69,23 +82,158 @@ OS_CONFIG_FILES_PATH = os.environ.get(
     'OS_CONFIG_FILES_PATH', '/var/lib/os-collect-config/os_config_files.json')
 OS_CONFIG_FILES_PATH_OLD = '/var/run/os-collect-config/os_config_files.json'
 
-CONTROL_FILE_SUFFIX = ".oac"
+CONTROL_FILE_SUFFIX = template_source.CONTROL_FILE_SUFFIX
+
+
+def default_partials_dir(template_root):
+    """The partials directory next to template_root."""
+    return os.path.join(
+        os.path.dirname(os.path.normpath(template_root)), 'partials')
 
 
 def install_config(
         config_path, template_root, output_path, validate, subhash=None,
-        fallback_metadata=None):
-    config = strip_hash(
-        collect_config.collect_config(config_path, fallback_metadata), subhash)
-    tree = build_tree(template_paths(template_root), config)
+        fallback_metadata=None, state_dir=None, stats=None,
+        partials_dir=None, only=None, exclude=None, exec_limits=None,
+        write_workers=1):
+    config_files = (fallback_metadata or []) + config_path
+    partials_dir = partials_dir or default_partials_dir(template_root)
+    if state_dir and not validate:
+        with metrics.phase(stats, 'fingerprint'):
+            fp = fingerprint.compute(
+                config_files, template_root, output_path, subhash,
+                partials_dir, only, exclude)
+            unchanged = fingerprint.is_current(state_dir, fp)
+        if unchanged:
+            logger.info("inputs unchanged since last apply, nothing to do")
+            if stats is not None:
+                stats.count('runs_unchanged')
+            return
+    if state_dir and not validate:
+        sig = key_index.signature(config_files)
+    with metrics.phase(stats, 'parse'):
+        parsed = collect_config.load_configs(config_files,
+                                             parse_cache(state_dir))
+    with metrics.phase(stats, 'merge'):
+        metadata = collect_config.merge_configs(parsed)
+        del parsed
+        config = strip_hash(metadata, subhash)
+    if stats is not None:
+        stats.count('metadata_bytes', _files_size(config_files))
+    oac_file.clear_caches()
+    exec_dir = (os.path.join(state_dir, template_source.EXEC_DIR)
+                if state_dir else None)
+    with template_source.open_templates(template_root, exec_dir) as source, \
+            writer.Writer(write_workers) as w:
+        with metrics.phase(stats, 'render'):
+            templates = source.paths(only, exclude)
+            controls = read_controls(templates, source)
+            renderer = make_renderer(partials_dir)
+        # Each priority is written before the next is rendered, so that
+        # the outputs services wait on are not held up by slower ones.
+        written = []
+        for group in priority_groups(templates, controls):
+            with metrics.phase(stats, 'render'):
+                tree = build_tree(group, config, stats, renderer,
+                                  exec_limits, source, controls)
+            if validate:
+                continue
+            with metrics.phase(stats, 'write'):
+                group_written = w.write_all(
+                    (os.path.join(output_path, strip_prefix('/', path)), obj)
+                    for path, obj in tree.items())
+            written += group_written
+            if stats is not None:
+                for out_file, obj, status in group_written:
+                    stats.record_file(out_file, status, len(obj.body))
+                stats.priority_done(controls[group[0][0]].priority)
+        if stats is not None and not validate:
+            for name, n in w.counts.items():
+                stats.count(name, n)
+            stats.count('name_lookups_cached', oac_file.cached_lookups())
     if not validate:
-        for path, obj in tree.items():
-            write_file(os.path.join(
-                output_path, strip_prefix('/', path)), obj)
+        outputs = [out_file for out_file, _obj, _status in written]
+        if state_dir:
+            fingerprint.record(state_dir, fp, outputs)
+            key_index.build(state_dir, sig, metadata)
+            manifest.record(state_dir, written, partial=bool(only or exclude))
+
 
+def verify_outputs(state_dir, repair=False, stats=None):
+    """Report outputs which have changed since the last apply.
 
-def _extract_key(config_path, key, fallback_metadata=None):
+    With repair, drifted outputs are rewritten from the content the last
+    apply recorded.  Returns the paths left drifted.
+    """
+    with metrics.phase(stats, 'verify'):
+        drifted = manifest.verify(state_dir)
+    for path, drift in drifted:
+        logger.warning("%s has drifted: %s", path, ', '.join(drift))
+    if stats is not None:
+        stats.drift = dict(drifted)
+        stats.count('files_drifted', len(drifted))
+    if not repair:
+        return [path for path, _drift in drifted]
+    with metrics.phase(stats, 'write'):
+        written = manifest.repair(state_dir,
+                                  [path for path, _drift in drifted])
+    for path, obj, status in written:
+        logger.info("repaired %s", path)
+        if stats is not None:
+            stats.record_file(path, status, len(obj.body))
+    return []
+
+
+def parse_cache(state_dir):
+    """Return the ParseCache to use with state_dir."""
+    if not state_dir:
+        return collect_config.ParseCache()
+    return collect_config.ParseCache(
+        os.path.join(state_dir, collect_config.CACHE_DIR))
+
+
+def _files_size(paths):
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def print_fingerprint(config_path, template_root, output_path, subhash=None,
+                      fallback_metadata=None, partials_dir=None, only=None,
+                      exclude=None):
+    partials_dir = partials_dir or default_partials_dir(template_root)
+    print(fingerprint.compute((fallback_metadata or []) + config_path,
+                              template_root, output_path, subhash,
+                              partials_dir, only, exclude))
+
+
+def _extract_key(config_path, key, fallback_metadata=None, state_dir=None):
+    if state_dir:
+        sig = key_index.signature((fallback_metadata or []) + config_path)
+        index = key_index.load(state_dir, sig)
+        if index is None:
+            config = collect_config.collect_config(
+                config_path, fallback_metadata, parse_cache(state_dir))
+            try:
+                key_index.build(state_dir, sig, config)
+            except (OSError, exc.ConfigException) as e:
+                logger.warning('could not write key index: %s', e)
+            return _walk_key(config, key)
+        try:
+            found, value = index.get(key)
+        finally:
+            index.close()
+        if found or key_index.is_canonical(key):
+            return value
     config = collect_config.collect_config(config_path, fallback_metadata)
+    return _walk_key(config, key)
+
+
+def _walk_key(config, key):
     keys = key.split('.')
     for key in keys:
         try:
@@ -104,9 +252,9 @@ def _extract_key(config_path, key, fallback_metadata=None):
 
 
 def print_key(
-        config_path, key, type_name, default=None, fallback_metadata=None):
-    config = collect_config.collect_config(config_path, fallback_metadata)
-    config = _extract_key(config_path, key, fallback_metadata)
+        config_path, key, type_name, default=None, fallback_metadata=None,
+        state_dir=None):
+    config = _extract_key(config_path, key, fallback_metadata, state_dir)
     if config is None:
         if default is not None:
             print(str(default))
@@ -121,8 +269,20 @@ def print_key(
         print(str(config))
 
 
-def boolean_key(metadata, key, fallback_metadata):
-    config = _extract_key(metadata, key, fallback_metadata)
+def validate_schema(config_path, schema_path, fallback_metadata=None):
+    rules = schema.load_schema(schema_path)
+    config = collect_config.collect_config(config_path, fallback_metadata)
+    errors = schema.validate(config, rules)
+    for error in errors:
+        logger.error(error)
+    if errors:
+        raise exc.ConfigException(
+            'metadata does not match schema %s: %d violation(s)'
+            % (schema_path, len(errors)))
+
+
+def boolean_key(metadata, key, fallback_metadata, state_dir=None):
+    config = _extract_key(metadata, key, fallback_metadata, state_dir)
     if not isinstance(config, bool):
         return -1
     if config:
@@ -132,65 +292,108 @@ def boolean_key(metadata, key, fallback_metadata):
 
 
 def write_file(path, obj):
-    if not obj.allow_empty and len(obj.body) == 0:
-        if os.path.exists(path):
-            logger.info("deleting %s", path)
-            os.unlink(path)
-        else:
-            logger.info("not creating empty %s", path)
-        return
+    """Write obj to path if it differs from what is there.
 
-    logger.info("writing %s", path)
-    if os.path.exists(path):
-        stat = os.stat(path)
-        mode, uid, gid = stat.st_mode, stat.st_uid, stat.st_gid
-    else:
-        mode, uid, gid = 0o644, -1, -1
-    mode = obj.mode or mode
-    if obj.owner is not None:
-        uid = obj.owner
-    if obj.group is not None:
-        gid = obj.group
-
-    d = os.path.dirname(path)
-    os.path.exists(d) or os.makedirs(d)
-    with tempfile.NamedTemporaryFile(dir=d, delete=False) as newfile:
-        if isinstance(obj.body, str):
-            obj.body = obj.body.encode('utf-8')
-        newfile.write(obj.body)
-        os.chmod(newfile.name, mode)
-        os.chown(newfile.name, uid, gid)
-        os.rename(newfile.name, path)
-
-
-def build_tree(templates, config):
-    """Return a map of filenames to OacFiles."""
+    Returns 'created', 'modified', 'deleted', 'unchanged', or 'skipped'
+    for an empty file which is not allowed and does not exist.
+    """
+    with writer.Writer() as w:
+        return w.write(path, obj)
+
+
+def read_control(template, source=None):
+    """Return an OacFile with the settings of template's control file."""
+    source = source or template_source.FileSource()
+    ctrl_dict = {}
+    ctrl_body = source.control(template)
+    if ctrl_body is not None:
+        ctrl_dict = yaml.safe_load(ctrl_body) or {}
+    if not isinstance(ctrl_dict, dict):
+        raise exc.ConfigException(
+            "header is not a dict: %s" % template)
+    return oac_file.OacFile('', **ctrl_dict)
+
+
+def read_controls(templates, source=None):
+    """Return a map of each of templates to read_control of it."""
+    res = {}
+    for in_file, _out_file in templates:
+        try:
+            res[in_file] = read_control(in_file, source)
+        except exc.ConfigException as e:
+            e.args += in_file,
+            raise
+    return res
+
+
+def priority_groups(templates, controls):
+    """Split templates into lists of equal priority, highest first.
+
+    Templates of equal priority keep their order.
+    """
+    def priority(t):
+        return controls[t[0]].priority
+    return [list(group) for _p, group in itertools.groupby(
+        sorted(templates, key=lambda t: -priority(t)), key=priority)]
+
+
+def build_tree(templates, config, stats=None, renderer=None,
+               exec_limits=None, source=None, controls=None):
+    """Return a map of filenames to OacFiles.
+
+    Templates are read from source, by default the filesystem, and their
+    control files too unless already read into controls.  Executable
+    templates run under exec_limits, as overridden by their control
+    files, and executable and plugin templates are sent the part of
+    config their control files ask for.
+    """
     res = {}
+    renderer = renderer or make_renderer()
+    exec_limits = exec_limits or limits.Limits()
+    source = source or template_source.FileSource()
+    controls = controls or {}
     for in_file, out_file in templates:
         try:
-            body = render_template(in_file, config)
-            ctrl_file = in_file + CONTROL_FILE_SUFFIX
-            ctrl_dict = {}
-            if os.path.isfile(ctrl_file):
-                with open(ctrl_file) as cf:
-                    ctrl_body = cf.read()
-                ctrl_dict = yaml.safe_load(ctrl_body) or {}
-            if not isinstance(ctrl_dict, dict):
-                raise exc.ConfigException(
-                    "header is not a dict: %s" % in_file)
-            res[out_file] = oac_file.OacFile(body, **ctrl_dict)
+            obj = controls.get(in_file) or read_control(in_file, source)
+            template_config = config
+            if ((obj.input_subhash or obj.input_keys is not None) and
+                    (obj.plugin or source.is_executable(in_file))):
+                template_config = executable_input(config, obj)
+            obj.body = render_template(in_file, template_config, stats,
+                                       renderer, exec_limits.override(obj),
+                                       source, obj.plugin)
+            res[out_file] = obj
+            if stats is not None:
+                stats.count('templates_rendered')
         except exc.ConfigException as e:
             e.args += in_file,
             raise
     return res
 
 
-def render_template(template, config):
-    if is_executable(template):
-        return render_executable(template, config)
+def render_template(template, config, stats=None, renderer=None,
+                    exec_limits=None, source=None, plugin=False):
+    source = source or template_source.FileSource()
+    if plugin:
+        start = time.monotonic()
+        try:
+            return plugins.render(template, config, source)
+        finally:
+            if stats is not None:
+                stats.count('plugin_templates')
+                stats.count('plugin_seconds', time.monotonic() - start)
+    elif source.is_executable(template):
+        start = time.monotonic()
+        try:
+            with source.executable(template) as path:
+                return render_executable(path, config, exec_limits)
+        finally:
+            if stats is not None:
+                stats.count('executable_templates')
+                stats.count('executable_seconds', time.monotonic() - start)
     else:
         try:
-            return render_moustache(open(template).read(), config)
+            return render_moustache(source.read(template), config, renderer)
         except context.KeyNotFoundError as e:
             raise exc.ConfigException(
                 "key '%s' from template '%s' does not exist in metadata file."
@@ -205,35 +408,78 @@ def is_executable(path):
     return os.path.isfile(path) and os.access(path, os.X_OK)
 
 
-def render_moustache(text, config):
-    r = renderers.JsonRenderer(missing_tags='ignore')
+def make_renderer(partials_dir=None):
+    """Return a renderer to share between the templates of one run.
+
+    Partials are loaded from partials_dir, if it exists.
+    """
+    partials = None
+    if partials_dir and os.path.isdir(partials_dir):
+        partials = renderers.PartialLoader(partials_dir)
+    return renderers.JsonRenderer(missing_tags='ignore', partials=partials)
+
+
+def render_moustache(text, config, renderer=None):
+    r = renderer or make_renderer()
     return r.render(text, config)
 
 
-def render_executable(path, config):
-    p = subprocess.Popen([path],
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate(json.dumps(config).encode('utf-8'))
+def render_executable(path, config, exec_limits=None):
+    """Run the executable template at path, with config on its stdin.
+
+    Returns what it writes to stdout.  The script is run under
+    exec_limits, if given.
+    """
+    exec_limits = exec_limits or limits.Limits()
+    cpu = limits.cpu_seconds()
+    try:
+        p = subprocess.Popen([path],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             preexec_fn=exec_limits.preexec())
+    except subprocess.SubprocessError:
+        raise exc.ConfigException(
+            "config script failed: %s could not be started with %s" %
+            (path, exec_limits))
+    except OSError as e:
+        # e.g. a script extracted to a filesystem mounted noexec.
+        raise exc.ConfigException(
+            "config script failed: %s could not be started. %s" % (path, e))
+    data = json.dumps(config).encode('utf-8')
+    if exec_limits.output_limit is None:
+        stdout, stderr = p.communicate(data)
+    else:
+        try:
+            stdout, stderr = limits.communicate(p, data,
+                                                exec_limits.output_limit)
+        except limits.OutputLimitExceeded:
+            raise exc.ConfigException(
+                "config script failed: %s exceeded its output limit of %d"
+                " bytes" % (path, exec_limits.output_limit))
     p.wait()
     if p.returncode != 0:
+        exceeded = exec_limits.explain(
+            p.returncode, limits.cpu_seconds() - cpu, stderr)
+        if exceeded:
+            raise exc.ConfigException(
+                "config script failed: %s exceeded its %s\n\nwith output:"
+                "\n\n%s" % (path, exceeded, stdout + stderr))
         raise exc.ConfigException(
             "config script failed: %s\n\nwith output:\n\n%s" %
             (path, stdout + stderr))
     return stdout.decode('utf-8')
 
 
-def template_paths(root):
-    res = []
-    for cur_root, _subdirs, files in os.walk(root):
-        for f in files:
-            if f.endswith(CONTROL_FILE_SUFFIX):
-                continue
-            inout = (os.path.join(cur_root, f), os.path.join(
-                strip_prefix(root, cur_root), f))
-            res.append(inout)
-    return res
+def template_paths(root, only=None, exclude=None):
+    """Return (template, output path) pairs for the tree under root.
+
+    When given, only and exclude are lists of glob patterns matched against
+    output paths such as /etc/nova/nova.conf, where a pattern matching a
+    directory also matches everything beneath it.  Directories that cannot
+    contain a selected output are not descended into.
+    """
+    return template_source.FileSource(root).paths(only, exclude)
 
 
 def strip_prefix(prefix, s):
@@ -253,6 +499,55 @@ def strip_hash(h, keys):
     return h
 
 
+def _indexes(value, part):
+    """Whether part is an index of the list value, as --key reads it."""
+    try:
+        value[int(part)]
+    except (IndexError, ValueError):
+        return False
+    return True
+
+
+def project_keys(h, keys):
+    """Return the parts of h named by the dotted keys.
+
+    Hashes leading to each key are kept, so the result has the shape of
+    h.  A key reaching into a list, such as hosts.0, is given the whole
+    list, so that its indices are unchanged.  Keys which are not in h are
+    left out.
+    """
+    res = {}
+    for key in keys:
+        parts = key.split('.')
+        src, dst = h, res
+        for i, part in enumerate(parts):
+            if not isinstance(src, dict) or part not in src:
+                break
+            value = src[part]
+            if dst.get(part) is value:
+                # Already sent whole for a shorter key.
+                break
+            if i == len(parts) - 1 or (isinstance(value, list) and
+                                       _indexes(value, parts[i + 1])):
+                dst[part] = value
+                break
+            if not isinstance(value, dict):
+                break
+            if not isinstance(dst.get(part), dict):
+                dst[part] = {}
+            src, dst = value, dst[part]
+    return res
+
+
+def executable_input(config, obj):
+    """Return what to send an executable template with control obj."""
+    if obj.input_subhash:
+        config = strip_hash(config, obj.input_subhash)
+    if obj.input_keys is not None:
+        config = project_keys(config, obj.input_keys)
+    return config
+
+
 def parse_opts(argv):
     parser = argparse.ArgumentParser(
         description='Reads and merges JSON configuration files specified'
@@ -261,9 +556,14 @@ def parse_opts(argv):
         ' specified this way, falls back to legacy behavior of searching'
         ' the fallback metadata path for a single config file.')
     parser.add_argument('-t', '--templates', metavar='TEMPLATE_ROOT',
-                        help="""path to template root directory (default:
-                        %(default)s)""",
+                        help="""path to template root directory, or to a
+                        zip or tar archive of one (default: %(default)s)""",
                         default=TEMPLATES_DIR)
+    parser.add_argument('--partials', metavar='PARTIALS_DIR', default=None,
+                        help='directory from which moustache templates load'
+                             ' partials, e.g. {{> database}} (default: the'
+                             ' "partials" directory next to the template'
+                             ' root)')
     parser.add_argument('-o', '--output', metavar='OUT_DIR',
                         help='root directory for output (default:%(default)s)',
                         default='/')
@@ -278,12 +578,68 @@ def parse_opts(argv):
                         default=['/var/cache/heat-cfntools/last_metadata',
                                  '/var/lib/heat-cfntools/cfn-init-data',
                                  '/var/lib/cloud/data/cfn-init-data'])
+    parser.add_argument('--only', metavar='PATTERN', action='append',
+                        default=None,
+                        help='Only render and write outputs whose path, or'
+                             ' the path of a directory containing them,'
+                             ' matches this glob pattern, e.g.'
+                             ' "/etc/nova/*". "*" also matches "/". May be'
+                             ' given more than once.')
+    parser.add_argument('--exclude', metavar='PATTERN', action='append',
+                        default=None,
+                        help='Do not render or write outputs whose path, or'
+                             ' the path of a directory containing them,'
+                             ' matches this glob pattern. Takes precedence'
+                             ' over --only. May be given more than once.')
+    parser.add_argument('--exec-cpu-limit', metavar='SECONDS', type=float,
+                        default=None,
+                        help='Seconds of CPU time each executable template'
+                             ' may use. Overridden by "cpu_limit" in its'
+                             ' control file.')
+    parser.add_argument('--exec-memory-limit', metavar='SIZE', default=None,
+                        help='Address space each executable template may'
+                             ' use, in bytes or e.g. "512M". Overridden by'
+                             ' "memory_limit" in its control file.')
+    parser.add_argument('--exec-output-limit', metavar='SIZE', default=None,
+                        help='Output each executable template may write, in'
+                             ' bytes or e.g. "16M". Overridden by'
+                             ' "output_limit" in its control file.')
+    parser.add_argument('--exec-nice', metavar='NICE', type=int,
+                        default=None,
+                        help='Niceness, from -20 to 19, to run executable'
+                             ' templates at. Overridden by "nice" in their'
+                             ' control files.')
+    parser.add_argument('--exec-ionice', metavar='CLASS[:LEVEL]',
+                        default=None,
+                        help='I/O priority to run executable templates at:'
+                             ' "idle", "best-effort" or "realtime", with an'
+                             ' optional level from 0 to 7, e.g.'
+                             ' "best-effort:7". Overridden by "ionice" in'
+                             ' their control files.')
+    parser.add_argument('--write-workers', metavar='N', type=int, default=1,
+                        help='Write the outputs of up to N directories at'
+                             ' once, for output filesystems where each'
+                             ' write waits on the network or a busy disk.'
+                             ' Each file is still replaced atomically.'
+                             ' (default: %(default)s)')
     parser.add_argument(
         '-v', '--validate', help='validate only. do not write files',
         default=False, action='store_true')
     parser.add_argument(
         '--print-templates', default=False, action='store_true',
         help='Print templates root and exit.')
+    parser.add_argument(
+        '--print-fingerprint', default=False, action='store_true',
+        help='Print the fingerprint of the metadata, templates, subhash and'
+             ' output root that an apply would use, and exit.')
+    parser.add_argument(
+        '--verify', default=False, action='store_true',
+        help='Check the outputs of the last apply recorded in --state-dir'
+             ' and exit with an error if any have been changed since.')
+    parser.add_argument(
+        '--repair', default=False, action='store_true',
+        help='As --verify, but rewrite changed outputs from the content'
+             ' the last apply recorded, without rendering.')
     parser.add_argument('-s', '--subhash',
                         help='use the sub-hash named by this key,'
                              ' instead of the full metadata hash')
@@ -307,11 +663,57 @@ def parse_opts(argv):
                              ' boolean true or false. The return code of the'
                              ' command will be 0 for true, 1 for false, and -1'
                              ' for non-boolean values.')
+    parser.add_argument('--schema', metavar='SCHEMA_FILE', default=None,
+                        help='Validate the metadata against the types given'
+                             ' for each key in this YAML or JSON file,'
+                             ' report every violation and exit. Keys are'
+                             ' dotted paths as for --key, where "*" matches'
+                             ' any list item or hash value.')
     parser.add_argument('--version', action='version',
                         version=version.version_info.version_string())
     parser.add_argument('--os-config-files',
                         default=OS_CONFIG_FILES_PATH,
                         help='Set path to os_config_files.json')
+    parser.add_argument('--metrics-file', metavar='METRICS_FILE',
+                        default=None,
+                        help='After each apply, write timings and counters'
+                             ' to this file in the Prometheus text format,'
+                             ' e.g. for the node_exporter textfile'
+                             ' collector.')
+    parser.add_argument('--report', metavar='REPORT_FILE', default=None,
+                        help='After each apply, write the paths of the'
+                             ' outputs it created, modified or deleted to'
+                             ' this file.')
+    parser.add_argument('--report-fd', metavar='FD', type=int, default=None,
+                        help='As --report, but write to this already open'
+                             ' file descriptor.')
+    parser.add_argument('--report-format', choices=report.FORMATS,
+                        default='json',
+                        help='"json" for an object with "created",'
+                             ' "modified" and "deleted" lists, or "lines"'
+                             ' for one changed path per line. (default:'
+                             ' %(default)s)')
+    parser.add_argument('--memory-report', default=False,
+                        action='store_true',
+                        help='Trace memory use and add the peak and retained'
+                             ' memory of each phase, and the source lines'
+                             ' holding the most memory, to the --report.')
+    parser.add_argument('--coalesce', default=False, action='store_true',
+                        help='Take a lock in --state-dir for the run, and'
+                             ' if another run holds it, wait for that run'
+                             ' to finish rather than applying alongside it.'
+                             ' As the fingerprint is checked once the lock'
+                             ' is held, runs which find nothing changed by'
+                             ' then exit without rendering.')
+    parser.add_argument('--state-dir', metavar='STATE_DIR', default=None,
+                        help='Directory in which to record the state of the'
+                             ' last successful apply. When given, a run whose'
+                             ' metadata, templates, subhash and output root'
+                             ' match that apply, and whose outputs have not'
+                             ' been changed since, exits without rendering.'
+                             ' --key and --boolean-key look keys up in an'
+                             ' index kept there instead of parsing the'
+                             ' metadata while it is unchanged.')
     opts = parser.parse_args(argv[1:])
 
     return opts
@@ -332,6 +734,67 @@ def add_handler(logger, handler):
     logger.addHandler(handler)
 
 
+def limits_from_opts(opts):
+    """Return the limits for executable templates given by opts."""
+    return limits.Limits(cpu_limit=opts.exec_cpu_limit,
+                         memory_limit=opts.exec_memory_limit,
+                         output_limit=opts.exec_output_limit,
+                         nice=opts.exec_nice,
+                         ionice=opts.exec_ionice)
+
+
+def apply(opts):
+    """Apply, verify or repair for opts, then write any metrics and report."""
+    reporting = opts.report is not None or opts.report_fd is not None
+    if opts.memory_report and (not reporting or
+                               opts.report_format != 'json'):
+        raise exc.ConfigException(
+            '--memory-report requires --report or --report-fd in the json'
+            ' format')
+    stats = None
+    if opts.metrics_file or reporting:
+        stats = metrics.RunStats(memory=opts.memory_report)
+    if (opts.verify or opts.repair) and not opts.state_dir:
+        raise exc.ConfigException('--verify and --repair require --state-dir')
+    if opts.coalesce and not opts.state_dir:
+        raise exc.ConfigException('--coalesce requires --state-dir')
+    if opts.write_workers < 1:
+        raise exc.ConfigException('--write-workers must be at least 1')
+    try:
+        with contextlib.ExitStack() as stack:
+            if stats is not None:
+                stack.enter_context(stats.run())
+            if opts.coalesce:
+                with metrics.phase(stats, 'wait'):
+                    stack.enter_context(state.locked(opts.state_dir))
+            if opts.verify or opts.repair:
+                drifted = verify_outputs(opts.state_dir, opts.repair, stats)
+                if drifted:
+                    raise exc.ConfigException(
+                        '%d outputs have drifted since the last apply'
+                        % len(drifted))
+                return
+            install_config(opts.metadata, opts.templates, opts.output,
+                           opts.validate, opts.subhash,
+                           opts.fallback_metadata, opts.state_dir,
+                           stats, opts.partials, opts.only,
+                           opts.exclude, limits_from_opts(opts),
+                           opts.write_workers)
+    finally:
+        if opts.metrics_file:
+            try:
+                metrics.write_textfile(opts.metrics_file, stats)
+            except OSError as e:
+                logger.error("could not write metrics to %s: %s",
+                             opts.metrics_file, e)
+        if reporting:
+            try:
+                report.write(stats, opts.report, opts.report_fd,
+                             opts.report_format)
+            except OSError as e:
+                logger.error("could not write report: %s", e)
+
+
 def main(argv=sys.argv):
     opts = parse_opts(argv)
     if opts.print_templates:
@@ -363,19 +826,27 @@ def main(argv=sys.argv):
         if opts.templates is None:
             raise exc.ConfigException('missing option --templates')
 
-        if opts.key:
+        if opts.print_fingerprint:
+            print_fingerprint(opts.metadata, opts.templates, opts.output,
+                              opts.subhash, opts.fallback_metadata,
+                              opts.partials, opts.only, opts.exclude)
+        elif opts.schema:
+            validate_schema(opts.metadata, opts.schema,
+                            opts.fallback_metadata)
+        elif opts.key:
             print_key(opts.metadata,
                       opts.key,
                       opts.type,
                       opts.key_default,
-                      opts.fallback_metadata)
+                      opts.fallback_metadata,
+                      opts.state_dir)
         elif opts.boolean_key:
             return boolean_key(opts.metadata,
                                opts.boolean_key,
-                               opts.fallback_metadata)
+                               opts.fallback_metadata,
+                               opts.state_dir)
         else:
-            install_config(opts.metadata, opts.templates, opts.output,
-                           opts.validate, opts.subhash, opts.fallback_metadata)
+            apply(opts)
             logger.info("success")
     except exc.ConfigException as e:
         logger.error(e)
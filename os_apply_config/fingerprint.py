@@ -0,0 +1,124 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fingerprints of everything that determines the result of an apply.
+
+A run whose fingerprint matches the one recorded after the last successful
+apply, and whose outputs are still as that apply left them, has nothing to
+do.
+"""
+
+import hashlib
+import json
+import os
+
+from os_apply_config import config_exception as exc
+from os_apply_config import state
+
+STATE_FILE = 'fingerprint.json'
+
+# Bump when the inputs covered by the fingerprint change, so that state
+# recorded by an older release never matches.
+FORMAT = 2
+
+
+def stat_identity(path, follow_symlinks=False):
+    """Return a list identifying the current state of path, or None.
+
+    Outputs are identified by themselves, so that one replaced by a
+    symlink is noticed; templates and partials by what they link to, so
+    that editing the target is.
+    """
+    try:
+        st = os.stat(path, follow_symlinks=follow_symlinks)
+    except FileNotFoundError:
+        return None
+    return identity(st)
+
+
+def identity(st):
+    """Return the list stat_identity would give for the stat result st."""
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+            st.st_mode, st.st_uid, st.st_gid]
+
+
+def _content_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise exc.ConfigException('Could not open %s for reading. %s' %
+                                  (path, e))
+
+
+def _tree_manifest(root):
+    if os.path.isfile(root):
+        # A template archive.
+        return [('', stat_identity(root, follow_symlinks=True))]
+    manifest = []
+    for cur_root, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for f in sorted(files):
+            path = os.path.join(cur_root, f)
+            manifest.append((os.path.relpath(path, root),
+                             stat_identity(path, follow_symlinks=True)))
+    return manifest
+
+
+def compute(config_files, template_root, output_path, subhash=None,
+            partials_dir=None, only=None, exclude=None):
+    """Return the fingerprint of an apply as a hex string.
+
+    Metadata files are hashed by content, because collectors tend to
+    rewrite them with identical data.  The template and partial trees are
+    covered by the stat identity of each file, which is cheap even for
+    large trees.
+    """
+    doc = {
+        'format': FORMAT,
+        'metadata': [(path, _content_hash(path))
+                     for path in config_files if path],
+        'templates': _tree_manifest(template_root),
+        'partials': _tree_manifest(partials_dir) if partials_dir else [],
+        'subhash': subhash,
+        'output': os.path.abspath(output_path),
+        'only': only or [],
+        'exclude': exclude or [],
+    }
+    return hashlib.sha256(
+        json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_current(state_dir, fingerprint):
+    """Whether fingerprint was recorded and the outputs have not drifted."""
+    record = state.load_json(os.path.join(state_dir, STATE_FILE))
+    if not isinstance(record, dict):
+        return False
+    if record.get('fingerprint') != fingerprint:
+        return False
+    for path, identity in record.get('outputs', {}).items():
+        if stat_identity(path) != identity:
+            return False
+    return True
+
+
+def record(state_dir, fingerprint, outputs):
+    """Record fingerprint along with the current identity of outputs."""
+    state.ensure_dir(state_dir)
+    state.save_json(os.path.join(state_dir, STATE_FILE), {
+        'fingerprint': fingerprint,
+        'outputs': dict((path, stat_identity(path)) for path in outputs),
+    })
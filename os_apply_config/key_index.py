@@ -0,0 +1,223 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A flattened, memory-mappable index of every key path in the metadata.
+
+The index maps each dotted path that --key can resolve, including list
+indices, to the JSON encoding of its value.  The metadata is encoded
+once, and each path points at the range of that encoding holding its
+value, so that a value is stored once however deeply it is nested.  The
+index is tagged with the stat identity of the metadata files it was
+built from, so lookups can tell whether it is current without reading
+those files.
+
+File layout, all integers little endian::
+
+    magic           8 bytes, MAGIC
+    signature       32 bytes, sha256 of the metadata stat identities
+    count           uint32
+    entries         count * (key offset uint64, key length uint32,
+                             value offset uint64, value length uint32),
+                    sorted by key
+    data            the keys, then the JSON encoding of the metadata,
+                    which the entries point into
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+from os_apply_config import collect_config
+from os_apply_config import config_exception as exc
+from os_apply_config import state
+
+INDEX_FILE = 'key-index'
+
+MAGIC = b'OACKIDX2'
+_HEADER = struct.Struct('<8s32sI')
+_ENTRY = struct.Struct('<QIQI')
+
+
+def signature(config_files):
+    """Return a digest of the stat identity of each metadata file.
+
+    Returns None if any of them was modified too recently for its stat
+    identity to be trusted, as for collect_config.ParseCache, in which
+    case no index is built or used.
+    """
+    identities = []
+    now = time.time_ns()
+    for path in config_files:
+        if not path:
+            continue
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            identities.append((path, None))
+            continue
+        except OSError as e:
+            raise exc.ConfigException('Could not open %s for reading. %s' %
+                                      (path, e))
+        if now - st.st_mtime_ns < collect_config.ParseCache.RACY_NS:
+            return None
+        identities.append((path, [st.st_dev, st.st_ino, st.st_size,
+                                  st.st_mtime_ns, st.st_ctime_ns]))
+    return hashlib.sha256(
+        json.dumps(identities).encode('utf-8')).digest()
+
+
+def _encode(value, key, chunks, entries, offset):
+    """Append the JSON encoding of value to chunks, starting at offset.
+
+    Appends (path, start, length) to entries for the value at key, and
+    for everything reachable within it.  key is None for the root, and
+    False for a value --key cannot reach.  Returns
+    the offset after the encoding.  The encoding is ASCII, so lengths in
+    characters are lengths in bytes.
+    """
+    start = offset
+    if isinstance(value, (dict, list)):
+        if isinstance(value, dict):
+            open_, close = '{', '}'
+            items = ((json.dumps(k if isinstance(k, str) else str(k)) + ': ',
+                      str(k), v) for k, v in value.items())
+        else:
+            open_, close = '[', ']'
+            items = (('', str(i), v) for i, v in enumerate(value))
+        chunks.append(open_)
+        offset += 1
+        sep = ''
+        # The root has no key, while '' is the key of a value in it.
+        prefix = '' if key is None or key is False else key + '.'
+        for head, k, v in items:
+            head = sep + head
+            sep = ', '
+            chunks.append(head)
+            offset += len(head)
+            # --key splits on '.', so keys containing one cannot be
+            # reached, nor anything beneath them.
+            reachable = key is not False and '.' not in k
+            offset = _encode(v, prefix + k if reachable else False,
+                             chunks, entries, offset)
+        chunks.append(close)
+        offset += 1
+    else:
+        text = json.dumps(value)
+        chunks.append(text)
+        offset += len(text)
+    if key is not None and key is not False:
+        entries.append((key.encode('utf-8'), start, offset - start))
+    return offset
+
+
+def serialize(config, sig):
+    """Return the index of config as bytes."""
+    chunks = []
+    entries = []
+    _encode(config, None, chunks, entries, 0)
+    entries.sort()
+    keys_size = sum(len(key) for key, _start, _length in entries)
+    table = []
+    keys = []
+    offset = 0
+    for key, start, length in entries:
+        table.append(_ENTRY.pack(offset, len(key), keys_size + start,
+                                 length))
+        keys.append(key)
+        offset += len(key)
+    return b''.join([_HEADER.pack(MAGIC, sig, len(entries))] + table +
+                    keys + [''.join(chunks).encode('ascii')])
+
+
+def build(state_dir, sig, config):
+    """Write the index of config, built from metadata with signature sig.
+
+    Nothing is written when sig is None.
+    """
+    if sig is None:
+        return
+    state.ensure_dir(state_dir)
+    state.atomic_write(os.path.join(state_dir, INDEX_FILE),
+                       serialize(config, sig), mode=0o600)
+
+
+class KeyIndex:
+    """Read-only view of an index file, shared through the page cache."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.signature, self._count = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a key index' % path)
+        self._data = _HEADER.size + self._count * _ENTRY.size
+
+    def close(self):
+        self._map.close()
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self._map, _HEADER.size + i * _ENTRY.size)
+
+    def _key(self, key_off, key_len):
+        start = self._data + key_off
+        return self._map[start:start + key_len]
+
+    def get(self, key):
+        """Return (True, value) for an indexed key, else (False, None)."""
+        key = key.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_off, key_len, val_off, val_len = self._entry(mid)
+            found = self._key(key_off, key_len)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                start = self._data + val_off
+                return True, json.loads(self._map[start:start + val_len])
+        return False, None
+
+
+def load(state_dir, sig):
+    """Return the KeyIndex in state_dir if it was built with sig."""
+    if sig is None:
+        return None
+    try:
+        index = KeyIndex(os.path.join(state_dir, INDEX_FILE))
+    except (OSError, ValueError, struct.error):
+        return None
+    if index.signature != sig:
+        index.close()
+        return None
+    return index
+
+
+def is_canonical(key):
+    """Whether a miss in the index is authoritative for key.
+
+    --key also accepts list indices that int() parses but that are not
+    spelled the way the index spells them, such as '-1' or '01'.
+    """
+    for part in key.split('.'):
+        try:
+            if str(int(part)) != part or part.startswith('-'):
+                return False
+        except ValueError:
+            pass
+    return True
@@ -0,0 +1,259 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resource limits and priorities for executable templates.
+
+CPU time and address space are limited with setrlimit, and the nice and
+I/O priority set, in the child between fork and exec, so they apply to
+the script alone.  The size of its output is limited by the parent as it
+reads it.
+"""
+
+import ctypes
+import logging
+import math
+import os
+import platform
+import re
+import resource
+import select
+import selectors
+import signal
+
+from os_apply_config import config_exception as exc
+
+logger = logging.getLogger('os-apply-config')
+
+KEYS = ('cpu_limit', 'memory_limit', 'output_limit', 'nice', 'ionice')
+
+# ioprio_set(2) has no wrapper in the standard library or in glibc.
+IOPRIO_SET = {
+    'x86_64': 251,
+    'aarch64': 30,
+    'ppc64le': 273,
+    'ppc64': 273,
+    's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+SIZE_UNITS = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+
+# How much of stderr to keep for error messages.
+STDERR_MAX = 64 * 1024
+
+# What scripts print when an allocation fails.
+ENOMEM_MARKERS = (b'MemoryError', b'Cannot allocate memory',
+                  b'out of memory', b'Out of memory')
+
+
+def parse_seconds(key, v):
+    if type(v) not in (int, float) or v <= 0:
+        raise exc.ConfigException(
+            "%s '%s' is not a positive number of seconds" % (key, v))
+    return v
+
+
+def parse_size(key, v):
+    """Return v, an int or a string such as '512M', in bytes."""
+    if type(v) is str:
+        m = re.match(r'^\s*(\d+)\s*([kmg]?)i?b?\s*$', v, re.IGNORECASE)
+        if m:
+            v = int(m.group(1)) * SIZE_UNITS[m.group(2).lower()]
+    if type(v) is not int or v <= 0:
+        raise exc.ConfigException(
+            "%s '%s' is not a positive size such as 1048576 or '512M'"
+            % (key, v))
+    return v
+
+
+def parse_nice(key, v):
+    if type(v) is not int or not -20 <= v <= 19:
+        raise exc.ConfigException(
+            "%s '%s' is not an integer from -20 to 19" % (key, v))
+    return v
+
+
+def parse_ionice(key, v):
+    """Return v, such as 'idle' or 'best-effort:7', as (class, level)."""
+    if type(v) is int:
+        v = 'best-effort:%d' % v
+    if type(v) is str:
+        name, _sep, level = v.partition(':')
+        if name in IOPRIO_CLASSES and (not level or level.isdigit()):
+            level = int(level or (0 if name == 'idle' else 4))
+            if 0 <= level <= 7:
+                return name, level
+    raise exc.ConfigException(
+        "%s '%s' is not 'idle', 'best-effort[:0-7]' or 'realtime[:0-7]'"
+        % (key, v))
+
+
+PARSERS = {
+    'cpu_limit': parse_seconds,
+    'memory_limit': parse_size,
+    'output_limit': parse_size,
+    'nice': parse_nice,
+    'ionice': parse_ionice,
+}
+
+
+def _ioprio_set(machine=None):
+    """Return a function setting the I/O priority of this process."""
+    nr = IOPRIO_SET.get(machine or platform.machine())
+    if nr is None:
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    def ioprio_set(cls, level):
+        prio = (IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT) | level
+        if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    return ioprio_set
+
+
+class Limits:
+    """The limits to run an executable template under.
+
+    Each of KEYS is None when not limited.  Values are validated as for
+    the keys of a control file.
+    """
+
+    def __init__(self, **kwargs):
+        for key in KEYS:
+            v = kwargs.pop(key, None)
+            setattr(self, key, None if v is None else PARSERS[key](key, v))
+        if kwargs:
+            raise exc.ConfigException(
+                "unrecognised limit '%s'" % sorted(kwargs)[0])
+
+    def __eq__(self, other):
+        return type(other) is type(self) and vars(self) == vars(other)
+
+    def __bool__(self):
+        return any(getattr(self, key) is not None for key in KEYS)
+
+    def __str__(self):
+        return ', '.join('%s=%s' % (key, getattr(self, key))
+                         for key in KEYS if getattr(self, key) is not None)
+
+    def override(self, obj):
+        """Return these limits overridden by those set on obj."""
+        limits = Limits()
+        for key in KEYS:
+            v = getattr(obj, key, None)
+            setattr(limits, key, getattr(self, key) if v is None else v)
+        return limits
+
+    def preexec(self):
+        """Return a function to apply the limits in a child, or None."""
+        if (self.cpu_limit is None and self.memory_limit is None and
+                self.nice is None and self.ionice is None):
+            return None
+        ioprio_set = None
+        if self.ionice is not None:
+            ioprio_set = _ioprio_set()
+            if ioprio_set is None:
+                logger.warning('ionice is not supported on %s, ignoring it',
+                               platform.machine())
+        cpu, memory, nice, ionice = (self.cpu_limit, self.memory_limit,
+                                     self.nice, self.ionice)
+
+        def preexec():
+            if cpu is not None:
+                # SIGXCPU at the soft limit, SIGKILL a second later.
+                soft = max(1, math.ceil(cpu))
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 1))
+            if memory is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+            if nice is not None:
+                os.nice(nice - os.nice(0))
+            if ioprio_set is not None:
+                ioprio_set(*ionice)
+        return preexec
+
+    def explain(self, returncode, cpu_seconds, stderr):
+        """Return which limit a script failing so ran into, or None."""
+        if self.cpu_limit is not None and (
+                returncode == -signal.SIGXCPU or
+                (returncode == -signal.SIGKILL and
+                 cpu_seconds >= self.cpu_limit)):
+            return 'CPU time limit of %s seconds' % self.cpu_limit
+        if self.memory_limit is not None and any(
+                marker in stderr for marker in ENOMEM_MARKERS):
+            return 'memory limit of %d bytes' % self.memory_limit
+        return None
+
+
+class OutputLimitExceeded(Exception):
+    pass
+
+
+def communicate(p, data, output_limit):
+    """As Popen.communicate, but stop reading at output_limit bytes.
+
+    Raises OutputLimitExceeded, having killed p, if the script writes
+    more than that to stdout.  Only the first STDERR_MAX bytes of stderr
+    are kept.
+    """
+    stdout, stderr = [], []
+    size = stderr_size = 0
+    offset = 0
+    view = memoryview(data)
+    with selectors.DefaultSelector() as sel:
+        if data:
+            sel.register(p.stdin, selectors.EVENT_WRITE)
+        else:
+            p.stdin.close()
+        sel.register(p.stdout, selectors.EVENT_READ)
+        sel.register(p.stderr, selectors.EVENT_READ)
+        try:
+            while sel.get_map():
+                for key, _events in sel.select():
+                    if key.fileobj is p.stdin:
+                        try:
+                            offset += os.write(
+                                key.fd, view[offset:offset + select.PIPE_BUF])
+                        except BrokenPipeError:
+                            offset = len(data)
+                        if offset >= len(data):
+                            sel.unregister(p.stdin)
+                            p.stdin.close()
+                        continue
+                    chunk = os.read(key.fd, 64 * 1024)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                    elif key.fileobj is p.stdout:
+                        size += len(chunk)
+                        if size > output_limit:
+                            p.kill()
+                            raise OutputLimitExceeded()
+                        stdout.append(chunk)
+                    elif stderr_size < STDERR_MAX:
+                        stderr_size += len(chunk)
+                        stderr.append(chunk)
+        finally:
+            for f in (p.stdin, p.stdout, p.stderr):
+                f.close()
+            p.wait()
+    return b''.join(stdout), b''.join(stderr)[:STDERR_MAX]
+
+
+def cpu_seconds():
+    """CPU time used by the children waited for so far."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
@@ -0,0 +1,172 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The outputs of the last apply, for detecting and repairing drift.
+
+The manifest records the content hash, size, mode, ownership and stat
+identity of every output the last apply left in place.  The rendered
+content itself is kept alongside it in a store addressed by hash, from
+which drifted outputs can be rewritten without rendering again.
+"""
+
+import hashlib
+import os
+import stat
+
+from os_apply_config import config_exception as exc
+from os_apply_config import fingerprint
+from os_apply_config import oac_file
+from os_apply_config import state
+from os_apply_config import writer
+
+MANIFEST_FILE = 'manifest.json'
+CONTENT_DIR = 'content'
+
+# Bump when the layout of the manifest changes.
+FORMAT = 1
+
+
+def _entry(path, body):
+    st = os.lstat(path)
+    return {
+        'sha256': hashlib.sha256(body).hexdigest(),
+        'size': st.st_size,
+        'mode': stat.S_IMODE(st.st_mode),
+        'uid': st.st_uid,
+        'gid': st.st_gid,
+        'identity': fingerprint.identity(st),
+    }
+
+
+def load(state_dir):
+    """Return the outputs recorded in state_dir as a dict by path."""
+    doc = state.load_json(os.path.join(state_dir, MANIFEST_FILE))
+    if not isinstance(doc, dict) or doc.get('format') != FORMAT:
+        return {}
+    return doc.get('outputs', {})
+
+
+def _save(state_dir, outputs):
+    state.save_json(os.path.join(state_dir, MANIFEST_FILE),
+                    {'format': FORMAT, 'outputs': outputs})
+
+
+def _store(state_dir, digest, body):
+    content_dir = os.path.join(state_dir, CONTENT_DIR)
+    path = os.path.join(content_dir, digest)
+    if not os.path.exists(path):
+        state.ensure_dir(content_dir)
+        state.atomic_write(path, body, mode=0o600)
+
+
+def _collect_garbage(state_dir, outputs):
+    content_dir = os.path.join(state_dir, CONTENT_DIR)
+    live = set(entry['sha256'] for entry in outputs.values())
+    try:
+        names = os.listdir(content_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name not in live:
+            os.unlink(os.path.join(content_dir, name))
+
+
+def record(state_dir, written, partial=False):
+    """Record the outputs of an apply.
+
+    written holds the (path, obj, status) of each output, as returned by
+    Writer.write_all.  Outputs which were deleted, or not created, are
+    dropped from the manifest.  Unless partial is True, so are outputs
+    the apply did not write at all.
+    """
+    state.ensure_dir(state_dir)
+    outputs = load(state_dir) if partial else {}
+    for path, obj, status in written:
+        if status in ('deleted', 'skipped'):
+            outputs.pop(path, None)
+            continue
+        entry = _entry(path, obj.body)
+        _store(state_dir, entry['sha256'], obj.body)
+        outputs[path] = entry
+    _save(state_dir, outputs)
+    _collect_garbage(state_dir, outputs)
+
+
+def _hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check(path, entry):
+    """Return a list of the ways path has drifted from entry.
+
+    Content is only hashed when the stat identity has changed but the
+    size has not.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return ['missing']
+    if not stat.S_ISREG(st.st_mode):
+        return ['type']
+    if fingerprint.identity(st) == entry['identity']:
+        return []
+    drift = []
+    if stat.S_IMODE(st.st_mode) != entry['mode']:
+        drift.append('mode')
+    if (st.st_uid, st.st_gid) != (entry['uid'], entry['gid']):
+        drift.append('owner')
+    if st.st_size != entry['size'] or _hash(path) != entry['sha256']:
+        drift.append('content')
+    return drift
+
+
+def verify(state_dir):
+    """Return a list of (path, drift) for each drifted output."""
+    drifted = []
+    for path, entry in sorted(load(state_dir).items()):
+        drift = check(path, entry)
+        if drift:
+            drifted.append((path, drift))
+    return drifted
+
+
+def repair(state_dir, paths):
+    """Rewrite paths from the content recorded for them.
+
+    Returns a list of (path, obj, status) as Writer.write_all does.
+    """
+    outputs = load(state_dir)
+    repairs = []
+    for path in paths:
+        entry = outputs[path]
+        content = os.path.join(state_dir, CONTENT_DIR, entry['sha256'])
+        try:
+            with open(content, 'rb') as f:
+                body = f.read()
+        except OSError as e:
+            raise exc.ConfigException(
+                'Could not read the recorded content of %s. %s' % (path, e))
+        obj = oac_file.OacFile(body, mode=entry['mode'])
+        # Set directly, as the owner may no longer be in the passwd and
+        # group databases.
+        obj._owner, obj._group = entry['uid'], entry['gid']
+        repairs.append((path, obj))
+    with writer.Writer() as w:
+        written = w.write_all(repairs)
+    record(state_dir, written, partial=True)
+    return written
@@ -0,0 +1,307 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run statistics and their Prometheus text exposition."""
+
+import collections
+import contextlib
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+from os_apply_config import state
+
+PREFIX = 'os_apply_config_'
+
+# counter name -> (metric name, help text)
+COUNTERS = collections.OrderedDict([
+    ('templates_rendered', ('templates_rendered',
+                            'Templates rendered by the last run.')),
+    ('files_written', ('files_written',
+                       'Files written by the last run.')),
+    ('files_skipped', ('files_skipped',
+                       'Outputs left untouched by the last run.')),
+    ('files_deleted', ('files_deleted',
+                       'Files deleted by the last run.')),
+    ('files_drifted', ('files_drifted',
+                       'Outputs found changed since the last apply.')),
+    ('metadata_updates', ('files_metadata_updated',
+                          'Outputs whose mode or ownership alone the last'
+                          ' run changed.')),
+    ('chmods_skipped', ('chmods_skipped',
+                        'New files created with the right mode, needing no'
+                        ' chmod.')),
+    ('chowns_skipped', ('chowns_skipped',
+                        'New files created with the right ownership,'
+                        ' needing no chown.')),
+    ('name_lookups_cached', ('name_lookups_cached',
+                             'Owner and group lookups answered from the'
+                             ' cache.')),
+    ('bytes_written', ('bytes_written',
+                       'Bytes written by the last run.')),
+    ('executable_templates', ('executable_templates',
+                              'Executable templates run by the last run.')),
+    ('executable_seconds', ('executable_duration_seconds',
+                            'Time spent running executable templates.')),
+    ('plugin_templates', ('plugin_templates',
+                          'Plugin templates rendered by the last run.')),
+    ('plugin_seconds', ('plugin_duration_seconds',
+                        'Time spent rendering plugin templates.')),
+    ('metadata_bytes', ('metadata_bytes',
+                        'Size of the metadata files read by the last run.')),
+    ('runs_unchanged', ('unchanged',
+                        'Whether the last run found its inputs unchanged.')),
+])
+
+LAST_SUCCESS = PREFIX + 'last_success_timestamp_seconds'
+
+# write_file statuses which change the output tree
+CHANGES = ('created', 'modified', 'deleted')
+
+
+def rss():
+    """Return the resident set size of this process in bytes, or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryTracker:
+    """Peak and retained memory of each phase of a run.
+
+    Python allocations are traced with tracemalloc, and the resident set
+    size is sampled from a background thread to catch peaks between phase
+    boundaries.
+    """
+
+    INTERVAL = 0.01
+    TOP = 10
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self._peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        tracemalloc.start()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        tracemalloc.stop()
+
+    def _sample(self):
+        while not self._stop.wait(self.INTERVAL):
+            self._peak_rss = max(self._peak_rss, rss() or 0)
+
+    def _top(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        return [{'line': '%s:%d' % (stat.traceback[0].filename,
+                                    stat.traceback[0].lineno),
+                 'size_bytes': stat.size,
+                 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:self.TOP]]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure the enclosed block, combining it with earlier entries.
+
+        A phase entered more than once, as render and write are for each
+        priority, reports the highest peaks, the total retained and the
+        largest allocation sites of all its entries.
+        """
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        self._peak_rss = rss() or 0
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            rss_now = rss()
+            entry = {
+                'peak_bytes': peak,
+                'retained_bytes': current - before,
+                'rss_bytes': rss_now,
+                'peak_rss_bytes': max(self._peak_rss, rss_now or 0),
+                'top': self._top(),
+            }
+            earlier = self.phases.get(name)
+            if earlier is not None:
+                entry = self._combine(earlier, entry)
+            self.phases[name] = entry
+
+    def _combine(self, earlier, later):
+        top = {}
+        for stat in earlier['top'] + later['top']:
+            if stat['size_bytes'] > top.get(stat['line'],
+                                            {'size_bytes': -1})['size_bytes']:
+                top[stat['line']] = stat
+        return {
+            'peak_bytes': max(earlier['peak_bytes'], later['peak_bytes']),
+            'retained_bytes': (earlier['retained_bytes'] +
+                               later['retained_bytes']),
+            'rss_bytes': later['rss_bytes'],
+            'peak_rss_bytes': max(earlier['peak_rss_bytes'],
+                                  later['peak_rss_bytes']),
+            'top': sorted(top.values(), key=lambda stat: -stat['size_bytes'])[
+                :self.TOP],
+        }
+
+    def summary(self):
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'phases': self.phases,
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_bytes': self_usage.ru_maxrss * 1024,
+            'children_max_rss_bytes': children.ru_maxrss * 1024,
+        }
+
+
+class RunStats:
+    """Timings and counters collected over a single run.
+
+    With memory=True each phase is also measured by a MemoryTracker.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = MemoryTracker() if memory else None
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.changes = dict((status, []) for status in CHANGES)
+        # path -> drift, for runs which verify the outputs
+        self.drift = None
+        # priority -> seconds into the run its outputs were written
+        self.priorities = collections.OrderedDict()
+        self.duration = 0.0
+        self.success = False
+        self._start = time.monotonic()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block, adding it to the named phase."""
+        start = time.monotonic()
+        try:
+            if self.memory is None:
+                yield
+            else:
+                with self.memory.phase(name):
+                    yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0) +
+                                 time.monotonic() - start)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def record_file(self, path, status, size=0):
+        """Account for an output which write_file left in status."""
+        if status in CHANGES:
+            self.changes[status].append(path)
+        if status in ('created', 'modified'):
+            self.count('files_written')
+            self.count('bytes_written', size)
+        elif status == 'deleted':
+            self.count('files_deleted')
+        else:
+            self.count('files_skipped')
+
+    def priority_done(self, priority):
+        """Record that the outputs of priority have been written."""
+        self.priorities[priority] = time.monotonic() - self._start
+
+    @contextlib.contextmanager
+    def run(self):
+        """Time the whole run, recording whether it succeeded."""
+        start = self._start = time.monotonic()
+        if self.memory is not None:
+            self.memory.start()
+        try:
+            yield self
+            self.success = True
+        finally:
+            self.duration = time.monotonic() - start
+            if self.memory is not None:
+                self.memory.stop()
+
+
+def phase(stats, name):
+    """Return stats.phase(name), or a no-op context if stats is None."""
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
+
+
+def _previous_success(path):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(LAST_SUCCESS + ' '):
+                    return float(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _metric(lines, name, help_text, samples):
+    lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+    lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+    for labels, value in samples:
+        lines.append('%s%s%s %s' % (PREFIX, name, labels, repr(value)))
+
+
+def format_textfile(stats, last_success=None):
+    """Return stats in the Prometheus text exposition format."""
+    lines = []
+    _metric(lines, 'duration_seconds', 'Duration of the last run.',
+            [('', stats.duration)])
+    _metric(lines, 'phase_duration_seconds',
+            'Duration of each phase of the last run.',
+            [('{phase="%s"}' % name, seconds)
+             for name, seconds in stats.phases.items()])
+    if stats.priorities:
+        _metric(lines, 'priority_completed_seconds',
+                'Time into the last run the outputs of each priority were'
+                ' written.',
+                [('{priority="%d"}' % priority, seconds)
+                 for priority, seconds in stats.priorities.items()])
+    for counter, (name, help_text) in COUNTERS.items():
+        _metric(lines, name, help_text, [('', stats.counters[counter])])
+    _metric(lines, 'last_run_success',
+            'Whether the last run succeeded.', [('', int(stats.success))])
+    if last_success is not None:
+        _metric(lines, 'last_success_timestamp_seconds',
+                'Time of the last successful run.', [('', last_success)])
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, stats):
+    """Write stats atomically for the node_exporter textfile collector.
+
+    The time of the last success is carried over from the previous file
+    when this run failed.
+    """
+    if stats.success:
+        last_success = time.time()
+    else:
+        last_success = _previous_success(path)
+    state.atomic_write(path, format_textfile(stats, last_success))
@@ -13,10 +13,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import grp
 import pwd
 
 from os_apply_config import config_exception as exc
+from os_apply_config import limits
+
+
+# Owners and groups are resolved through NSS, which on nodes backed by LDAP
+# or SSSD means a round trip for every lookup, while a tree uses the same
+# few service users over and over.  Lookups are cached for a run; call
+# clear_caches() before the next so that changes are picked up.
+
+@functools.lru_cache(maxsize=None, typed=True)
+def _uid(v):
+    try:
+        return (pwd.getpwuid(v) if type(v) is int else pwd.getpwnam(v))[2]
+    except KeyError:
+        return None
+
+
+@functools.lru_cache(maxsize=None, typed=True)
+def _gid(v):
+    try:
+        return (grp.getgrgid(v) if type(v) is int else grp.getgrnam(v))[2]
+    except KeyError:
+        return None
+
+
+def clear_caches():
+    _uid.cache_clear()
+    _gid.cache_clear()
+
+
+def cached_lookups():
+    """Return how many owner and group lookups the caches answered."""
+    return _uid.cache_info().hits + _gid.cache_info().hits
+
+
+def _limit(key, doc):
+    def get(self):
+        return getattr(self, '_' + key)
+
+    def set_(self, v):
+        setattr(self, '_' + key, limits.PARSERS[key](key, v))
+    return property(get, set_, doc=doc)
 
 
 class OacFile:
@@ -25,6 +67,15 @@ class OacFile:
         'mode': None,
         'owner': None,
         'group': None,
+        'cpu_limit': None,
+        'memory_limit': None,
+        'output_limit': None,
+        'nice': None,
+        'ionice': None,
+        'input_keys': None,
+        'input_subhash': None,
+        'priority': 0,
+        'plugin': False,
     }
 
     def __init__(self, body, **kwargs):
@@ -106,18 +157,14 @@ class OacFile:
 
         EG 'rabbitmq' or 501.
         """
-        try:
-            if type(v) is int:
-                user = pwd.getpwuid(v)
-            elif type(v) is str:
-                user = pwd.getpwnam(v)
-            else:
-                raise exc.ConfigException(
-                    "owner '%s' must be a string or int" % v)
-        except KeyError:
+        if type(v) not in (int, str):
+            raise exc.ConfigException(
+                "owner '%s' must be a string or int" % v)
+        uid = _uid(v)
+        if uid is None:
             raise exc.ConfigException(
                 "owner '%s' not found in passwd database" % v)
-        self._owner = user[2]
+        self._owner = uid
 
     @property
     def group(self):
@@ -130,15 +177,80 @@ class OacFile:
 
         EG 'rabbitmq' or 501.
         """
-        try:
-            if type(v) is int:
-                group = grp.getgrgid(v)
-            elif type(v) is str:
-                group = grp.getgrnam(v)
-            else:
-                raise exc.ConfigException(
-                    "group '%s' must be a string or int" % v)
-        except KeyError:
+        if type(v) not in (int, str):
+            raise exc.ConfigException(
+                "group '%s' must be a string or int" % v)
+        gid = _gid(v)
+        if gid is None:
             raise exc.ConfigException(
                 "group '%s' not found in group database" % v)
-        self._group = group[2]
+        self._group = gid
+
+    cpu_limit = _limit(
+        'cpu_limit', "Seconds of CPU time an executable template may use.")
+    memory_limit = _limit(
+        'memory_limit',
+        "Address space an executable template may use, EG 536870912 or"
+        " '512M'.")
+    output_limit = _limit(
+        'output_limit', "Bytes of output an executable template may write.")
+    nice = _limit('nice', "The niceness to run an executable template at.")
+    ionice = _limit(
+        'ionice',
+        "The I/O priority to run an executable template at, EG 'idle' or"
+        " 'best-effort:7'.")
+
+    @property
+    def input_keys(self):
+        """The dotted keys an executable template reads, EG ['nova.db']."""
+        return self._input_keys
+
+    @input_keys.setter
+    def input_keys(self, v):
+        """Pass in the keys to send an executable template.
+
+        Only these keys, with the hashes containing them, are written to
+        its standard in.
+        """
+        if type(v) is str:
+            v = [v]
+        if (type(v) is not list or
+                not all(type(k) is str and k for k in v)):
+            raise exc.ConfigException(
+                "input_keys '%s' is not a list of keys" % v)
+        self._input_keys = v
+
+    @property
+    def input_subhash(self):
+        """The hash to send an executable template, EG 'nova'."""
+        return self._input_subhash
+
+    @input_subhash.setter
+    def input_subhash(self, v):
+        if type(v) is not str or not v:
+            raise exc.ConfigException(
+                "input_subhash '%s' is not a key" % v)
+        self._input_subhash = v
+
+    @property
+    def priority(self):
+        """When to render and write the file, highest first, EG 10."""
+        return self._priority
+
+    @priority.setter
+    def priority(self, v):
+        if type(v) is not int:
+            raise exc.ConfigException("priority '%s' is not an integer" % v)
+        self._priority = v
+
+    @property
+    def plugin(self):
+        """Whether the template is a Python module defining render(config)."""
+        return self._plugin
+
+    @plugin.setter
+    def plugin(self, v):
+        if type(v) is not bool:
+            raise exc.ConfigException(
+                "plugin requires Boolean, got: '%s'" % v)
+        self._plugin = v
@@ -0,0 +1,75 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Python templates rendered in process.
+
+A template whose control file sets `plugin: true` is a Python module
+defining render(config), which returns the output as bytes or a string.
+Each module is loaded once and kept for as long as its source is
+unchanged, and called with the parsed config itself, so that rendering
+costs neither a fork and exec nor encoding the config as JSON and
+decoding it again.  The config is shared with every other template, so
+plugins must not change it.
+"""
+
+import traceback
+import types
+
+from os_apply_config import config_exception as exc
+
+# template -> (source text, module)
+_modules = {}
+
+
+def _failed(template):
+    return exc.ConfigException(
+        "config plugin failed: %s\n\nwith error:\n\n%s"
+        % (template, traceback.format_exc()))
+
+
+def load(template, source):
+    """Return the module for template, read from source."""
+    text = source.read(template)
+    cached = _modules.get(template)
+    if cached is not None and cached[0] == text:
+        return cached[1]
+    module = types.ModuleType('os_apply_config_plugin')
+    module.__file__ = template
+    try:
+        exec(compile(text, template, 'exec'), module.__dict__)
+    except Exception:
+        raise _failed(template)
+    if not callable(getattr(module, 'render', None)):
+        raise exc.ConfigException(
+            "config plugin failed: %s does not define render(config)"
+            % template)
+    _modules[template] = (text, module)
+    return module
+
+
+def render(template, config, source):
+    """Return what the plugin template renders for config.
+
+    config is passed as it is, and must be treated as read-only.
+    """
+    module = load(template, source)
+    try:
+        out = module.render(config)
+    except Exception:
+        raise _failed(template)
+    if not isinstance(out, (bytes, str)):
+        raise exc.ConfigException(
+            "config plugin failed: %s returned %s, not bytes or a string"
+            % (template, type(out).__name__))
+    return out
@@ -14,11 +14,141 @@
 # limitations under the License.
 
 import json
+import os
 
 import pystache
+from pystache import context
+from pystache import parser
+from pystache import renderengine
+
+
+class PartialLoader:
+    """Loads partials by name from a directory, reading each one once."""
+
+    def __init__(self, path):
+        self.path = os.path.normpath(path)
+        self._partials = {}
+
+    def get(self, name):
+        if name not in self._partials:
+            self._partials[name] = self._read(name)
+        return self._partials[name]
+
+    def _read(self, name):
+        path = os.path.normpath(os.path.join(self.path, name))
+        if not path.startswith(os.path.join(self.path, '')):
+            return None
+        try:
+            with open(path) as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+
+class CachingRenderEngine(renderengine.RenderEngine):
+    """A RenderEngine which parses each distinct template only once.
+
+    Partials are rendered through here each time they are included, so a
+    partial shared by many templates is parsed once per renderer.
+    """
+
+    def __init__(self, parsed, **kwargs):
+        super().__init__(**kwargs)
+        self._parsed = parsed
+
+    def render(self, template, context_stack, delimiters=None):
+        key = (template, delimiters)
+        parsed = self._parsed.get(key)
+        if parsed is None:
+            parsed = parser.parse(template, delimiters)
+            self._parsed[key] = parsed
+        return parsed.render(self, context_stack)
+
+
+class MetadataContextStack(context.ContextStack):
+    """A ContextStack which resolves each name once per section scope.
+
+    The items the stack is created with form its bottom level, and each
+    section pushes a level of its own.  Every level caches the names
+    resolved against it and the levels below, misses included, and a name
+    whose first part is not in a section's item is looked up in the cache
+    of the level below.  The items must not change while the stack is in
+    use, which holds for a snapshot of metadata.
+    """
+
+    def __init__(self, *items, cache=None):
+        super().__init__(*items)
+        self._base = len(items)
+        self._caches = [{} if cache is None else cache]
+
+    @classmethod
+    def create(cls, *items, **kwargs):
+        return cls(*context.ContextStack.create(*items, **kwargs)._stack)
+
+    def get(self, name):
+        entry = self._caches[-1].get(name)
+        if entry is None:
+            if name == '.':
+                return super().get(name)
+            entry = self._lookup(len(self._caches) - 1, name)
+        found, result = entry
+        if not found:
+            raise context.KeyNotFoundError(name, result)
+        return result
+
+    def _lookup(self, level, name):
+        cache = self._caches[level]
+        entry = cache.get(name)
+        if entry is None:
+            parts = name.split('.')
+            if level:
+                items = [self._stack[self._base + level - 1]]
+            else:
+                items = reversed(self._stack[:self._base])
+            for item in items:
+                result = context._get_value(item, parts[0])
+                if result is not context._NOT_FOUND:
+                    entry = self._resolve(result, parts[1:])
+                    break
+            else:
+                if level:
+                    entry = self._lookup(level - 1, name)
+                else:
+                    entry = (False, 'first part')
+            cache[name] = entry
+        return entry
+
+    @staticmethod
+    def _resolve(result, parts):
+        for part in parts:
+            result = context._get_value(result, part)
+            if result is context._NOT_FOUND:
+                return False, 'missing %s' % repr(part)
+        return True, result
+
+    def push(self, item):
+        super().push(item)
+        self._caches.append({})
+
+    def pop(self):
+        self._caches.pop()
+        return super().pop()
+
+    def copy(self):
+        return MetadataContextStack(*self._stack)
 
 
 class JsonRenderer(pystache.Renderer):
+    """Renders templates against metadata, interpolating values as JSON.
+
+    A renderer is meant to render one snapshot of the metadata, which must
+    not be modified while it is in use: the JSON of each list and dict
+    interpolated is kept, up to COERCE_CACHE_SIZE characters in all, and
+    reused whenever the same object is interpolated again.
+    """
+
+    COERCE_CACHE_SIZE = 16 * 1024 * 1024
+
     def __init__(self,
                  file_encoding=None,
                  string_encoding=None,
@@ -33,13 +163,48 @@ class JsonRenderer(pystache.Renderer):
             return u
         if escape is None:
             escape = escape_noop
+        self._parsed = {}
+        # id(value) -> (value, json); holding value keeps its id unique
+        self._coerced = {}
+        self._coerced_size = 0
+        # ids of the items of a context -> (items, names resolved in it)
+        self._resolved = {}
         return super().__init__(file_encoding,
                                 string_encoding,
                                 decode_errors, search_dirs,
                                 file_extension, escape,
                                 partials, missing_tags)
 
+    def _make_render_engine(self):
+        return CachingRenderEngine(
+            self._parsed,
+            literal=self._to_unicode_hard,
+            escape=self._escape_to_unicode,
+            resolve_context=self._make_resolve_context(),
+            resolve_partial=self._make_resolve_partial(),
+            to_str=self.str_coerce)
+
+    def _render_final(self, render_func, *context, **kwargs):
+        # Templates rendered against the same metadata share the names
+        # resolved at the bottom of the stack.
+        stack = MetadataContextStack.create(*context, **kwargs)
+        if not kwargs:
+            key = tuple(id(item) for item in stack._stack)
+            _items, stack._caches[0] = self._resolved.setdefault(
+                key, (stack._stack[:], stack._caches[0]))
+        self._context = stack
+        return render_func(self._make_render_engine(), stack)
+
     def str_coerce(self, val):
         if val is None:
             return b''
-        return json.dumps(val)
+        if not isinstance(val, (dict, list)):
+            return json.dumps(val)
+        found = self._coerced.get(id(val))
+        if found is not None and found[0] is val:
+            return found[1]
+        text = json.dumps(val)
+        if self._coerced_size + len(text) <= self.COERCE_CACHE_SIZE:
+            self._coerced[id(val)] = (val, text)
+            self._coerced_size += len(text)
+        return text
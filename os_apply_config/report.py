@@ -0,0 +1,65 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Machine readable report of what a run did.
+
+The JSON form is an object holding the output paths the run created,
+modified and deleted, along with any diagnostics enabled for the run.
+Where templates set priorities, it also holds the time into the run at
+which the outputs of each priority were written.
+The lines form holds just the changed paths, one per line.
+"""
+
+import json
+import os
+
+from os_apply_config import metrics
+from os_apply_config import state
+
+FORMATS = ('json', 'lines')
+
+
+def build(stats):
+    """Return the JSON report for stats as a dict."""
+    doc = {'success': stats.success}
+    doc.update(stats.changes)
+    if stats.drift is not None:
+        doc['drift'] = stats.drift
+    # Only where some template sets a priority other than the default.
+    if any(stats.priorities):
+        doc['priorities'] = dict((str(priority), seconds) for
+                                 priority, seconds in stats.priorities.items())
+    if stats.memory is not None:
+        doc['memory'] = stats.memory.summary()
+    return doc
+
+
+def format_report(stats, fmt='json'):
+    if fmt == 'lines':
+        return ''.join('%s\n' % path for status in metrics.CHANGES
+                       for path in stats.changes[status])
+    return json.dumps(build(stats), indent=2, sort_keys=True) + '\n'
+
+
+def write(stats, path=None, fd=None, fmt='json'):
+    """Write the report for stats to path and/or file descriptor fd.
+
+    path is replaced atomically.  fd is left open for the caller.
+    """
+    text = format_report(stats, fmt)
+    if path is not None:
+        state.atomic_write(path, text)
+    if fd is not None:
+        with os.fdopen(fd, 'w', closefd=False) as f:
+            f.write(text)
@@ -0,0 +1,141 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Validation of metadata against a schema of value types.
+
+A schema maps dotted key paths, as accepted by --key, to the names of the
+types in value_types.TYPES::
+
+    keystone.database.host: netaddress
+    neutron.ovs.bridge_mappings.*: default
+    swift.devices:
+      type: swiftdevices
+      required: false
+
+A '*' segment matches every item of a list or every value of a hash.
+"""
+
+import yaml
+
+from os_apply_config import config_exception as exc
+from os_apply_config import value_types
+
+WILDCARD = '*'
+
+_MISSING = object()
+
+
+class Rule:
+    def __init__(self, path, type_name, required=True):
+        if (not isinstance(type_name, str) or
+                type_name not in value_types.TYPES):
+            raise exc.ConfigException(
+                "unknown type '%s' for key %s in schema" % (type_name, path))
+        if type(required) is not bool:
+            raise exc.ConfigException(
+                "required for key %s in schema must be a boolean" % path)
+        self.path = path
+        self.segments = path.split('.')
+        self.type_name = type_name
+        self.pattern = value_types.PATTERNS[type_name]
+        self.required = required
+
+
+def compile_schema(schema):
+    """Return the list of Rules described by a parsed schema document."""
+    if not isinstance(schema, dict):
+        raise exc.ConfigException("schema is not a dict")
+    rules = []
+    # YAML may give keys of other types, such as 1 or false.
+    for path, spec in sorted(schema.items(), key=lambda item: str(item[0])):
+        if isinstance(spec, dict):
+            unknown = set(spec) - set(['type', 'required'])
+            if unknown or 'type' not in spec:
+                raise exc.ConfigException(
+                    "schema for key %s must have a type and may only"
+                    " say whether it is required" % path)
+            rules.append(Rule(str(path), spec['type'],
+                              spec.get('required', True)))
+        else:
+            rules.append(Rule(str(path), spec))
+    return rules
+
+
+def load_schema(path):
+    try:
+        with open(path) as f:
+            schema = yaml.safe_load(f)
+    except OSError as e:
+        raise exc.ConfigException(
+            'Could not open %s for reading. %s' % (path, e))
+    except yaml.YAMLError:
+        raise exc.ConfigException('Could not parse schema file: %s' % path)
+    return compile_schema(schema)
+
+
+def _step(value, key):
+    """Resolve one path segment the way --key does."""
+    if isinstance(value, dict):
+        value = value.get(key)
+    elif isinstance(value, list):
+        try:
+            value = value[int(key)]
+        except (IndexError, ValueError):
+            return _MISSING
+    else:
+        return _MISSING
+    return _MISSING if value is None else value
+
+
+def _resolve(value, segments, prefix):
+    """Yield (path, value) for each key matched by segments."""
+    if not segments:
+        yield '.'.join(prefix), value
+        return
+    key, rest = segments[0], segments[1:]
+    if key != WILDCARD:
+        value = _step(value, key)
+        if value is _MISSING:
+            yield '.'.join(prefix + [key]), _MISSING
+        else:
+            for match in _resolve(value, rest, prefix + [key]):
+                yield match
+        return
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        yield '.'.join(prefix + [key]), _MISSING
+        return
+    for k, v in items:
+        if v is None:
+            yield '.'.join(prefix + [str(k)]), _MISSING
+        else:
+            for match in _resolve(v, rest, prefix + [str(k)]):
+                yield match
+
+
+def validate(config, rules):
+    """Return a list of every violation of rules found in config."""
+    errors = []
+    for rule in rules:
+        for path, value in _resolve(config, rule.segments, []):
+            if value is _MISSING:
+                if rule.required:
+                    errors.append('key %s does not exist' % path)
+            elif not rule.pattern.match(str(value)):
+                errors.append("cannot interpret value '%s' of key %s as"
+                              " type %s" % (value, path, rule.type_name))
+    return errors
@@ -0,0 +1,83 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from os_apply_config import config_exception as exc
+
+logger = logging.getLogger('os-apply-config')
+
+LOCK_FILE = 'lock'
+
+
+def ensure_dir(state_dir):
+    """Create the state directory if needed and return its path."""
+    try:
+        os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    except OSError as e:
+        raise exc.ConfigException(
+            'Could not create state directory %s. %s' % (state_dir, e))
+    return state_dir
+
+
+def atomic_write(path, data, mode=0o644):
+    """Replace path with data so readers never see a partial file."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    d = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(dir=d, delete=False) as newfile:
+        try:
+            newfile.write(data)
+            newfile.flush()
+            os.chmod(newfile.name, mode)
+            os.rename(newfile.name, path)
+        except Exception:
+            os.unlink(newfile.name)
+            raise
+
+
+def load_json(path, default=None):
+    """Return the JSON document at path, or default if it is unusable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, obj):
+    atomic_write(path, json.dumps(obj, sort_keys=True), mode=0o600)
+
+
+@contextlib.contextmanager
+def locked(state_dir):
+    """Hold the run lock of state_dir, waiting for it if need be."""
+    ensure_dir(state_dir)
+    path = os.path.join(state_dir, LOCK_FILE)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("waiting for another run to finish with %s",
+                        state_dir)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
@@ -0,0 +1,313 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Where templates are read from: a directory tree or an archive.
+
+A template is named by a path, and its source reads it, its control file
+and whether it is executable.  For a directory tree these are plain
+filesystem operations.  A zip or tar archive is instead opened once,
+memory-mapped, and indexed by member name, so that reading thousands of
+templates costs no further opens or directory walks.  Executable
+templates in an archive are extracted only while they run, beneath the
+state directory if there is one and otherwise beneath TMPDIR.
+"""
+
+import contextlib
+import fnmatch
+import mmap
+import os
+import posixpath
+import re
+import shutil
+import stat
+import tarfile
+import tempfile
+import zipfile
+
+from os_apply_config import config_exception as exc
+
+CONTROL_FILE_SUFFIX = ".oac"
+# Where executable templates are extracted to, beneath the state directory.
+EXEC_DIR = 'exec'
+
+
+def covers(out_path, pattern):
+    """Whether pattern matches out_path and everything beneath it."""
+    return (fnmatch.fnmatchcase(out_path, pattern) or
+            (pattern.endswith('*') and
+             fnmatch.fnmatchcase(out_path + '/', pattern)))
+
+
+def may_cover(out_dir, pattern):
+    """Whether pattern might match something beneath out_dir."""
+    literal = re.split(r'[*?[]', pattern, maxsplit=1)[0]
+    prefix = out_dir + '/'
+    return literal.startswith(prefix) or prefix.startswith(literal)
+
+
+def selected(out_path, only, exclude):
+    """Whether the output out_path is selected by only and exclude.
+
+    As for template_paths, a pattern matching a directory also matches
+    everything beneath it.
+    """
+    parents = []
+    d = posixpath.dirname(out_path)
+    while d != '/':
+        parents.append(d)
+        d = posixpath.dirname(d)
+    for p in exclude:
+        if (fnmatch.fnmatchcase(out_path, p) or
+                any(covers(d, p) for d in parents)):
+            return False
+    return not only or any(fnmatch.fnmatchcase(out_path, p) or
+                           any(covers(d, p) for d in parents)
+                           for p in only)
+
+
+class FileSource:
+    """Templates read from the directory tree under root."""
+
+    def __init__(self, root=None):
+        self.root = root
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def paths(self, only=None, exclude=None):
+        """Return (template, output path) pairs for the tree.
+
+        Directories that cannot contain a selected output are not
+        descended into.
+        """
+        root = self.root
+        res = []
+        only = [p.rstrip('/') or '/*' for p in only or []]
+        exclude = [p.rstrip('/') or '/*' for p in exclude or []]
+        selected_dirs = set()
+        for cur_root, subdirs, files in os.walk(root):
+            rel_dir = cur_root[len(root):]
+            out_dir = '/' + rel_dir.strip('/')
+            if out_dir == '/':
+                out_dir = ''
+            chosen = not only or cur_root in selected_dirs
+            if only or exclude:
+                kept = []
+                for d in subdirs:
+                    out_path = out_dir + '/' + d
+                    if any(covers(out_path, p) for p in exclude):
+                        continue
+                    if not chosen:
+                        if any(covers(out_path, p) for p in only):
+                            selected_dirs.add(os.path.join(cur_root, d))
+                        elif not any(may_cover(out_path, p) for p in only):
+                            continue
+                    kept.append(d)
+                subdirs[:] = kept
+            for f in files:
+                if f.endswith(CONTROL_FILE_SUFFIX):
+                    continue
+                out_path = out_dir + '/' + f
+                if any(fnmatch.fnmatchcase(out_path, p) for p in exclude):
+                    continue
+                if not chosen and not any(fnmatch.fnmatchcase(out_path, p)
+                                          for p in only):
+                    continue
+                res.append((os.path.join(cur_root, f),
+                            os.path.join(rel_dir, f)))
+        return res
+
+    def read(self, template):
+        with open(template) as f:
+            return f.read()
+
+    def control(self, template):
+        """Return the control file of template, or None if it has none."""
+        ctrl_file = template + CONTROL_FILE_SUFFIX
+        if not os.path.isfile(ctrl_file):
+            return None
+        with open(ctrl_file) as f:
+            return f.read()
+
+    def is_executable(self, template):
+        return os.path.isfile(template) and os.access(template, os.X_OK)
+
+    @contextlib.contextmanager
+    def executable(self, template):
+        """Yield a path from which template can be run."""
+        yield template
+
+
+class ArchiveSource(FileSource):
+    """Templates read from a zip or tar archive.
+
+    Templates are named by joining root, the path of the archive, and
+    their name in it, so that messages about them read as they would for a
+    directory tree.  Executable templates are extracted beneath exec_dir,
+    which is created if need be, or beneath TMPDIR if it is None.
+    """
+
+    def __init__(self, path, exec_dir=None):
+        super().__init__(path)
+        self.exec_dir = exec_dir
+        # name in the archive -> (mode, reader of its content)
+        self._members = {}
+        self._zip = None
+        try:
+            self._file = open(path, 'rb')
+        except OSError as e:
+            raise exc.ConfigException(
+                'Could not open template archive %s. %s' % (path, e))
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            self._file.close()
+            raise exc.ConfigException(
+                'Could not map template archive %s. %s' % (path, e))
+        try:
+            if zipfile.is_zipfile(self._file):
+                self._index_zip()
+            else:
+                self._index_tar()
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError,
+                OSError) as e:
+            self.close()
+            raise exc.ConfigException(
+                'Could not read template archive %s. %s' % (path, e))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+    def _add(self, name, mode, reader):
+        name = posixpath.normpath('/' + name).lstrip('/')
+        if name and name != '.':
+            self._members[name] = (mode, reader)
+
+    def _index_zip(self):
+        # ZipFile reads through the file object rather than the map, as
+        # it needs a seekable() which mmap lacks before Python 3.13.
+        self._zip = zipfile.ZipFile(self._file)
+        for info in self._zip.infolist():
+            mode = info.external_attr >> 16
+            # Only a mode with a file type can say it is not a file.
+            if info.is_dir() or (stat.S_IFMT(mode) and
+                                 not stat.S_ISREG(mode)):
+                continue
+            # Archives made without Unix attributes have no mode bits.
+            self._add(info.filename, mode or 0o644,
+                      lambda info=info: self._zip.read(info))
+
+    def _index_tar(self):
+        with tarfile.open(fileobj=self._map, mode='r:*') as tf:
+            compressed = tf.fileobj is not self._map
+            for member in tf:
+                if not member.isreg():
+                    continue
+                if compressed:
+                    # A compressed stream can only be read in order, so
+                    # read everything as it is indexed.
+                    data = tf.extractfile(member).read()
+                    reader = (lambda data=data: data)
+                else:
+                    start, end = (member.offset_data,
+                                  member.offset_data + member.size)
+                    reader = (lambda start=start, end=end:
+                              self._map[start:end])
+                self._add(member.name, member.mode, reader)
+
+    def _name(self, template):
+        prefix = self.root + '/'
+        if template.startswith(prefix):
+            return template[len(prefix):]
+        return template
+
+    def paths(self, only=None, exclude=None):
+        """Return (template, output path) pairs as template_paths does."""
+        only = [p.rstrip('/') or '/*' for p in only or []]
+        exclude = [p.rstrip('/') or '/*' for p in exclude or []]
+        res = []
+        for name in self._members:
+            if name.endswith(CONTROL_FILE_SUFFIX):
+                continue
+            out_path = '/' + name
+            if (only or exclude) and not selected(out_path, only, exclude):
+                continue
+            res.append((self.root + out_path, out_path))
+        return res
+
+    def _data(self, name):
+        return self._members[name][1]()
+
+    def read(self, template):
+        return self._data(self._name(template)).decode('utf-8')
+
+    def control(self, template):
+        name = self._name(template) + CONTROL_FILE_SUFFIX
+        if name not in self._members:
+            return None
+        return self._data(name).decode('utf-8')
+
+    def is_executable(self, template):
+        member = self._members.get(self._name(template))
+        return member is not None and bool(member[0] & 0o111)
+
+    @contextlib.contextmanager
+    def executable(self, template):
+        """Extract template to a private directory while it runs."""
+        try:
+            if self.exec_dir:
+                os.makedirs(self.exec_dir, mode=0o700, exist_ok=True)
+            tmpdir = tempfile.mkdtemp(prefix='os-apply-config-',
+                                      dir=self.exec_dir)
+        except OSError as e:
+            raise exc.ConfigException(
+                'Could not extract executable template %s. %s'
+                % (template, e))
+        try:
+            path = os.path.join(tmpdir, posixpath.basename(template))
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                             os.O_CLOEXEC, 0o700)
+                with open(fd, 'wb') as f:
+                    f.write(self._data(self._name(template)))
+            except OSError as e:
+                raise exc.ConfigException(
+                    'Could not extract executable template %s. %s'
+                    % (template, e))
+            yield path
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def open_templates(root, exec_dir=None):
+    """Return the source of the templates at root.
+
+    root is either a directory or a zip or tar archive, whose executable
+    templates are extracted beneath exec_dir while they run.
+    """
+    if os.path.isfile(root):
+        return ArchiveSource(root, exec_dir)
+    return FileSource(root)
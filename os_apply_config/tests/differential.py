@@ -0,0 +1,681 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Differential testing of the apply paths against a reference.
+
+The reference is the straightforward implementation os-apply-config
+started from: metadata parsed with json.loads and merged by deep copy,
+templates walked, rendered by a plain pystache renderer and written one
+at a time through their full paths.  Random cases -- metadata with
+overlapping keys, templates using variables, sections, inverted
+sections and missing keys, executable templates, and .oac control files
+-- are applied through both the reference and each optimized path, and
+the resulting trees must match byte for byte, along with their modes
+and ownership.
+
+A failing case is shrunk to a minimal one that still fails, and written
+out as a reproducer.
+"""
+
+import collections
+import contextlib
+import copy
+import grp
+import json
+import os
+import pwd
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+import pystache
+from pystache import context
+import yaml
+
+from os_apply_config import apply_config
+from os_apply_config import collect_config
+from os_apply_config import config_exception as exc
+from os_apply_config import oac_file
+
+WORDS = ['a', 'b', 'c', 'host', 'port', 'db', 'nova', 'x-y', 'list', 'ü']
+STRINGS = ['', 'foo', 'bar baz', 'naïve', 'line\nbreak', '{{not}}', '0',
+           'true', '192.0.2.1', 'controller-0.localdomain']
+DIRS = ['', 'etc', 'etc/nova', 'var/lib/x y', 'usr/share/ü']
+MODES = [0o600, 0o640, 0o644, 0o755]
+
+EXECUTABLE = """#!%(python)s
+import hashlib
+import json
+import sys
+data = sys.stdin.buffer.read()
+config = json.loads(data)
+print(hashlib.sha256(data).hexdigest())
+print(json.dumps(config.get(%(key)r), sort_keys=True))
+"""
+
+_mtime = [10 ** 9]
+
+
+# The reference implementation.
+
+class _ReferenceRenderer(pystache.Renderer):
+
+    def __init__(self):
+        super().__init__(escape=lambda u: u, missing_tags='ignore')
+
+    def str_coerce(self, val):
+        if val is None:
+            return b''
+        return json.dumps(val)
+
+
+def _reference_merge(a, b):
+    if not isinstance(b, dict):
+        return b
+    new_dict = copy.deepcopy(a)
+    for k, v in iter(b.items()):
+        if k in new_dict and isinstance(new_dict[k], dict):
+            new_dict[k] = _reference_merge(new_dict[k], v)
+        else:
+            new_dict[k] = copy.deepcopy(v)
+    return new_dict
+
+
+def reference_config(metadata):
+    config = {}
+    for path in metadata:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            conf = json.loads(f.read())
+        if conf and isinstance(conf, dict):
+            config = _reference_merge(config, conf)
+    return config
+
+
+def _reference_render(template, config):
+    if os.path.isfile(template) and os.access(template, os.X_OK):
+        p = subprocess.Popen([template], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate(json.dumps(config).encode('utf-8'))
+        if p.returncode != 0:
+            raise exc.ConfigException('config script failed: %s' % template)
+        return stdout.decode('utf-8')
+    try:
+        with open(template) as f:
+            return _ReferenceRenderer().render(f.read(), config)
+    except context.KeyNotFoundError as e:
+        raise exc.ConfigException('key %s does not exist' % e.key)
+
+
+def _reference_write(path, obj):
+    if not obj.allow_empty and len(obj.body) == 0:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    if os.path.exists(path):
+        st = os.stat(path)
+        mode, uid, gid = st.st_mode, st.st_uid, st.st_gid
+    else:
+        mode, uid, gid = 0o644, -1, -1
+    mode = obj.mode or mode
+    if obj.owner is not None:
+        uid = obj.owner
+    if obj.group is not None:
+        gid = obj.group
+    d = os.path.dirname(path)
+    os.path.exists(d) or os.makedirs(d)
+    with tempfile.NamedTemporaryFile(dir=d, delete=False) as newfile:
+        if isinstance(obj.body, str):
+            obj.body = obj.body.encode('utf-8')
+        newfile.write(obj.body)
+        os.chmod(newfile.name, mode)
+        os.chown(newfile.name, uid, gid)
+        os.rename(newfile.name, path)
+
+
+def reference_apply(metadata, templates, output):
+    """Render and write the templates, a priority at a time."""
+    config = reference_config(metadata)
+    found = []
+    for cur_root, _subdirs, files in os.walk(templates):
+        for f in files:
+            if f.endswith(apply_config.CONTROL_FILE_SUFFIX):
+                continue
+            in_file = os.path.join(cur_root, f)
+            out_file = os.path.join(cur_root[len(templates):] or '/', f)
+            ctrl_dict = {}
+            ctrl_file = in_file + apply_config.CONTROL_FILE_SUFFIX
+            if os.path.isfile(ctrl_file):
+                with open(ctrl_file) as cf:
+                    ctrl_dict = yaml.safe_load(cf.read()) or {}
+            found.append((in_file, out_file, ctrl_dict))
+    for priority in sorted(set(c.get('priority', 0) for _i, _o, c in found),
+                           reverse=True):
+        tree = {}
+        for in_file, out_file, ctrl_dict in found:
+            if ctrl_dict.get('priority', 0) == priority:
+                tree[out_file] = oac_file.OacFile(
+                    _reference_render(in_file, config), **ctrl_dict)
+        for path, obj in tree.items():
+            _reference_write(os.path.join(output, path.lstrip('/')), obj)
+
+
+def reference_key(config, key):
+    for part in key.split('.'):
+        try:
+            config = config[part]
+            if config is None:
+                raise TypeError()
+        except (KeyError, TypeError):
+            try:
+                if isinstance(config, list):
+                    config = config[int(part)]
+                    continue
+            except (IndexError, ValueError):
+                pass
+            return None
+    return config
+
+
+# Random cases.  A case is a JSON document, so that it can be shrunk and
+# written out as a reproducer: a list of steps, each holding the metadata
+# documents and the templates to apply, in order, to the same output.
+
+def _owners():
+    users = [pwd.getpwuid(os.getuid()).pw_name, os.getuid()]
+    groups = [grp.getgrgid(os.getgid()).gr_name, os.getgid()]
+    if os.geteuid() == 0:
+        for name in ('nobody', 'daemon'):
+            try:
+                pwd.getpwnam(name)
+                users.append(name)
+            except KeyError:
+                pass
+    return users, groups
+
+
+def _value(rand, depth):
+    kind = rand.choice(['str', 'str', 'int', 'float', 'bool', 'none',
+                        'list', 'dict', 'dict'][:9 if depth < 3 else 6])
+    if kind == 'str':
+        return rand.choice(STRINGS)
+    if kind == 'int':
+        return rand.randrange(-5, 10 ** 6)
+    if kind == 'float':
+        return rand.choice([0.5, 1e-07, 3.0])
+    if kind == 'bool':
+        return rand.choice([True, False])
+    if kind == 'none':
+        return None
+    if kind == 'list':
+        return [_value(rand, depth + 1) for _ in range(rand.randrange(4))]
+    return _doc(rand, depth + 1)
+
+
+def _doc(rand, depth=0):
+    keys = WORDS + (['dot.key'] if depth else [])
+    return dict((rand.choice(keys), _value(rand, depth))
+                for _ in range(rand.randrange(1, 5)))
+
+
+def _paths(value, prefix=''):
+    """Yield the dotted names which resolve in value."""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if '.' in k:
+                continue
+            yield prefix + k
+            for path in _paths(v, prefix + k + '.'):
+                yield path
+
+
+def _tokens(rand, names):
+    def name():
+        if names and rand.random() < 0.8:
+            return rand.choice(names)
+        return rand.choice(['nope', 'a.nope', 'host.port.db'])
+
+    tokens = []
+    for _ in range(rand.randrange(6)):
+        kind = rand.randrange(8)
+        if kind == 0:
+            tokens.append(rand.choice(STRINGS + [' ', '\n', '= ']))
+        elif kind in (1, 2):
+            tokens.append('{{%s}}' % name())
+        elif kind == 3:
+            tokens.append('{{{%s}}}' % name())
+        elif kind == 4:
+            n = name()
+            inner = rand.choice(['{{.}}', '{{%s}}' % rand.choice(WORDS),
+                                 '[{{.}}]\n', 'x'])
+            tokens.append('{{#%s}}%s{{/%s}}' % (n, inner, n))
+        elif kind == 5:
+            n = name()
+            tokens.append('{{^%s}}none{{/%s}}' % (n, n))
+        elif kind == 6:
+            tokens.append('{{! comment }}')
+        else:
+            tokens.append('%s = {{%s}}\n' % (rand.choice(WORDS), name()))
+    return tokens
+
+
+def _templates(rand, names, executables):
+    users, groups = _owners()
+    templates = []
+    used = set()
+    for i in range(rand.randrange(1, 7)):
+        path = os.path.join(rand.choice(DIRS), 'f%d.conf' % i)
+        if path in used:
+            continue
+        used.add(path)
+        template = {'path': path, 'tokens': _tokens(rand, names),
+                    'executable': executables and rand.random() < 0.15,
+                    'oac': None}
+        if template['executable']:
+            template['key'] = rand.choice(names or ['nope'])
+        if rand.random() < 0.5:
+            oac = {}
+            if rand.random() < 0.6:
+                oac['mode'] = rand.choice(MODES)
+            if rand.random() < 0.3:
+                oac['allow_empty'] = rand.choice([True, False])
+            if rand.random() < 0.3:
+                oac['owner'] = rand.choice(users)
+            if rand.random() < 0.3:
+                oac['group'] = rand.choice(groups)
+            if rand.random() < 0.3:
+                oac['priority'] = rand.choice([-1, 0, 10])
+            template['oac'] = oac
+        templates.append(template)
+    return templates
+
+
+def _step(rand, executables):
+    metadata = [_doc(rand) for _ in range(rand.randrange(1, 4))]
+    if rand.random() < 0.1:
+        metadata.append(rand.choice([[], 'not a dict', None]))
+    names = sorted(set(path for doc in metadata
+                       for path in _paths(doc)))
+    return {'metadata': metadata,
+            'templates': _templates(rand, names, executables)}
+
+
+def _mutate(rand, step, executables):
+    """Return a step changing some of the metadata and templates of step."""
+    new = copy.deepcopy(step)
+    if new['metadata'] and isinstance(new['metadata'][-1], dict):
+        new['metadata'][-1].update(_doc(rand))
+    names = sorted(set(path for doc in new['metadata']
+                       for path in _paths(doc)))
+    for template in new['templates']:
+        if rand.random() < 0.3:
+            template['tokens'] = _tokens(rand, names)
+    if rand.random() < 0.3:
+        new['templates'] += _templates(rand, names, executables)[:1]
+    return new
+
+
+def generate(seed, executables=True):
+    """Return the random case for seed."""
+    rand = random.Random(seed)
+    first = _step(rand, executables)
+    return {'seed': seed,
+            'steps': [first, _mutate(rand, first, executables)]}
+
+
+def materialize(step, root):
+    """Write step under root, returning (metadata paths, template root)."""
+    templates = os.path.join(root, 'templates')
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(templates)
+    metadata = []
+    for i, doc in enumerate(step['metadata']):
+        path = os.path.join(root, 'md%d.json' % i)
+        with open(path, 'w') as f:
+            json.dump(doc, f)
+        # Distinct times old enough for the parse cache to trust.
+        _mtime[0] += 10 ** 9
+        os.utime(path, ns=(_mtime[0], _mtime[0]))
+        metadata.append(path)
+    seen = set()
+    for template in step['templates']:
+        path = os.path.join(templates, template['path'])
+        if path in seen:
+            continue
+        seen.add(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            if template['executable']:
+                f.write(EXECUTABLE % {'python': sys.executable,
+                                      'key': template.get('key')})
+            else:
+                f.write(''.join(template['tokens']))
+        os.chmod(path, 0o755 if template['executable'] else 0o644)
+        if template['oac'] is not None:
+            with open(path + apply_config.CONTROL_FILE_SUFFIX, 'w') as f:
+                f.write(yaml.safe_dump(template['oac']))
+    return metadata, templates
+
+
+def snapshot(root):
+    """Return a comparable description of the tree under root."""
+    tree = {}
+    for cur_root, subdirs, files in os.walk(root):
+        for name in subdirs + files:
+            path = os.path.join(cur_root, name)
+            st = os.lstat(path)
+            rel = os.path.relpath(path, root)
+            if stat.S_ISDIR(st.st_mode):
+                tree[rel] = ('dir', stat.S_IMODE(st.st_mode))
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    tree[rel] = ('file', f.read(), stat.S_IMODE(st.st_mode),
+                                 st.st_uid, st.st_gid)
+            else:
+                tree[rel] = ('other', stat.S_IFMT(st.st_mode))
+    return tree
+
+
+def _diff(expected, actual):
+    if expected == actual:
+        return []
+    if isinstance(expected, str) or isinstance(actual, str):
+        return ['reference: %s, optimized: %s' % (
+            'error' if isinstance(expected, str) else 'ok',
+            actual if isinstance(actual, str) else 'ok')]
+    diffs = []
+    for path in sorted(set(expected) | set(actual)):
+        if path not in actual:
+            diffs.append('%s: missing' % path)
+        elif path not in expected:
+            diffs.append('%s: unexpected' % path)
+        elif expected[path] != actual[path]:
+            diffs.append('%s: expected %r, got %r' % (
+                path, expected[path], actual[path]))
+    return diffs
+
+
+def _run(fn, output):
+    """Return the snapshot of output after fn, or a string for an error."""
+    try:
+        fn()
+    except exc.ConfigException:
+        return 'error'
+    return snapshot(output)
+
+
+# The paths under test.  Each takes a case and a work directory, and
+# returns a list of the differences between it and the reference.
+
+def _install(metadata, templates, output, state_dir=None, write_workers=1):
+    apply_config.install_config(metadata, templates, output, False,
+                                state_dir=state_dir,
+                                write_workers=write_workers)
+
+
+def check_install(case, work):
+    metadata, templates = materialize(case['steps'][0],
+                                      os.path.join(work, 'case'))
+    ref = os.path.join(work, 'ref')
+    opt = os.path.join(work, 'opt')
+    return _diff(_run(lambda: reference_apply(metadata, templates, ref), ref),
+                 _run(lambda: _install(metadata, templates, opt), opt))
+
+
+def check_pools(case, work):
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(collect_config,
+                                              'READ_THRESHOLD', 0))
+        stack.enter_context(mock.patch.object(collect_config,
+                                              'PARSE_THRESHOLD', 2))
+        stack.enter_context(mock.patch('os.cpu_count', return_value=4))
+        return check_install(case, work)
+
+
+def check_workers(case, work):
+    """Write the outputs from a pool of threads."""
+    metadata, templates = materialize(case['steps'][0],
+                                      os.path.join(work, 'case'))
+    ref = os.path.join(work, 'ref')
+    opt = os.path.join(work, 'opt')
+    return _diff(_run(lambda: reference_apply(metadata, templates, ref), ref),
+                 _run(lambda: _install(metadata, templates, opt,
+                                       write_workers=4), opt))
+
+
+def check_archive(case, work):
+    """Read the templates from zip and tar archives of the tree."""
+    metadata, templates = materialize(case['steps'][0],
+                                      os.path.join(work, 'case'))
+    ref = os.path.join(work, 'ref')
+    expected = _run(lambda: reference_apply(metadata, templates, ref), ref)
+    diffs = []
+    for fmt in ('zip', 'tar', 'gztar'):
+        archive = shutil.make_archive(os.path.join(work, 'templates'), fmt,
+                                      templates)
+        opt = os.path.join(work, 'opt-' + fmt)
+        diffs += ['%s: %s' % (fmt, d) for d in _diff(
+            expected, _run(lambda: _install(metadata, archive, opt), opt))]
+    return diffs
+
+
+def check_incremental(case, work):
+    """Apply each step in turn to one output, with a state directory."""
+    ref = os.path.join(work, 'ref')
+    opt = os.path.join(work, 'opt')
+    state_dir = os.path.join(work, 'state')
+    diffs = []
+    for i, step in enumerate(case['steps']):
+        metadata, templates = materialize(step, os.path.join(work, 'case'))
+        expected = _run(lambda: reference_apply(metadata, templates, ref),
+                        ref)
+        for attempt in ('apply', 'unchanged'):
+            actual = _run(
+                lambda: _install(metadata, templates, opt, state_dir), opt)
+            diffs += ['step %d %s: %s' % (i, attempt, d)
+                      for d in _diff(expected, actual)]
+        if isinstance(expected, str):
+            break
+    return diffs
+
+
+def check_repair(case, work):
+    """Tamper with every output of an apply, then repair them."""
+    metadata, templates = materialize(case['steps'][0],
+                                      os.path.join(work, 'case'))
+    ref = os.path.join(work, 'ref')
+    opt = os.path.join(work, 'opt')
+    state_dir = os.path.join(work, 'state')
+    expected = _run(lambda: reference_apply(metadata, templates, ref), ref)
+    if isinstance(expected, str):
+        return []
+    _install(metadata, templates, opt, state_dir)
+    files = sorted(p for p, v in snapshot(opt).items() if v[0] == 'file')
+    for i, rel in enumerate(files):
+        path = os.path.join(opt, rel)
+        action = i % 4
+        if action == 0:
+            with open(path, 'a') as f:
+                f.write('edited by hand\n')
+        elif action == 1:
+            os.chmod(path, 0o666)
+        elif action == 2:
+            os.unlink(path)
+    actual = _run(lambda: apply_config.verify_outputs(state_dir, True), opt)
+    return _diff(expected, actual)
+
+
+def check_key(case, work):
+    """Look every name up through the key index and by walking."""
+    metadata, _templates = materialize(case['steps'][0],
+                                       os.path.join(work, 'case'))
+    config = reference_config(metadata)
+    state_dir = os.path.join(work, 'state')
+    names = sorted(set(_paths(config))) + ['nope', 'a.0', 'list.0', 'list.-1',
+                                           'list.01', 'dot.key']
+    diffs = []
+    for attempt in ('build', 'indexed'):
+        for name in names:
+            expected = reference_key(config, name)
+            actual = apply_config._extract_key(metadata, name,
+                                               state_dir=state_dir)
+            if expected != actual or type(expected) is not type(actual):
+                diffs.append('%s %s: expected %r, got %r' % (
+                    attempt, name, expected, actual))
+    return diffs
+
+
+VARIANTS = collections.OrderedDict([
+    ('install', check_install),
+    ('pools', check_pools),
+    ('workers', check_workers),
+    ('archive', check_archive),
+    ('incremental', check_incremental),
+    ('repair', check_repair),
+    ('key', check_key),
+])
+
+
+def check(case, variant):
+    """Return the differences variant shows for case."""
+    work = tempfile.mkdtemp(prefix='oac-difftest-')
+    try:
+        return VARIANTS[variant](case, work)
+    finally:
+        shutil.rmtree(work)
+
+
+# Shrinking.
+
+def _candidates(case):
+    """Yield cases each a little smaller than case."""
+    steps = case['steps']
+    for i in range(len(steps)):
+        if len(steps) > 1:
+            yield dict(case, steps=steps[:i] + steps[i + 1:])
+    for i, step in enumerate(steps):
+        def with_step(new, i=i):
+            return dict(case, steps=steps[:i] + [new] + steps[i + 1:])
+        for j in range(len(step['templates'])):
+            yield with_step(dict(step, templates=(
+                step['templates'][:j] + step['templates'][j + 1:])))
+        for j in range(len(step['metadata'])):
+            yield with_step(dict(step, metadata=(
+                step['metadata'][:j] + step['metadata'][j + 1:])))
+        for j, template in enumerate(step['templates']):
+            def with_template(new, j=j):
+                return with_step(dict(step, templates=(
+                    step['templates'][:j] + [new] +
+                    step['templates'][j + 1:])))
+            if template['oac'] is not None:
+                yield with_template(dict(template, oac=None))
+                for key in template['oac']:
+                    oac = dict(template['oac'])
+                    del oac[key]
+                    yield with_template(dict(template, oac=oac))
+            if template['executable']:
+                yield with_template(dict(template, executable=False))
+            for k in range(len(template['tokens'])):
+                yield with_template(dict(template, tokens=(
+                    template['tokens'][:k] + template['tokens'][k + 1:])))
+        for j, doc in enumerate(step['metadata']):
+            for smaller in _smaller_values(doc):
+                yield with_step(dict(step, metadata=(
+                    step['metadata'][:j] + [smaller] +
+                    step['metadata'][j + 1:])))
+
+
+def _smaller_values(value):
+    if isinstance(value, dict):
+        for k in value:
+            yield dict((k2, v) for k2, v in value.items() if k2 != k)
+        for k, v in value.items():
+            for smaller in _smaller_values(v):
+                yield dict(value, **{k: smaller})
+    elif isinstance(value, list):
+        for i in range(len(value)):
+            yield value[:i] + value[i + 1:]
+        for i, v in enumerate(value):
+            for smaller in _smaller_values(v):
+                yield value[:i] + [smaller] + value[i + 1:]
+
+
+def minimize(case, fails, limit=2000):
+    """Return the smallest case found for which fails(case) holds."""
+    attempts = 0
+    progress = True
+    while progress and attempts < limit:
+        progress = False
+        for candidate in _candidates(case):
+            attempts += 1
+            if fails(candidate):
+                case = candidate
+                progress = True
+                break
+            if attempts >= limit:
+                break
+    return case
+
+
+class Mismatch(Exception):
+    """An optimized path differs from the reference."""
+
+    def __init__(self, variant, case, diffs, reproducer=None):
+        self.variant = variant
+        self.case = case
+        self.diffs = diffs
+        self.reproducer = reproducer
+        message = '%s differs from the reference for seed %s:\n  %s' % (
+            variant, case.get('seed'), '\n  '.join(diffs[:20]))
+        if reproducer:
+            message += ('\nminimized reproducer: %s (replay with'
+                        ' tools/difftest.py --replay %s --variant %s)' % (
+                            reproducer, reproducer, variant))
+        super().__init__(message)
+
+
+def write_reproducer(case, directory):
+    """Write case, and each of its steps as files, under directory."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'case.json')
+    with open(path, 'w') as f:
+        json.dump(case, f, indent=2, sort_keys=True)
+    for i, step in enumerate(case['steps']):
+        materialize(step, os.path.join(directory, 'step%d' % i))
+    return path
+
+
+def run(case, variants=None, reproducer_dir=None):
+    """Check case against each variant, raising Mismatch on a difference.
+
+    The case is minimized first, and written under reproducer_dir if
+    given.
+    """
+    for variant in variants or VARIANTS:
+        diffs = check(case, variant)
+        if not diffs:
+            continue
+        small = minimize(case, lambda c: bool(check(c, variant)))
+        path = None
+        if reproducer_dir:
+            path = write_reproducer(
+                small, os.path.join(reproducer_dir, '%s-%s' % (
+                    variant, case.get('seed'))))
+        raise Mismatch(variant, small, check(small, variant) or diffs, path)
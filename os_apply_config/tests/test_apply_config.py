@@ -16,15 +16,23 @@
 import atexit
 import json
 import os
+import pwd
 import tempfile
+import threading
+import time
 from unittest import mock
 
 import fixtures
 import testtools
 
 from os_apply_config import apply_config
+from os_apply_config import collect_config
 from os_apply_config import config_exception as exc
+from os_apply_config import key_index
+from os_apply_config import metrics
 from os_apply_config import oac_file
+from os_apply_config import report
+from os_apply_config import state
 
 # example template tree
 TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
@@ -193,6 +201,22 @@ class TestRunOSConfigApplier(testtools.TestCase):
             self.stdout.read().strip(), apply_config.TEMPLATES_DIR)
         self.assertEqual('', self.logger.output)
 
+    def test_print_key_state_dir(self):
+        state_dir = tempfile.mkdtemp()
+        for _ in range(2):
+            self.stdout.seek(0)
+            self.stdout.truncate()
+            self.assertEqual(0, apply_config.main(
+                ['os-apply-config.py', '--metadata', self.path, '--key',
+                 'database.url', '--type', 'raw', '--state-dir', state_dir]))
+            self.stdout.seek(0)
+            self.assertEqual(CONFIG['database']['url'],
+                             self.stdout.read().strip())
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config.py', '--metadata', self.path, '--key',
+             'does.not.exist', '--state-dir', state_dir]))
+        self.assertIn('does not exist', self.logger.output)
+
     def test_boolean_key(self):
         rcode = apply_config.main(['os-apply-config', '--metadata',
                                    self.path, '--boolean-key', 'btrue'])
@@ -213,6 +237,220 @@ class TestRunOSConfigApplier(testtools.TestCase):
         self.assertEqual(self.stdout.read().strip(), 'foo')
         self.assertIn('--boolean-key ignored', self.logger.output)
 
+    def test_schema(self):
+        fd, schema_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as t:
+            t.write('database.url: dsn\nl.*: int\n')
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path,
+             '--schema', schema_path]))
+        self.assertEqual('', self.logger.output)
+
+    def test_schema_violations(self):
+        fd, schema_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as t:
+            t.write('x: int\nl.*: netdevice\nmissing: raw\n')
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path,
+             '--schema', schema_path]))
+        self.assertIn("value 'foo' of key x as type int", self.logger.output)
+        self.assertIn('key missing does not exist', self.logger.output)
+        self.assertIn('2 violation(s)', self.logger.output)
+
+    def test_print_fingerprint(self):
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--print-fingerprint']))
+        self.stdout.seek(0)
+        first = self.stdout.read().strip()
+        self.assertEqual(64, len(first))
+        with open(self.path, 'w') as t:
+            t.write(json.dumps({'x': 'bar'}))
+        self.stdout.seek(0)
+        self.stdout.truncate()
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--print-fingerprint']))
+        self.stdout.seek(0)
+        self.assertNotEqual(first, self.stdout.read().strip())
+
+    def test_metrics_file(self):
+        tmpdir = tempfile.mkdtemp()
+        metrics_file = os.path.join(tmpdir, 'oac.prom')
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--metrics-file', metrics_file]))
+        with open(metrics_file) as f:
+            lines = f.read().splitlines()
+        self.assertIn('os_apply_config_templates_rendered 5', lines)
+        self.assertIn('os_apply_config_files_written 4', lines)
+        self.assertIn('os_apply_config_files_skipped 1', lines)
+        self.assertIn('os_apply_config_executable_templates 1', lines)
+        self.assertIn('os_apply_config_last_run_success 1', lines)
+        self.assertTrue([line for line in lines if line.startswith(
+            'os_apply_config_phase_duration_seconds{phase="render"} ')])
+        self.assertTrue([line for line in lines if line.startswith(
+            'os_apply_config_last_success_timestamp_seconds ')])
+
+    def test_metrics_file_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        metrics_file = os.path.join(tmpdir, 'oac.prom')
+        with open(self.path, 'w') as t:
+            t.write('{')
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--metrics-file', metrics_file]))
+        with open(metrics_file) as f:
+            lines = f.read().splitlines()
+        self.assertIn('os_apply_config_last_run_success 0', lines)
+
+    def test_report(self):
+        tmpdir = tempfile.mkdtemp()
+        report_file = os.path.join(tempfile.mkdtemp(), 'report.json')
+        argv = ['os-apply-config', '--metadata', self.path, '--templates',
+                TEMPLATES, '--output', tmpdir, '--report', report_file]
+        self.assertEqual(0, apply_config.main(argv))
+        with open(report_file) as f:
+            changes = json.load(f)
+        self.assertEqual(
+            sorted(os.path.join(tmpdir, p[1:]) for p, obj in OUTPUT.items()
+                   if obj.allow_empty),
+            sorted(changes['created']))
+        self.assertEqual([], changes['modified'])
+
+        keystone = os.path.join(tmpdir, 'etc/keystone/keystone.conf')
+        with open(keystone, 'w') as f:
+            f.write('edited by hand\n')
+        self.assertEqual(0, apply_config.main(argv))
+        with open(report_file) as f:
+            changes = json.load(f)
+        self.assertEqual({'success': True, 'created': [],
+                          'modified': [keystone], 'deleted': []}, changes)
+
+    def test_verify_repair(self):
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        report_file = os.path.join(tempfile.mkdtemp(), 'report.json')
+        argv = ['os-apply-config', '--metadata', self.path, '--templates',
+                TEMPLATES, '--output', tmpdir, '--state-dir', state_dir]
+        self.assertEqual(0, apply_config.main(argv))
+        self.assertEqual(0, apply_config.main(argv + ['--verify']))
+
+        keystone = os.path.join(tmpdir, 'etc/keystone/keystone.conf')
+        with open(keystone, 'w') as f:
+            f.write('edited by hand\n')
+        with mock.patch.object(apply_config, 'build_tree') as build_tree:
+            self.assertEqual(1, apply_config.main(
+                argv + ['--verify', '--report', report_file]))
+            self.assertIn('%s has drifted: content' % keystone,
+                          self.logger.output)
+            with open(report_file) as f:
+                self.assertEqual({keystone: ['content']},
+                                 json.load(f)['drift'])
+            self.assertEqual(0, apply_config.main(
+                argv + ['--repair', '--report', report_file]))
+            self.assertFalse(build_tree.called)
+        with open(report_file) as f:
+            self.assertEqual([keystone], json.load(f)['modified'])
+        self.assertEqual(OUTPUT['/etc/keystone/keystone.conf'].body,
+                         open(keystone).read())
+        self.assertEqual(0, apply_config.main(argv + ['--verify']))
+
+    def test_verify_requires_state_dir(self):
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--verify']))
+        self.assertIn('require --state-dir', self.logger.output)
+
+    def test_coalesce(self):
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        argv = ['os-apply-config', '--metadata', self.path, '--templates',
+                TEMPLATES, '--output', tmpdir, '--state-dir', state_dir,
+                '--coalesce']
+        self.assertEqual(0, apply_config.main(argv))
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(dict(CONFIG, x='bar')))
+        results = []
+        with mock.patch.object(apply_config, 'build_tree',
+                               wraps=apply_config.build_tree) as build_tree:
+            with state.locked(state_dir):
+                threads = [threading.Thread(
+                    target=lambda: results.append(apply_config.main(argv)))
+                    for _ in range(3)]
+                for t in threads:
+                    t.start()
+                time.sleep(0.1)
+                self.assertEqual([], results)
+            for t in threads:
+                t.join()
+            self.assertEqual(1, build_tree.call_count)
+        self.assertEqual([0, 0, 0], results)
+        self.assertIn('waiting for another run', self.logger.output)
+        self.assertEqual('bar\n', open(
+            os.path.join(tmpdir, 'etc/glance/script.conf')).read())
+
+    def test_metadata_directory_with_state_dir(self):
+        metadata = tempfile.mkdtemp()
+        for extra in ([], ['--key', 'x']):
+            self.assertEqual(1, apply_config.main(
+                ['os-apply-config', '--metadata', metadata, '--templates',
+                 TEMPLATES, '--output', tempfile.mkdtemp(), '--state-dir',
+                 tempfile.mkdtemp()] + extra))
+            self.assertIn('Could not open %s for reading' % metadata,
+                          self.logger.output)
+
+    def test_coalesce_requires_state_dir(self):
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--coalesce']))
+        self.assertIn('--coalesce requires --state-dir', self.logger.output)
+
+    def test_write_workers(self):
+        tmpdir = tempfile.mkdtemp()
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--write-workers', '4']))
+        for path, obj in OUTPUT.items():
+            full_path = os.path.join(tmpdir, path[1:])
+            if obj.allow_empty:
+                self.assertEqual(obj.body, open(full_path).read())
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--write-workers', '0']))
+        self.assertIn('--write-workers must be at least 1',
+                      self.logger.output)
+
+    def test_report_fd_lines(self):
+        tmpdir = tempfile.mkdtemp()
+        fd, report_file = tempfile.mkstemp()
+        self.addCleanup(os.close, fd)
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--only', '/etc/glance',
+             '--report-fd', str(fd), '--report-format', 'lines']))
+        with open(report_file) as f:
+            self.assertEqual(os.path.join(tmpdir, 'etc/glance/script.conf'),
+                             f.read().strip())
+
+    def test_memory_report(self):
+        tmpdir = tempfile.mkdtemp()
+        report_file = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.assertEqual(0, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tmpdir, '--report', report_file,
+             '--memory-report']))
+        with open(report_file) as f:
+            memory = json.load(f)['memory']
+        self.assertEqual(['merge', 'parse', 'render', 'write'],
+                         sorted(memory['phases']))
+
+    def test_memory_report_needs_report(self):
+        self.assertEqual(1, apply_config.main(
+            ['os-apply-config', '--metadata', self.path, '--templates',
+             TEMPLATES, '--output', tempfile.mkdtemp(), '--memory-report']))
+        self.assertIn('--memory-report requires', self.logger.output)
+
     def test_os_config_files(self):
         with tempfile.NamedTemporaryFile() as fake_os_config_files:
             with tempfile.NamedTemporaryFile() as fake_config:
@@ -268,6 +506,237 @@ class OSConfigApplierTestCase(testtools.TestCase):
         for path, obj in OUTPUT.items():
             self.check_output_file(tmpdir, path, obj)
 
+    def test_install_config_unchanged(self):
+        path = self.write_config(CONFIG)
+        os.utime(path, ns=(10 ** 9, 10 ** 9))
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        self.assertTrue(os.path.exists(
+            os.path.join(state_dir, key_index.INDEX_FILE)))
+        with mock.patch.object(apply_config, 'build_tree') as build_tree:
+            apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                        state_dir=state_dir)
+            self.assertFalse(build_tree.called)
+        self.assertIn('nothing to do', self.logger.output)
+
+    def test_install_config_output_drift(self):
+        path = self.write_config(CONFIG)
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        target_file = os.path.join(tmpdir, 'etc/keystone/keystone.conf')
+        with open(target_file, 'w') as f:
+            f.write('edited by hand\n')
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        for path, obj in OUTPUT.items():
+            self.check_output_file(tmpdir, path, obj)
+
+    def test_install_config_symlinked_template_edited(self):
+        path = self.write_config(CONFIG)
+        root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(root, 'templates', 'etc'))
+        real = os.path.join(root, 'real.conf')
+        with open(real, 'w') as f:
+            f.write('{{x}}')
+        templates = os.path.join(root, 'templates')
+        os.symlink(real, os.path.join(templates, 'etc', 'foo.conf'))
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    state_dir=state_dir)
+        with open(real, 'w') as f:
+            f.write('{{x}} edited')
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    state_dir=state_dir)
+        self.assertEqual('foo edited', open(
+            os.path.join(tmpdir, 'etc', 'foo.conf')).read())
+
+    def test_install_config_metadata_changed(self):
+        path = self.write_config(CONFIG)
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        with open(path, 'w') as f:
+            f.write(json.dumps(dict(CONFIG, x='bar')))
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        target_file = os.path.join(tmpdir, 'etc/glance/script.conf')
+        self.assertEqual('bar\n', open(target_file).read())
+
+    def test_install_config_parse_cache(self):
+        self.useFixture(fixtures.MockPatchObject(
+            collect_config.ParseCache, '_memory', {}))
+        base = self.write_config(CONFIG)
+        path = self.write_config({'x': 'foo'})
+        for p in (base, path):
+            os.utime(p, ns=(10 ** 9, 10 ** 9))
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([base, path], TEMPLATES, tmpdir, False,
+                                    state_dir=state_dir)
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(state_dir, collect_config.CACHE_DIR))))
+        collect_config.ParseCache._memory.clear()
+        with open(path, 'w') as f:
+            f.write(json.dumps({'x': 'bar'}))
+        os.utime(path, ns=(2 * 10 ** 9, 2 * 10 ** 9))
+        with mock.patch.object(collect_config, '_parse',
+                               wraps=collect_config._parse) as parse:
+            apply_config.install_config([base, path], TEMPLATES, tmpdir,
+                                        False, state_dir=state_dir)
+        self.assertEqual([path], [c[0][1] for c in parse.call_args_list])
+        target_file = os.path.join(tmpdir, 'etc/glance/script.conf')
+        self.assertEqual('bar\n', open(target_file).read())
+
+    def test_install_config_counts_skipped_operations(self):
+        self.addCleanup(os.umask, os.umask(0o022))
+        path = self.write_config(CONFIG)
+        templates = tempfile.mkdtemp()
+        for name in ('a', 'b'):
+            with open(os.path.join(templates, name), 'w') as f:
+                f.write('{{x}}')
+            with open(os.path.join(templates, name + '.oac'), 'w') as f:
+                f.write('mode: 0644\nowner: %s\n'
+                        % pwd.getpwuid(os.geteuid())[0])
+        tmpdir = tempfile.mkdtemp()
+        stats = metrics.RunStats()
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    stats=stats)
+        self.assertEqual(2, stats.counters['chmods_skipped'])
+        self.assertEqual(2, stats.counters['chowns_skipped'])
+        self.assertEqual(1, stats.counters['name_lookups_cached'])
+        stats = metrics.RunStats()
+        os.chmod(os.path.join(tmpdir, 'a'), 0o600)
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    stats=stats)
+        self.assertEqual(1, stats.counters['metadata_updates'])
+        self.assertEqual(1, stats.counters['files_skipped'])
+        self.assertEqual(0o100644, os.stat(os.path.join(tmpdir, 'a')).st_mode)
+
+    def write_templates(self, templates):
+        root = tempfile.mkdtemp()
+        for name, (body, ctrl) in templates.items():
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(body)
+            if body.startswith('#!'):
+                os.chmod(os.path.join(root, name), 0o755)
+            if ctrl:
+                with open(os.path.join(root, name + '.oac'), 'w') as f:
+                    f.write(ctrl)
+        return root
+
+    def test_priority_groups(self):
+        templates = [('/t/%s' % n, '/%s' % n) for n in 'abcde']
+        controls = dict((t, oac_file.OacFile('', priority=p)) for t, p in
+                        zip((t for t, _ in templates), [0, 10, -1, 10, 0]))
+        self.assertEqual(
+            [[('/t/b', '/b'), ('/t/d', '/d')],
+             [('/t/a', '/a'), ('/t/e', '/e')],
+             [('/t/c', '/c')]],
+            apply_config.priority_groups(templates, controls))
+
+    def test_install_config_priority(self):
+        path = self.write_config(CONFIG)
+        templates = self.write_templates({
+            'network': ('{{x}}', 'priority: 10'),
+            'db': ('{{x}}', 'priority: 5'),
+            'other': ('{{x}}', None),
+        })
+        tmpdir = tempfile.mkdtemp()
+        stats = metrics.RunStats()
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    stats=stats)
+        self.assertEqual([10, 5, 0], list(stats.priorities))
+        times = list(stats.priorities.values())
+        self.assertEqual(sorted(times), times)
+        self.assertEqual({'10', '5', '0'},
+                         set(report.build(stats)['priorities']))
+
+    def test_install_config_priority_memory(self):
+        path = self.write_config(CONFIG)
+        templates = self.write_templates({
+            'big': ('def render(config):\n'
+                    '    data = bytearray(16 * 1024 * 1024)\n'
+                    '    return str(len(data))\n',
+                    'priority: 10\nplugin: true'),
+            'small': ('{{x}}', None),
+        })
+        stats = metrics.RunStats(memory=True)
+        with stats.run():
+            apply_config.install_config([path], templates,
+                                        tempfile.mkdtemp(), False,
+                                        stats=stats)
+        render = stats.memory.summary()['phases']['render']
+        self.assertGreaterEqual(render['peak_bytes'], 16 * 1024 * 1024)
+        self.assertLess(render['retained_bytes'], 16 * 1024 * 1024)
+
+    def test_install_config_priority_written_first(self):
+        path = self.write_config(CONFIG)
+        templates = self.write_templates({
+            'network': ('{{x}}', 'priority: 10'),
+            'broken': ('#!/bin/sh\nexit 1\n', None),
+        })
+        tmpdir = tempfile.mkdtemp()
+        self.assertRaises(exc.ConfigException, apply_config.install_config,
+                          [path], templates, tmpdir, False)
+        self.assertEqual('foo', open(os.path.join(tmpdir, 'network')).read())
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, 'broken')))
+
+    def test_install_config_partials(self):
+        path = self.write_config({'db': {'user': 'nova', 'host': 'db1'}})
+        root = tempfile.mkdtemp()
+        templates = os.path.join(root, 'templates')
+        os.makedirs(os.path.join(templates, 'etc'))
+        os.makedirs(os.path.join(root, 'partials'))
+        for name in ['a.conf', 'b.conf']:
+            with open(os.path.join(templates, 'etc', name), 'w') as t:
+                t.write('[database]\n{{#db}}{{> dsn}}{{/db}}\n')
+        dsn = os.path.join(root, 'partials', 'dsn')
+        with open(dsn, 'w') as p:
+            p.write('connection = mysql://{{user}}@{{host}}')
+        tmpdir = tempfile.mkdtemp()
+        state_dir = tempfile.mkdtemp()
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    state_dir=state_dir)
+        for name in ['a.conf', 'b.conf']:
+            self.assertEqual(
+                '[database]\nconnection = mysql://nova@db1\n',
+                open(os.path.join(tmpdir, 'etc', name)).read())
+
+        # a changed partial is picked up even though nothing else changed
+        with open(dsn, 'w') as p:
+            p.write('connection = mysql+pymysql://{{user}}@{{host}}')
+        apply_config.install_config([path], templates, tmpdir, False,
+                                    state_dir=state_dir)
+        self.assertEqual(
+            '[database]\nconnection = mysql+pymysql://nova@db1\n',
+            open(os.path.join(tmpdir, 'etc', 'a.conf')).read())
+
+    def test_write_file_unchanged(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'etc', 'foo')
+        obj = oac_file.OacFile('foo\n')
+        self.assertEqual('created', apply_config.write_file(path, obj))
+        inode = os.stat(path).st_ino
+        self.assertEqual('unchanged', apply_config.write_file(
+            path, oac_file.OacFile('foo\n')))
+        self.assertEqual(inode, os.stat(path).st_ino)
+        self.assertEqual('modified', apply_config.write_file(
+            path, oac_file.OacFile('foo\n').set('mode', 0o600)))
+        self.assertEqual(0o100600, os.stat(path).st_mode)
+        self.assertEqual('modified', apply_config.write_file(
+            path, oac_file.OacFile('bar\n')))
+        self.assertEqual('bar\n', open(path).read())
+        self.assertEqual('deleted', apply_config.write_file(
+            path, oac_file.OacFile('').set('allow_empty', False)))
+        self.assertEqual('skipped', apply_config.write_file(
+            path, oac_file.OacFile('').set('allow_empty', False)))
+
     def test_delete_if_not_allowed_empty(self):
         path = self.write_config(CONFIG)
         tmpdir = tempfile.mkdtemp()
@@ -311,6 +780,15 @@ class OSConfigApplierTestCase(testtools.TestCase):
             apply_config.render_template,
             template("/etc/glance/script.conf"), {})
 
+    def test_render_executable_not_started(self):
+        path = template("/etc/glance/script.conf")
+        with mock.patch('subprocess.Popen',
+                        side_effect=PermissionError(13, 'Permission denied')):
+            e = self.assertRaises(exc.ConfigException,
+                                  apply_config.render_executable, path, {})
+        self.assertEqual('config script failed: %s could not be started.'
+                         ' [Errno 13] Permission denied' % path, str(e))
+
     def test_render_template_bad_template(self):
         tdir = self.useFixture(fixtures.TempDir())
         bt_path = os.path.join(tdir.path, 'bad_template')
@@ -328,6 +806,11 @@ class OSConfigApplierTestCase(testtools.TestCase):
             "ab123cd",
             apply_config.render_moustache("ab{{x.a}}cd", {"x": {"a": "123"}}))
 
+    def test_default_partials_dir(self):
+        self.assertEqual('/usr/libexec/os-apply-config/partials',
+                         apply_config.default_partials_dir(
+                             '/usr/libexec/os-apply-config/templates/'))
+
     def test_render_moustache_bad_key(self):
         self.assertEqual('', apply_config.render_moustache("{{badkey}}", {}))
 
@@ -347,6 +830,69 @@ class OSConfigApplierTestCase(testtools.TestCase):
             apply_config.render_executable,
             template("/etc/glance/script.conf"), {})
 
+    def test_project_keys(self):
+        config = {'a': {'b': 1, 'c': {'d': 2}, 'e': 3}, 'l': [1, 2], 'f': 4}
+        self.assertEqual({'a': {'b': 1, 'c': {'d': 2}}, 'l': [1, 2]},
+                         apply_config.project_keys(
+                             config, ['a.b', 'a.c.d', 'l', 'missing',
+                                      'a.missing', 'l.0', 'f.g']))
+        self.assertEqual({'a': config['a']},
+                         apply_config.project_keys(config, ['a', 'a.b']))
+        self.assertEqual({'a': config['a']},
+                         apply_config.project_keys(config, ['a.b', 'a']))
+        self.assertEqual({'a': {'b': 1, 'c': {'d': 2}, 'e': 3}, 'l': [1, 2],
+                          'f': 4}, config)
+
+    def test_project_keys_list_index(self):
+        config = {'hosts': ['a', 'b'], 'x': {'s': [{'ip': 1}, {'ip': 2}]},
+                  'y': 1}
+        for keys, expected in [
+                (['hosts.0'], {'hosts': ['a', 'b']}),
+                (['hosts.-1'], {'hosts': ['a', 'b']}),
+                (['hosts.2', 'hosts.a'], {}),
+                (['x.s.1.ip'], {'x': {'s': config['x']['s']}}),
+                (['x.s.0', 'x.s.1'], {'x': {'s': config['x']['s']}})]:
+            self.assertEqual(expected,
+                             apply_config.project_keys(config, keys), keys)
+        self.assertEqual(apply_config._walk_key(config, 'x.s.1.ip'),
+                         apply_config._walk_key(apply_config.project_keys(
+                             config, ['x.s.1.ip']), 'x.s.1.ip'))
+
+    def test_build_tree_input_keys(self):
+        tdir = self.useFixture(fixtures.TempDir()).path
+        script = os.path.join(tdir, 'echo')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncat\n')
+        os.chmod(script, 0o755)
+        with open(os.path.join(tdir, 'moustache'), 'w') as f:
+            f.write('{{x}}')
+        config = {'x': 'foo', 'database': {'url': 'sqlite://', 'pw': 'p'}}
+        for ctrl, expected in [
+                ('', config),
+                ('input_keys: [database.url]', {'database': {'url':
+                                                             'sqlite://'}}),
+                ('input_subhash: database', config['database']),
+                ('input_subhash: database\ninput_keys: pw', {'pw': 'p'}),
+                ('input_keys: []', {})]:
+            for name in ('echo', 'moustache'):
+                with open(os.path.join(tdir, name + '.oac'), 'w') as f:
+                    f.write(ctrl)
+            tree = apply_config.build_tree(
+                apply_config.template_paths(tdir), config)
+            self.assertEqual(expected, json.loads(tree['echo'].body))
+            self.assertEqual('foo', tree['moustache'].body)
+
+    def test_build_tree_input_subhash_missing(self):
+        tdir = self.useFixture(fixtures.TempDir()).path
+        script = os.path.join(tdir, 'echo')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncat\n')
+        os.chmod(script, 0o755)
+        with open(script + '.oac', 'w') as f:
+            f.write('input_subhash: x')
+        self.assertRaises(exc.ConfigException, apply_config.build_tree,
+                          apply_config.template_paths(tdir), {'x': 'foo'})
+
     def test_template_paths(self):
         expected = list(map(lambda p: (template(p), p), TEMPLATE_PATHS))
         actual = apply_config.template_paths(TEMPLATES)
@@ -354,6 +900,51 @@ class OSConfigApplierTestCase(testtools.TestCase):
         actual.sort(key=lambda tup: tup[1])
         self.assertEqual(expected, actual)
 
+    def selected(self, only=None, exclude=None):
+        return sorted(out for _, out in apply_config.template_paths(
+            TEMPLATES, only, exclude))
+
+    def test_template_paths_only(self):
+        self.assertEqual(['/etc/control/allow_empty', '/etc/control/empty',
+                          '/etc/control/mode'],
+                         self.selected(only=['/etc/control']))
+        self.assertEqual(['/etc/control/mode', '/etc/keystone/keystone.conf'],
+                         self.selected(only=['/etc/*/mode', '/etc/keystone/']))
+        self.assertEqual(['/etc/glance/script.conf',
+                          '/etc/keystone/keystone.conf'],
+                         self.selected(only=['*.conf']))
+        self.assertEqual([], self.selected(only=['/usr/*']))
+        self.assertEqual(sorted(TEMPLATE_PATHS), self.selected(only=['/']))
+
+    def test_template_paths_exclude(self):
+        self.assertEqual(['/etc/glance/script.conf',
+                          '/etc/keystone/keystone.conf'],
+                         self.selected(exclude=['/etc/control']))
+        self.assertEqual(['/etc/control/mode'],
+                         self.selected(only=['/etc/control/*'],
+                                       exclude=['*empty']))
+
+    def test_template_paths_prunes(self):
+        walked = []
+        real_walk = os.walk
+
+        def walk(root):
+            for cur_root, subdirs, files in real_walk(root):
+                walked.append(cur_root)
+                yield cur_root, subdirs, files
+        with mock.patch('os.walk', walk):
+            self.selected(only=['/etc/glance/*'], exclude=['/etc/control'])
+        self.assertEqual(
+            [TEMPLATES, os.path.join(TEMPLATES, 'etc'),
+             os.path.join(TEMPLATES, 'etc', 'glance')], walked)
+
+    def test_install_config_only(self):
+        path = self.write_config(CONFIG)
+        tmpdir = tempfile.mkdtemp()
+        apply_config.install_config([path], TEMPLATES, tmpdir, False,
+                                    only=['/etc/keystone/*'])
+        self.assertEqual(['keystone'], os.listdir(os.path.join(tmpdir, 'etc')))
+
     def test_strip_hash(self):
         h = {'a': {'b': {'x': 'y'}}, "c": [1, 2, 3]}
         self.assertEqual({'x': 'y'}, apply_config.strip_hash(h, 'a.b'))
@@ -417,8 +1008,10 @@ class OSConfigApplierTestCase(testtools.TestCase):
         apply_config.install_config([path], TEMPLATES, tmpdir, False)
         self.assertEqual(0o100755, os.stat(target_file).st_mode)
 
-    @mock.patch('os.chown')
-    def test_control_chown(self, chown_mock):
+    @mock.patch('os.getegid', return_value=1000)
+    @mock.patch('os.geteuid', return_value=1000)
+    @mock.patch('os.fchown')
+    def test_control_chown(self, chown_mock, *_ids):
         path = self.write_config(CONFIG)
         tmpdir = tempfile.mkdtemp()
         apply_config.install_config([path], CHOWN_TEMPLATES, tmpdir, False)
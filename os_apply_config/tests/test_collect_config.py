@@ -13,8 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import json
 import os
+import sys
 
 import fixtures
 import testtools
@@ -82,6 +84,132 @@ class OCCTestCase(testtools.TestCase):
             lambda: list(collect_config.parse_configs([('{', bad_json_path)])))
 
 
+class TestLoadConfigs(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.paths = []
+        for i in range(4):
+            path = os.path.join(self.tdir, '%d.json' % i)
+            with open(path, 'w') as out:
+                out.write(json.dumps({'a': i, 'b%d' % i: 'x' * (i * 10)}))
+            self.paths.append(path)
+
+    def thresholds(self, read, parse):
+        self.useFixture(fixtures.MockPatch('os.cpu_count', return_value=4))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_apply_config.collect_config.READ_THRESHOLD', read))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_apply_config.collect_config.PARSE_THRESHOLD', parse))
+
+    def expected(self):
+        return [json.loads(open(p).read()) for p in self.paths]
+
+    def test_sequential(self):
+        self.assertEqual(self.expected(),
+                         collect_config.load_configs(self.paths))
+
+    def test_thread_pool(self):
+        self.thresholds(0, 1024 * 1024)
+        self.assertEqual(self.expected(),
+                         collect_config.load_configs(self.paths))
+
+    def test_process_pool(self):
+        self.thresholds(0, 30)
+        self.assertEqual(self.expected(),
+                         collect_config.load_configs(self.paths))
+
+    def test_order_and_missing(self):
+        self.thresholds(0, 30)
+        missing = os.path.join(self.tdir, 'missing.json')
+        paths = [self.paths[3], missing, self.paths[0], '', self.paths[2]]
+        config = collect_config.collect_config(paths)
+        self.assertEqual(2, config['a'])
+        self.assertEqual(['a', 'b3', 'b0', 'b2'], list(config))
+
+    def test_bad_json(self):
+        self.thresholds(0, 30)
+        with open(self.paths[3], 'w') as out:
+            out.write('{' * 40)
+        e = self.assertRaises(exc.ConfigException,
+                              collect_config.load_configs, self.paths)
+        self.assertIn(self.paths[3], str(e))
+
+
+class TestParseCache(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MockPatchObject(
+            collect_config.ParseCache, '_memory', {}))
+        self.cache_dir = os.path.join(self.tdir, 'parse-cache')
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tdir, '%d.json' % i)
+            self.write(path, {'a': i, 'b%d' % i: {'c': i}})
+            self.paths.append(path)
+        self.parse = self.useFixture(fixtures.MockPatchObject(
+            collect_config, '_parse', wraps=collect_config._parse)).mock
+
+    def write(self, path, config):
+        with open(path, 'w') as out:
+            out.write(json.dumps(config))
+        # Old enough not to be considered racy.
+        os.utime(path, ns=(10 ** 9, 10 ** 9))
+
+    def parsed_paths(self):
+        return [c[0][1] for c in self.parse.call_args_list]
+
+    def collect(self, cache_dir=None):
+        return collect_config.collect_config(
+            self.paths, cache=collect_config.ParseCache(cache_dir))
+
+    def test_in_memory(self):
+        first = self.collect()
+        self.assertEqual(first, self.collect())
+        self.assertEqual(self.paths, self.parsed_paths())
+
+    def test_one_changed(self):
+        self.collect()
+        self.parse.reset_mock()
+        self.write(self.paths[1], {'a': 10, 'b0': {'d': 1}})
+        config = self.collect()
+        self.assertEqual([self.paths[1]], self.parsed_paths())
+        self.assertEqual(collect_config.collect_config(self.paths), config)
+        self.assertEqual({'a': 2, 'b0': {'c': 0, 'd': 1}, 'b2': {'c': 2}},
+                         config)
+
+    def test_on_disk(self):
+        self.collect(self.cache_dir)
+        self.assertEqual(3, len(os.listdir(self.cache_dir)))
+        collect_config.ParseCache._memory.clear()
+        self.parse.reset_mock()
+        config = self.collect(self.cache_dir)
+        self.assertEqual([], self.parsed_paths())
+        self.assertEqual(collect_config.collect_config(self.paths), config)
+
+    def test_corrupt_entry(self):
+        self.collect(self.cache_dir)
+        collect_config.ParseCache._memory.clear()
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                f.write(b'\x00garbage')
+        self.parse.reset_mock()
+        config = self.collect(self.cache_dir)
+        self.assertEqual(self.paths, self.parsed_paths())
+        self.assertEqual(collect_config.collect_config(self.paths), config)
+
+    def test_racy_not_cached(self):
+        with open(self.paths[0], 'w') as out:
+            out.write(json.dumps({'a': 'new'}))
+        self.collect()
+        self.parse.reset_mock()
+        self.collect()
+        self.assertEqual([self.paths[0]], self.parsed_paths())
+
+
 class TestMergeConfigs(testtools.TestCase):
 
     def test_merge_configs_noconflict(self):
@@ -125,3 +253,36 @@ class TestMergeConfigs(testtools.TestCase):
                          {'b': '2'}, {}, 'baseball']
         result = collect_config.merge_configs(list_conflict)
         self.assertEqual({'a': '1', 'b': '2'}, result)
+
+    def test_merge_configs_inputs_unmodified(self):
+        configs = [{'a': {'b': {'c': 1}}, 'l': [1]},
+                   {'a': {'b': {'d': 2}, 'e': 3}},
+                   {'a': {'b': {'c': 4}}}]
+        before = copy.deepcopy(configs)
+        result = collect_config.merge_configs(configs)
+        self.assertEqual({'a': {'b': {'c': 4, 'd': 2}, 'e': 3}, 'l': [1]},
+                         result)
+        self.assertEqual(before, configs)
+
+    def test_merge_configs_shares_unmerged(self):
+        configs = [{'a': {'x': [1]}, 'b': {'y': 1}}, {'b': {'z': 2}}]
+        result = collect_config.merge_configs(configs)
+        self.assertIs(configs[0]['a'], result['a'])
+        self.assertIsNot(configs[0]['b'], result['b'])
+
+
+class TestInterning(testtools.TestCase):
+
+    def test_parse_interns(self):
+        name = ''.join(['controller', '-0'])
+        doc = json.dumps({'host': name, 'hosts': [name, name],
+                          'n': {'controller-0': 1}, 'long': 'x' * 100,
+                          'nested': [[name]]})
+        parsed = collect_config._parse(doc, 'test')
+        key = list(parsed['n'])[0]
+        self.assertIs(key, parsed['host'])
+        self.assertIs(parsed['host'], parsed['hosts'][0])
+        self.assertIs(parsed['host'], parsed['hosts'][1])
+        self.assertIs(sys.intern(name), parsed['host'])
+        self.assertIsNot(sys.intern('x' * 100), parsed['long'])
+        self.assertEqual([[name]], parsed['nested'])
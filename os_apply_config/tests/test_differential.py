@@ -0,0 +1,84 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from unittest import mock
+
+import fixtures
+import testtools
+
+from os_apply_config import renderers
+from os_apply_config.tests import differential
+
+SEEDS = range(12)
+
+
+class DifferentialTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+
+    def test_generate_deterministic(self):
+        self.assertEqual(differential.generate(3), differential.generate(3))
+        self.assertNotEqual(differential.generate(3),
+                            differential.generate(4))
+
+    def test_variants(self):
+        for seed in SEEDS:
+            differential.run(differential.generate(seed),
+                             reproducer_dir=self.tdir)
+
+    def test_pools(self):
+        for seed in SEEDS[:3]:
+            differential.run(differential.generate(seed, executables=False),
+                             variants=['pools'], reproducer_dir=self.tdir)
+
+    def test_minimized_reproducer(self):
+        original = renderers.JsonRenderer.str_coerce
+
+        def broken(renderer, val):
+            if isinstance(val, list):
+                return json.dumps(val[::-1])
+            return original(renderer, val)
+
+        case = {'seed': 'injected', 'steps': [{
+            'metadata': [{'a': 'foo', 'list': [1, 2, 3]},
+                         {'b': {'c': True}}],
+            'templates': [
+                {'path': 'etc/foo', 'executable': False, 'oac': None,
+                 'tokens': ['{{a}}', ' = ', '{{b.c}}']},
+                {'path': 'etc/bar', 'executable': False,
+                 'oac': {'mode': 0o600},
+                 'tokens': ['x', '{{list}}', '{{^a}}none{{/a}}']},
+            ]}]}
+        with mock.patch.object(renderers.JsonRenderer, 'str_coerce',
+                               broken):
+            e = self.assertRaises(differential.Mismatch, differential.run,
+                                  case, ['install'], self.tdir)
+        self.assertEqual('install', e.variant)
+        self.assertEqual(
+            {'seed': 'injected', 'steps': [{
+                'metadata': [{'list': [2, 3]}],
+                'templates': [{'path': 'etc/bar', 'executable': False,
+                               'oac': None, 'tokens': ['{{list}}']}]}]},
+            e.case)
+        self.assertIn(e.reproducer, str(e))
+        with open(e.reproducer) as f:
+            self.assertEqual(e.case, json.load(f))
+        self.assertTrue(os.path.exists(os.path.join(
+            os.path.dirname(e.reproducer), 'step0', 'templates', 'etc',
+            'bar')))
@@ -0,0 +1,126 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import fixtures
+import testtools
+
+from os_apply_config import fingerprint
+
+
+class FingerprintTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.templates = os.path.join(self.tdir, 'templates')
+        os.makedirs(os.path.join(self.templates, 'etc'))
+        self.template = os.path.join(self.templates, 'etc', 'foo.conf')
+        with open(self.template, 'w') as t:
+            t.write('{{x}}\n')
+        self.metadata = os.path.join(self.tdir, 'md.json')
+        self.write_metadata({'x': 'foo'})
+        self.output = os.path.join(self.tdir, 'out')
+        self.state_dir = os.path.join(self.tdir, 'state')
+
+    def write_metadata(self, config):
+        with open(self.metadata, 'w') as md:
+            md.write(json.dumps(config))
+
+    def compute(self, subhash=None):
+        return fingerprint.compute(
+            [self.metadata], self.templates, self.output, subhash)
+
+    def test_stable(self):
+        self.assertEqual(self.compute(), self.compute())
+
+    def test_metadata_content(self):
+        before = self.compute()
+        self.write_metadata({'x': 'bar'})
+        self.assertNotEqual(before, self.compute())
+
+    def test_metadata_rewritten_unchanged(self):
+        before = self.compute()
+        self.write_metadata({'x': 'foo'})
+        self.assertEqual(before, self.compute())
+
+    def test_template_added(self):
+        before = self.compute()
+        with open(self.template + '.oac', 'w') as t:
+            t.write('mode: 0600\n')
+        self.assertNotEqual(before, self.compute())
+
+    def test_template_mode(self):
+        before = self.compute()
+        os.chmod(self.template, 0o755)
+        self.assertNotEqual(before, self.compute())
+
+    def test_template_symlink_target_edited(self):
+        real = os.path.join(self.tdir, 'real.conf')
+        with open(real, 'w') as f:
+            f.write('{{x}}\n')
+        os.symlink(real, os.path.join(self.templates, 'etc', 'link.conf'))
+        before = self.compute()
+        with open(real, 'w') as f:
+            f.write('{{y}}\n')
+        self.assertNotEqual(before, self.compute())
+
+    def test_subhash(self):
+        self.assertNotEqual(self.compute(), self.compute('x'))
+
+    def test_missing_metadata(self):
+        missing = os.path.join(self.tdir, 'missing.json')
+        self.assertNotEqual(
+            self.compute(),
+            fingerprint.compute([self.metadata, missing], self.templates,
+                                self.output))
+
+    def test_record_is_current(self):
+        out_file = os.path.join(self.tdir, 'out.conf')
+        with open(out_file, 'w') as f:
+            f.write('foo\n')
+        fp = self.compute()
+        self.assertFalse(fingerprint.is_current(self.state_dir, fp))
+        fingerprint.record(self.state_dir, fp, [out_file])
+        self.assertTrue(fingerprint.is_current(self.state_dir, fp))
+        self.assertFalse(fingerprint.is_current(self.state_dir, 'other'))
+
+    def test_output_drift(self):
+        out_file = os.path.join(self.tdir, 'out.conf')
+        with open(out_file, 'w') as f:
+            f.write('foo\n')
+        fp = self.compute()
+        fingerprint.record(self.state_dir, fp, [out_file])
+        with open(out_file, 'w') as f:
+            f.write('edited by hand\n')
+        self.assertFalse(fingerprint.is_current(self.state_dir, fp))
+
+    def test_output_removed(self):
+        out_file = os.path.join(self.tdir, 'out.conf')
+        with open(out_file, 'w') as f:
+            f.write('foo\n')
+        fp = self.compute()
+        fingerprint.record(self.state_dir, fp, [out_file])
+        os.unlink(out_file)
+        self.assertFalse(fingerprint.is_current(self.state_dir, fp))
+
+    def test_corrupt_state(self):
+        os.makedirs(self.state_dir)
+        with open(os.path.join(self.state_dir,
+                               fingerprint.STATE_FILE), 'w') as f:
+            f.write('{')
+        self.assertFalse(fingerprint.is_current(self.state_dir,
+                                                self.compute()))
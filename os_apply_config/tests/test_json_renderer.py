@@ -14,7 +14,12 @@
 # limitations under the License.
 
 import json
+import os
+from unittest import mock
 
+import fixtures
+from pystache import context as pystache_context
+from pystache import parser
 import testtools
 from testtools import content
 
@@ -36,3 +41,142 @@ class JsonRendererTestCase(testtools.TestCase):
         result = x.render('{{a.c}}', context)
         self.addDetail('result', content.text_content(result))
         self.assertEqual('the quick brown fox', result)
+
+    def test_parse_once(self):
+        x = renderers.JsonRenderer(partials={'p': '{{a.c}}'})
+        with mock.patch.object(renderers.parser, 'parse',
+                               wraps=parser.parse) as parse:
+            self.assertEqual('the quick brown fox!',
+                             x.render('{{>p}}!', json.loads(TEST_JSON)))
+            self.assertEqual('the quick brown fox?',
+                             x.render('{{>p}}?', json.loads(TEST_JSON)))
+            self.assertEqual(3, parse.call_count)
+
+    def test_coerce_once(self):
+        context = json.loads(TEST_JSON)
+        x = renderers.JsonRenderer()
+        with mock.patch.object(renderers.json, 'dumps',
+                               wraps=json.dumps) as dumps:
+            self.assertEqual('[1, 2, 3, "foo"] [1, 2, 3, "foo"]',
+                             x.render('{{a.b}} {{a.b}}', context))
+            self.assertEqual('[1, 2, 3, "foo"]', x.render('{{a.b}}', context))
+            self.assertEqual(1, dumps.call_count)
+            # an equal but distinct value is serialized again
+            x.render('{{a.b}}', json.loads(TEST_JSON))
+            self.assertEqual(2, dumps.call_count)
+
+    def test_coerce_cache_bounded(self):
+        context = {'a': ['x' * 10], 'b': ['y' * 10]}
+        x = renderers.JsonRenderer()
+        x.COERCE_CACHE_SIZE = 20
+        self.assertEqual('["xxxxxxxxxx"] ["yyyyyyyyyy"]',
+                         x.render('{{a}} {{b}}', context))
+        self.assertEqual([id(context['a'])], list(x._coerced))
+
+    def test_sections_shadow(self):
+        context = {'a': {'b': 1}, 'c': 'top',
+                   'items': [{'c': 'one'}, {'a': {'d': 2}}, {}]}
+        x = renderers.JsonRenderer(missing_tags='ignore')
+        self.assertEqual(
+            'top 1|one 1|top |top 1|top',
+            x.render('{{c}} {{a.b}}|{{#items}}{{c}} {{a.b}}|{{/items}}{{c}}',
+                     context))
+
+    def test_missing_strict(self):
+        x = renderers.JsonRenderer(missing_tags='strict')
+        for template, key in [('{{x}}', 'x'), ('{{a.x}}', 'a.x'),
+                              ('{{a.c}}{{a.x}}{{a.x}}', 'a.x')]:
+            e = self.assertRaises(pystache_context.KeyNotFoundError,
+                                  x.render, template, json.loads(TEST_JSON))
+            self.assertEqual(key, e.key)
+
+
+class MetadataContextStackTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stack = renderers.MetadataContextStack(json.loads(TEST_JSON))
+
+    def test_get(self):
+        self.assertEqual('the quick brown fox', self.stack.get('a.c'))
+        self.assertEqual([1, 2, 3, 'foo'], self.stack.get('a.b'))
+        self.assertEqual(self.stack.top(), self.stack.get('.'))
+
+    def test_resolves_once(self):
+        with mock.patch.object(renderers.context, '_get_value',
+                               wraps=pystache_context._get_value) as gv:
+            self.stack.get('a.c')
+            self.stack.get('a.c')
+            self.assertEqual(2, gv.call_count)
+
+    def test_missing(self):
+        for _ in range(2):
+            e = self.assertRaises(pystache_context.KeyNotFoundError,
+                                  self.stack.get, 'a.x')
+            self.assertEqual("missing 'x'", e.details)
+            e = self.assertRaises(pystache_context.KeyNotFoundError,
+                                  self.stack.get, 'x.y')
+            self.assertEqual('first part', e.details)
+
+    def test_push_pop(self):
+        self.assertEqual('the quick brown fox', self.stack.get('a.c'))
+        self.stack.push({'a': {'c': 'lazy dog'}})
+        self.assertEqual('lazy dog', self.stack.get('a.c'))
+        self.assertRaises(pystache_context.KeyNotFoundError,
+                          self.stack.get, 'a.b')
+        self.stack.push({'d': 1})
+        self.assertEqual('lazy dog', self.stack.get('a.c'))
+        self.stack.pop()
+        self.stack.pop()
+        self.assertEqual('the quick brown fox', self.stack.get('a.c'))
+        self.assertEqual([1, 2, 3, 'foo'], self.stack.get('a.b'))
+
+    def test_shared_between_renders(self):
+        context = json.loads(TEST_JSON)
+        x = renderers.JsonRenderer()
+        x.render('{{a.c}}', context)
+        with mock.patch.object(renderers.context, '_get_value') as gv:
+            self.assertEqual('the quick brown fox',
+                             x.render('{{a.c}}', context))
+            self.assertFalse(gv.called)
+
+
+class PartialLoaderTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.partials = os.path.join(self.tdir, 'partials')
+        os.makedirs(os.path.join(self.partials, 'db'))
+        with open(os.path.join(self.partials, 'db', 'dsn'), 'w') as f:
+            f.write('mysql://{{user}}@{{host}}/{{name}}')
+        with open(os.path.join(self.tdir, 'secret'), 'w') as f:
+            f.write('secret')
+
+    def test_get(self):
+        loader = renderers.PartialLoader(self.partials)
+        self.assertEqual('mysql://{{user}}@{{host}}/{{name}}',
+                         loader.get('db/dsn'))
+        self.assertIsNone(loader.get('missing'))
+        self.assertIsNone(loader.get('db'))
+
+    def test_read_once(self):
+        loader = renderers.PartialLoader(self.partials)
+        loader.get('db/dsn')
+        os.unlink(os.path.join(self.partials, 'db', 'dsn'))
+        self.assertEqual('mysql://{{user}}@{{host}}/{{name}}',
+                         loader.get('db/dsn'))
+
+    def test_outside_dir(self):
+        loader = renderers.PartialLoader(self.partials)
+        self.assertIsNone(loader.get('../secret'))
+        self.assertIsNone(loader.get(os.path.join(self.tdir, 'secret')))
+
+    def test_render(self):
+        x = renderers.JsonRenderer(
+            missing_tags='ignore',
+            partials=renderers.PartialLoader(self.partials))
+        self.assertEqual(
+            'connection = mysql://nova@db1/nova\n',
+            x.render('connection = {{#db}}{{>db/dsn}}{{/db}}\n{{>missing}}',
+                     {'db': {'user': 'nova', 'host': 'db1', 'name': 'nova'}}))
@@ -0,0 +1,190 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from unittest import mock
+
+import fixtures
+import testtools
+
+from os_apply_config import apply_config
+from os_apply_config import config_exception as exc
+from os_apply_config import key_index
+
+CONFIG = {
+    'database': {'url': 'sqlite:///blah', 'port': 3306},
+    'l': [1, {'a': 'b'}, None],
+    'dotted.key': {'x': 1},
+    'z': None,
+    'btrue': True,
+    'unicode': '☃',
+}
+
+
+class KeyIndexTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.state_dir = os.path.join(self.tdir, 'state')
+        self.metadata = os.path.join(self.tdir, 'md.json')
+        with open(self.metadata, 'w') as md:
+            md.write(json.dumps(CONFIG))
+        # Old enough for its stat identity to be trusted.
+        os.utime(self.metadata, ns=(10 ** 9, 10 ** 9))
+
+    def build(self, config=CONFIG):
+        sig = key_index.signature([self.metadata])
+        key_index.build(self.state_dir, sig, config)
+        return sig
+
+    def test_get(self):
+        sig = self.build()
+        index = key_index.load(self.state_dir, sig)
+        self.addCleanup(index.close)
+        self.assertEqual((True, 'sqlite:///blah'), index.get('database.url'))
+        self.assertEqual((True, CONFIG['database']), index.get('database'))
+        self.assertEqual((True, {'a': 'b'}), index.get('l.1'))
+        self.assertEqual((True, 'b'), index.get('l.1.a'))
+        self.assertEqual((True, None), index.get('z'))
+        self.assertEqual((True, '☃'), index.get('unicode'))
+        self.assertEqual((False, None), index.get('database.user'))
+        self.assertEqual((False, None), index.get('dotted.key'))
+        self.assertEqual((False, None), index.get('l.3'))
+
+    def test_matches_walk(self):
+        sig = self.build()
+        index = key_index.load(self.state_dir, sig)
+        self.addCleanup(index.close)
+        for key in ['database', 'database.url', 'database.port', 'l',
+                    'l.0', 'l.1', 'l.1.a', 'l.2', 'l.2.x', 'l.5',
+                    'dotted', 'dotted.key', 'dotted.key.x', 'z', 'z.a',
+                    'btrue', 'btrue.x', 'unicode', 'database.url.x',
+                    'missing']:
+            found, value = index.get(key)
+            self.assertTrue(key_index.is_canonical(key))
+            self.assertEqual(apply_config._walk_key(CONFIG, key), value,
+                             key)
+
+    def test_empty_string_key(self):
+        config = {'': {'b': 'shadow'}, 'b': 'real'}
+        sig = self.build(config)
+        index = key_index.load(self.state_dir, sig)
+        self.addCleanup(index.close)
+        for key, value in [('b', 'real'), ('.b', 'shadow'),
+                           ('', {'b': 'shadow'})]:
+            self.assertEqual((True, value), index.get(key), key)
+            self.assertEqual(apply_config._walk_key(config, key), value)
+
+    def test_empty(self):
+        sig = self.build({})
+        index = key_index.load(self.state_dir, sig)
+        self.addCleanup(index.close)
+        self.assertEqual((False, None), index.get('a'))
+
+    def test_stale(self):
+        self.build()
+        with open(self.metadata, 'w') as md:
+            md.write(json.dumps({'changed': True}))
+        os.utime(self.metadata, ns=(2 * 10 ** 9, 2 * 10 ** 9))
+        sig = key_index.signature([self.metadata])
+        self.assertIsNone(key_index.load(self.state_dir, sig))
+
+    def test_recently_modified(self):
+        os.utime(self.metadata)
+        self.assertIsNone(key_index.signature([self.metadata]))
+        key_index.build(self.state_dir, None, CONFIG)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.state_dir, key_index.INDEX_FILE)))
+        self.assertIsNone(key_index.load(self.state_dir, None))
+
+    def test_unreadable(self):
+        with mock.patch('os.stat', side_effect=PermissionError(13, 'denied')):
+            e = self.assertRaises(exc.ConfigException, key_index.signature,
+                                  [self.metadata])
+        self.assertIn('Could not open %s for reading' % self.metadata,
+                      str(e))
+
+    def test_values_stored_once(self):
+        config = leaf = {}
+        for depth in range(6):
+            leaf['n%d' % depth] = dict(('k%d' % i, 'v' * 100)
+                                       for i in range(100))
+            leaf['child'] = {}
+            leaf = leaf['child']
+        data = key_index.serialize(config, b'\0' * 32)
+        self.assertLess(len(data), 2 * len(json.dumps(config)))
+        sig = self.build(config)
+        index = key_index.load(self.state_dir, sig)
+        self.addCleanup(index.close)
+        self.assertEqual((True, config['child']), index.get('child'))
+        self.assertEqual((True, 'v' * 100),
+                         index.get('child.child.n2.k99'))
+
+    def test_missing_or_corrupt(self):
+        sig = key_index.signature([self.metadata])
+        self.assertIsNone(key_index.load(self.state_dir, sig))
+        os.makedirs(self.state_dir)
+        path = os.path.join(self.state_dir, key_index.INDEX_FILE)
+        for data in [b'', b'OACK', b'x' * 100]:
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.assertIsNone(key_index.load(self.state_dir, sig))
+
+    def test_is_canonical(self):
+        self.assertTrue(key_index.is_canonical('a.b.0.10'))
+        self.assertFalse(key_index.is_canonical('l.-1'))
+        self.assertFalse(key_index.is_canonical('l.01'))
+        self.assertFalse(key_index.is_canonical('l.-0'))
+
+
+class ExtractKeyTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.state_dir = os.path.join(self.tdir, 'state')
+        self.metadata = os.path.join(self.tdir, 'md.json')
+        self.write({'a': {'b': 'c'}, 'l': [1, 2, 3]})
+
+    def write(self, config):
+        with open(self.metadata, 'w') as md:
+            md.write(json.dumps(config))
+        self.mtime = getattr(self, 'mtime', 0) + 10 ** 9
+        os.utime(self.metadata, ns=(self.mtime, self.mtime))
+
+    def extract(self, key):
+        return apply_config._extract_key([self.metadata], key,
+                                         state_dir=self.state_dir)
+
+    def test_uses_index(self):
+        self.assertEqual('c', self.extract('a.b'))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.state_dir, key_index.INDEX_FILE)))
+        with fixtures.MockPatch(
+                'os_apply_config.collect_config.collect_config') as collect:
+            self.assertEqual('c', self.extract('a.b'))
+            self.assertIsNone(self.extract('a.x'))
+            self.assertFalse(collect.mock.called)
+
+    def test_rebuilds_when_changed(self):
+        self.assertEqual('c', self.extract('a.b'))
+        self.write({'a': {'b': 'd'}})
+        self.assertEqual('d', self.extract('a.b'))
+
+    def test_non_canonical_index(self):
+        self.assertEqual(1, self.extract('l.0'))
+        self.assertEqual(3, self.extract('l.-1'))
+        self.assertEqual(2, self.extract('l.01'))
@@ -0,0 +1,168 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+from unittest import mock
+
+import fixtures
+import testtools
+
+from os_apply_config import apply_config
+from os_apply_config import config_exception as exc
+from os_apply_config import limits
+from os_apply_config import oac_file
+
+
+class LimitsTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+
+    def script(self, body):
+        path = os.path.join(self.tdir, 'script')
+        with open(path, 'w') as f:
+            f.write('#!%s\nimport os, sys\n%s\n' % (sys.executable, body))
+        os.chmod(path, 0o755)
+        return path
+
+    def render(self, body, **kwargs):
+        return apply_config.render_executable(
+            self.script(body), {}, limits.Limits(**kwargs))
+
+    def test_parse(self):
+        self.assertEqual(512 * 2 ** 20,
+                         limits.parse_size('memory_limit', '512M'))
+        self.assertEqual(2 ** 30, limits.parse_size('memory_limit', '1GiB'))
+        self.assertEqual(4096, limits.parse_size('output_limit', 4096))
+        self.assertEqual(('idle', 0), limits.parse_ionice('ionice', 'idle'))
+        self.assertEqual(('best-effort', 7),
+                         limits.parse_ionice('ionice', 'best-effort:7'))
+        self.assertEqual(('best-effort', 3), limits.parse_ionice('ionice', 3))
+        for key, v in [('cpu_limit', 0), ('cpu_limit', '1'),
+                       ('memory_limit', '12X'), ('output_limit', -1),
+                       ('nice', 20), ('ionice', 'idle:8'),
+                       ('ionice', 'fast')]:
+            e = self.assertRaises(exc.ConfigException,
+                                  limits.PARSERS[key], key, v)
+            self.assertIn(key, str(e))
+
+    def test_unrecognised(self):
+        self.assertRaises(exc.ConfigException, limits.Limits, timeout=1)
+
+    def test_override(self):
+        defaults = limits.Limits(cpu_limit=10, nice=5)
+        obj = oac_file.OacFile('', cpu_limit=2, output_limit='1K')
+        self.assertEqual(limits.Limits(cpu_limit=2, nice=5, output_limit=1024),
+                         defaults.override(obj))
+        self.assertFalse(limits.Limits())
+        self.assertIsNone(limits.Limits(output_limit=1).preexec())
+
+    def test_unlimited(self):
+        with mock.patch('subprocess.Popen', wraps=subprocess.Popen) as popen:
+            self.assertEqual('ok\n', self.render('print("ok")'))
+        self.assertIsNone(popen.call_args[1]['preexec_fn'])
+
+    def test_nice(self):
+        self.assertEqual(
+            '%d\n' % min(19, os.nice(0) + 5),
+            self.render('print(os.nice(0))', nice=min(19, os.nice(0) + 5)))
+
+    @testtools.skipUnless(shutil.which('ionice') and
+                          limits._ioprio_set() is not None,
+                          'ionice is not available')
+    def test_ionice(self):
+        out = self.render(
+            'import subprocess\n'
+            'subprocess.call(["ionice", "-p", str(os.getpid())])',
+            ionice='best-effort:6')
+        self.assertEqual('best-effort: prio 6\n', out)
+
+    def test_ionice_unsupported(self):
+        with mock.patch('platform.machine', return_value='vax'):
+            self.assertEqual('ok\n', self.render('print("ok")',
+                                                 ionice='idle'))
+        self.assertIn('ionice is not supported on vax', self.logger.output)
+
+    def test_cpu_limit(self):
+        e = self.assertRaises(exc.ConfigException, self.render,
+                              'while True:\n    pass', cpu_limit=1)
+        self.assertIn('exceeded its CPU time limit of 1 seconds', str(e))
+
+    def test_memory_limit(self):
+        e = self.assertRaises(exc.ConfigException, self.render,
+                              'x = bytearray(1024 ** 3)',
+                              memory_limit='256M')
+        self.assertIn('exceeded its memory limit of 268435456 bytes',
+                      str(e))
+        self.assertIn('MemoryError', str(e))
+
+    def test_output_limit(self):
+        e = self.assertRaises(
+            exc.ConfigException, self.render,
+            'import time\n'
+            'sys.stdout.write("x" * 4096)\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)', output_limit=1024)
+        self.assertIn('exceeded its output limit of 1024 bytes', str(e))
+
+    def test_output_within_limit(self):
+        # Larger than a pipe buffer both ways.
+        out = apply_config.render_executable(
+            self.script('sys.stdout.write(sys.stdin.read())\n'
+                        'sys.stderr.write("e" * 10 ** 6)'),
+            {'x': 'y' * 10 ** 6}, limits.Limits(output_limit='2M'))
+        self.assertEqual('{"x": "%s"}' % ('y' * 10 ** 6), out)
+
+    def test_failure_within_limits(self):
+        e = self.assertRaises(exc.ConfigException, self.render,
+                              'sys.exit("broken")', cpu_limit=10,
+                              memory_limit='1G')
+        self.assertIn('config script failed: %s\n' % self.script(''),
+                      str(e))
+        self.assertIn('broken', str(e))
+
+    def test_preexec_failure(self):
+        with mock.patch.object(limits, '_ioprio_set',
+                               return_value=mock.Mock(side_effect=OSError)):
+            e = self.assertRaises(exc.ConfigException, self.render,
+                                  'print("ok")', ionice='realtime')
+        self.assertIn('could not be started with ionice', str(e))
+
+    def test_build_tree_control_file(self):
+        templates = os.path.join(self.tdir, 'templates')
+        os.mkdir(templates)
+        path = os.path.join(templates, 'out')
+        with open(path, 'w') as f:
+            f.write('#!%s\nprint("x" * 100)\n' % sys.executable)
+        os.chmod(path, 0o755)
+        with open(path + '.oac', 'w') as f:
+            f.write('output_limit: 10\n')
+        e = self.assertRaises(
+            exc.ConfigException, apply_config.build_tree,
+            apply_config.template_paths(templates), {}, None, None,
+            limits.Limits(output_limit='1M'))
+        self.assertIn('output limit of 10 bytes', str(e))
+
+    def test_opts(self):
+        opts = apply_config.parse_opts(
+            ['os-apply-config', '--exec-memory-limit', '1G',
+             '--exec-ionice', 'idle', '--exec-cpu-limit', '30'])
+        self.assertEqual(
+            limits.Limits(memory_limit=2 ** 30, ionice='idle', cpu_limit=30),
+            apply_config.limits_from_opts(opts))
@@ -0,0 +1,120 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest import mock
+
+import fixtures
+import testtools
+
+from os_apply_config import config_exception as exc
+from os_apply_config import manifest
+from os_apply_config import oac_file
+from os_apply_config import writer
+
+
+class ManifestTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.state_dir = os.path.join(self.tdir, 'state')
+        self.out = os.path.join(self.tdir, 'out')
+        self.foo = os.path.join(self.out, 'foo')
+        self.bar = os.path.join(self.out, 'bar')
+        self.apply([(self.foo, oac_file.OacFile('foo\n').set('mode', 0o600)),
+                    (self.bar, oac_file.OacFile('bar\n'))])
+
+    def apply(self, outputs, partial=False):
+        with writer.Writer() as w:
+            manifest.record(self.state_dir, w.write_all(outputs), partial)
+
+    def test_record(self):
+        outputs = manifest.load(self.state_dir)
+        self.assertEqual([self.bar, self.foo], sorted(outputs))
+        self.assertEqual(0o600, outputs[self.foo]['mode'])
+        self.assertEqual(4, outputs[self.foo]['size'])
+        content = os.path.join(self.state_dir, manifest.CONTENT_DIR,
+                               outputs[self.foo]['sha256'])
+        self.assertEqual(b'foo\n', open(content, 'rb').read())
+        self.assertEqual(0o100600, os.stat(content).st_mode)
+        self.assertEqual([], manifest.verify(self.state_dir))
+
+    def test_deleted_and_unreferenced_content(self):
+        old = manifest.load(self.state_dir)[self.bar]['sha256']
+        self.apply([(self.foo, oac_file.OacFile('foo\n')),
+                    (self.bar, oac_file.OacFile('').set('allow_empty',
+                                                        False))])
+        self.assertEqual([self.foo], list(manifest.load(self.state_dir)))
+        self.assertNotIn(old, os.listdir(
+            os.path.join(self.state_dir, manifest.CONTENT_DIR)))
+
+    def test_partial(self):
+        baz = os.path.join(self.out, 'baz')
+        self.apply([(baz, oac_file.OacFile('baz\n'))], partial=True)
+        self.assertEqual([self.bar, baz, self.foo],
+                         sorted(manifest.load(self.state_dir)))
+        self.apply([(baz, oac_file.OacFile('baz\n'))])
+        self.assertEqual([baz], list(manifest.load(self.state_dir)))
+
+    def test_touched_is_not_drift(self):
+        os.utime(self.foo, ns=(10 ** 9, 10 ** 9))
+        with mock.patch.object(manifest, '_hash',
+                               wraps=manifest._hash) as hash_:
+            self.assertEqual([], manifest.verify(self.state_dir))
+            self.assertEqual(1, hash_.call_count)
+
+    def test_unchanged_not_hashed(self):
+        with mock.patch.object(manifest, '_hash') as hash_:
+            self.assertEqual([], manifest.verify(self.state_dir))
+            self.assertFalse(hash_.called)
+
+    def test_drift(self):
+        with open(self.foo, 'w') as f:
+            f.write('bar\n')
+        os.chmod(self.bar, 0o640)
+        self.assertEqual([(self.bar, ['mode']),
+                          (self.foo, ['content'])],
+                         manifest.verify(self.state_dir))
+
+    def test_missing_and_type(self):
+        os.unlink(self.foo)
+        os.unlink(self.bar)
+        os.symlink(self.foo, self.bar)
+        self.assertEqual([(self.bar, ['type']), (self.foo, ['missing'])],
+                         manifest.verify(self.state_dir))
+
+    def test_repair(self):
+        with open(self.foo, 'w') as f:
+            f.write('edited by hand\n')
+        os.chmod(self.foo, 0o644)
+        os.unlink(self.bar)
+        written = manifest.repair(self.state_dir, [self.bar, self.foo])
+        self.assertEqual([(self.out, 'created'), (self.out, 'modified')],
+                         [(os.path.dirname(path), status)
+                          for path, _obj, status in written])
+        self.assertEqual('foo\n', open(self.foo).read())
+        self.assertEqual(0o100600, os.stat(self.foo).st_mode)
+        self.assertEqual('bar\n', open(self.bar).read())
+        self.assertEqual([], manifest.verify(self.state_dir))
+
+    def test_repair_missing_content(self):
+        os.unlink(self.foo)
+        for name in os.listdir(os.path.join(self.state_dir,
+                                            manifest.CONTENT_DIR)):
+            os.unlink(os.path.join(self.state_dir, manifest.CONTENT_DIR,
+                                   name))
+        self.assertRaises(exc.ConfigException,
+                          manifest.repair, self.state_dir, [self.foo])
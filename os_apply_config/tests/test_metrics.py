@@ -0,0 +1,136 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tracemalloc
+
+import fixtures
+import testtools
+
+from os_apply_config import metrics
+
+
+class RunStatsTestCase(testtools.TestCase):
+
+    def test_phase(self):
+        stats = metrics.RunStats()
+        with stats.phase('render'):
+            pass
+        with stats.phase('render'):
+            pass
+        self.assertEqual(['render'], list(stats.phases))
+        self.assertGreaterEqual(stats.phases['render'], 0)
+
+    def test_phase_none(self):
+        with metrics.phase(None, 'render'):
+            pass
+
+    def test_run_failure(self):
+        stats = metrics.RunStats()
+
+        def fail():
+            with stats.run():
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertFalse(stats.success)
+
+    def test_format_textfile(self):
+        stats = metrics.RunStats()
+        with stats.run():
+            stats.count('files_written', 2)
+            stats.count('bytes_written', 10)
+        text = metrics.format_textfile(stats, 1234.5)
+        lines = text.splitlines()
+        self.assertIn('# TYPE os_apply_config_files_written gauge', lines)
+        self.assertIn('os_apply_config_files_written 2', lines)
+        self.assertIn('os_apply_config_bytes_written 10', lines)
+        self.assertIn('os_apply_config_files_deleted 0', lines)
+        self.assertIn(
+            'os_apply_config_last_success_timestamp_seconds 1234.5', lines)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_format_priorities(self):
+        stats = metrics.RunStats()
+        with stats.run():
+            stats.priority_done(10)
+            stats.priority_done(0)
+        lines = metrics.format_textfile(stats).splitlines()
+        self.assertIn('# TYPE os_apply_config_priority_completed_seconds'
+                      ' gauge', lines)
+        self.assertEqual(['10', '0'], [
+            line.split('"')[1] for line in lines if line.startswith(
+                'os_apply_config_priority_completed_seconds{')])
+
+
+class MemoryTrackerTestCase(testtools.TestCase):
+
+    def test_phases(self):
+        stats = metrics.RunStats(memory=True)
+        with stats.run():
+            with stats.phase('parse'):
+                kept = [bytearray(1024) for _ in range(1024)]
+            with stats.phase('render'):
+                [bytearray(1024) for _ in range(2048)]
+        summary = stats.memory.summary()
+        self.assertEqual(['parse', 'render'], list(summary['phases']))
+        parse = summary['phases']['parse']
+        self.assertGreater(parse['retained_bytes'], 1024 * 1024)
+        self.assertGreaterEqual(parse['peak_bytes'], parse['retained_bytes'])
+        render = summary['phases']['render']
+        self.assertGreater(render['peak_bytes'], 2 * 1024 * 1024)
+        self.assertLess(render['retained_bytes'], 1024 * 1024)
+        self.assertTrue(parse['top'])
+        self.assertIn('test_metrics.py:', parse['top'][0]['line'])
+        self.assertGreater(summary['max_rss_bytes'], 0)
+        self.assertFalse(tracemalloc.is_tracing())
+        del kept
+
+    def test_off(self):
+        stats = metrics.RunStats()
+        with stats.run():
+            with stats.phase('parse'):
+                self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(stats.memory)
+
+
+class WriteTextfileTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'oac.prom')
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_keeps_last_success(self):
+        stats = metrics.RunStats()
+        with stats.run():
+            pass
+        metrics.write_textfile(self.path, stats)
+        success = [line for line in self.read()
+                   if line.startswith(metrics.LAST_SUCCESS + ' ')]
+        self.assertEqual(1, len(success))
+
+        stats = metrics.RunStats()
+        metrics.write_textfile(self.path, stats)
+        lines = self.read()
+        self.assertIn('os_apply_config_last_run_success 0', lines)
+        self.assertIn(success[0], lines)
+
+    def test_no_previous_success(self):
+        metrics.write_textfile(self.path, metrics.RunStats())
+        self.assertFalse([line for line in self.read()
+                          if line.startswith(metrics.LAST_SUCCESS)])
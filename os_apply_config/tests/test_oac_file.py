@@ -15,6 +15,7 @@
 
 import grp
 import pwd
+from unittest import mock
 
 import testtools
 
@@ -88,3 +89,43 @@ class OacFileTestCase(testtools.TestCase):
         except exc.ConfigException as e:
             self.assertIn(
                 "group '%s' not found in group database" % group, str(e))
+
+    def test_input_keys(self):
+        oacf = oac_file.OacFile('')
+        oacf.input_keys = 'a.b'
+        self.assertEqual(['a.b'], oacf.input_keys)
+        oacf.input_keys = ['a', 'b.c']
+        self.assertEqual(['a', 'b.c'], oacf.input_keys)
+        for keys in [{'a': 1}, ['a', 1], ['']]:
+            e = self.assertRaises(exc.ConfigException,
+                                  setattr, oacf, 'input_keys', keys)
+            self.assertIn('is not a list of keys', str(e))
+
+    def test_input_subhash(self):
+        oacf = oac_file.OacFile('', input_subhash='nova')
+        self.assertEqual('nova', oacf.input_subhash)
+        self.assertRaises(exc.ConfigException,
+                          setattr, oacf, 'input_subhash', ['nova'])
+
+    def test_priority(self):
+        oacf = oac_file.OacFile('')
+        self.assertEqual(0, oacf.priority)
+        oacf.priority = -5
+        self.assertEqual(-5, oacf.priority)
+        for v in ['10', 1.5, None]:
+            e = self.assertRaises(exc.ConfigException,
+                                  setattr, oacf, 'priority', v)
+            self.assertIn('is not an integer', str(e))
+
+    def test_lookups_cached(self):
+        oac_file.clear_caches()
+        self.addCleanup(oac_file.clear_caches)
+        name = pwd.getpwuid(0)[0]
+        with mock.patch('pwd.getpwnam', wraps=pwd.getpwnam) as getpwnam:
+            for _ in range(3):
+                self.assertEqual(0, oac_file.OacFile('', owner=name).owner)
+            self.assertEqual(1, getpwnam.call_count)
+            self.assertEqual(2, oac_file.cached_lookups())
+            oac_file.clear_caches()
+            oac_file.OacFile('', owner=name)
+            self.assertEqual(2, getpwnam.call_count)
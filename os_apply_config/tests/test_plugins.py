@@ -0,0 +1,126 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+
+import fixtures
+import testtools
+
+from os_apply_config import apply_config
+from os_apply_config import config_exception as exc
+from os_apply_config import metrics
+from os_apply_config import plugins
+from os_apply_config import template_source
+
+CONFIG = {'db': {'host': 'db1', 'user': 'nova'}, 'hosts': ['a', 'b']}
+
+UPPER = '''
+def render(config):
+    return config['db']['host'].upper().encode('utf-8')
+'''
+
+
+class PluginTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.templates = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MockPatchObject(plugins, '_modules', {}))
+
+    def template(self, name, body, ctrl='plugin: true\n'):
+        path = os.path.join(self.templates, name)
+        with open(path, 'w') as f:
+            f.write(body)
+        if ctrl is not None:
+            with open(path + '.oac', 'w') as f:
+                f.write(ctrl)
+        return path
+
+    def build(self, config=CONFIG, stats=None, source=None):
+        source = source or template_source.FileSource(self.templates)
+        return apply_config.build_tree(source.paths(), config, stats,
+                                       source=source)
+
+    def test_render(self):
+        self.template('upper', UPPER)
+        self.template('str', 'def render(config):\n'
+                             '    return ",".join(config["hosts"])\n')
+        stats = metrics.RunStats()
+        tree = self.build(stats=stats)
+        self.assertEqual(b'DB1', tree['upper'].body)
+        self.assertEqual('a,b', tree['str'].body)
+        self.assertEqual(2, stats.counters['plugin_templates'])
+        self.assertEqual(0, stats.counters['executable_templates'])
+
+    def test_loaded_once(self):
+        path = self.template('upper', UPPER)
+        self.build()
+        module = plugins._modules[path][1]
+        self.assertEqual(b'DB2', self.build(
+            {'db': {'host': 'db2'}})['upper'].body)
+        self.assertIs(module, plugins._modules[path][1])
+        self.template('upper', 'def render(config):\n    return "new"\n')
+        self.assertEqual('new', self.build()['upper'].body)
+
+    def test_config_passed_directly(self):
+        path = self.template('seen', 'def render(config):\n'
+                                     '    global seen\n'
+                                     '    seen = config\n'
+                                     '    return ""\n')
+        self.build()
+        self.assertIs(CONFIG, plugins._modules[path][1].seen)
+
+    def test_input_keys(self):
+        self.template('keys', 'def render(config):\n'
+                              '    return repr(sorted(config))\n',
+                      'plugin: true\ninput_subhash: db\ninput_keys: user\n')
+        self.assertEqual("['user']", self.build()['keys'].body)
+
+    def test_errors(self):
+        for body, message in [
+                ('def render(config):\n    return config["missing"]\n',
+                 "KeyError: 'missing'"),
+                ('def render(config:\n', 'SyntaxError'),
+                ('import no_such_module\n', 'ModuleNotFoundError'),
+                ('render = 1\n', 'does not define render(config)'),
+                ('def render(config):\n    return None\n',
+                 'returned NoneType, not bytes or a string')]:
+            path = self.template('broken', body)
+            e = self.assertRaises(exc.ConfigException, self.build)
+            self.assertIn('config plugin failed: %s' % path, e.args[0])
+            self.assertIn(message, e.args[0])
+
+    def test_archive(self):
+        self.template('upper', UPPER)
+        archive = shutil.make_archive(
+            os.path.join(self.useFixture(fixtures.TempDir()).path, 't'),
+            'tar', self.templates)
+        with template_source.open_templates(archive) as source:
+            self.assertEqual(b'DB1', self.build(source=source)['/upper'].body)
+
+    def test_install_config(self):
+        self.template('upper', UPPER)
+        metadata = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                'md.json')
+        with open(metadata, 'w') as f:
+            f.write('{"db": {"host": "db1"}}')
+        out = self.useFixture(fixtures.TempDir()).path
+        state_dir = self.useFixture(fixtures.TempDir()).path
+        for _ in range(2):
+            apply_config.install_config([metadata], self.templates, out,
+                                        False, state_dir=state_dir)
+            with open(os.path.join(out, 'upper'), 'rb') as f:
+                self.assertEqual(b'DB1', f.read())
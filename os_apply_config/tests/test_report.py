@@ -0,0 +1,70 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import fixtures
+import testtools
+
+from os_apply_config import metrics
+from os_apply_config import report
+
+
+class ReportTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.stats = metrics.RunStats()
+        with self.stats.run():
+            self.stats.record_file('/etc/a', 'created', 3)
+            self.stats.record_file('/etc/b', 'modified', 4)
+            self.stats.record_file('/etc/c', 'unchanged', 5)
+            self.stats.record_file('/etc/d', 'deleted')
+            self.stats.record_file('/etc/e', 'skipped')
+
+    def test_counts(self):
+        self.assertEqual(2, self.stats.counters['files_written'])
+        self.assertEqual(7, self.stats.counters['bytes_written'])
+        self.assertEqual(2, self.stats.counters['files_skipped'])
+        self.assertEqual(1, self.stats.counters['files_deleted'])
+
+    def test_json(self):
+        self.assertEqual({'success': True,
+                          'created': ['/etc/a'],
+                          'modified': ['/etc/b'],
+                          'deleted': ['/etc/d']},
+                         json.loads(report.format_report(self.stats)))
+
+    def test_lines(self):
+        self.assertEqual('/etc/a\n/etc/b\n/etc/d\n',
+                         report.format_report(self.stats, 'lines'))
+        self.assertEqual('', report.format_report(metrics.RunStats(),
+                                                  'lines'))
+
+    def test_write_path(self):
+        path = os.path.join(self.tdir, 'report.json')
+        report.write(self.stats, path=path)
+        with open(path) as f:
+            self.assertEqual(['/etc/a'], json.load(f)['created'])
+
+    def test_write_fd(self):
+        path = os.path.join(self.tdir, 'report')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        self.addCleanup(os.close, fd)
+        report.write(self.stats, fd=fd, fmt='lines')
+        os.fstat(fd)  # left open
+        with open(path) as f:
+            self.assertEqual('/etc/a\n/etc/b\n/etc/d\n', f.read())
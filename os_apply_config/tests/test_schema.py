@@ -0,0 +1,123 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import fixtures
+import testtools
+import yaml
+
+from os_apply_config import config_exception as exc
+from os_apply_config import schema
+
+CONFIG = {
+    'keystone': {'database': {'host': '192.0.2.1', 'port': 3306}},
+    'bridges': [{'name': 'br-ex', 'mtu': 1500},
+                {'name': 'br ex', 'mtu': 'big'}],
+    'devices': {'eth0': 'eth0', 'eth1': None},
+    'nothing': None,
+}
+
+
+class SchemaTestCase(testtools.TestCase):
+
+    def validate(self, doc):
+        return schema.validate(CONFIG, schema.compile_schema(doc))
+
+    def test_valid(self):
+        self.assertEqual([], self.validate({
+            'keystone.database.host': 'netaddress',
+            'keystone.database.port': 'int',
+            'bridges.0.name': 'netdevice',
+        }))
+
+    def test_bad_value(self):
+        self.assertEqual(
+            ["cannot interpret value '192.0.2.1' of key"
+             " keystone.database.host as type int"],
+            self.validate({'keystone.database.host': 'int'}))
+
+    def test_missing(self):
+        self.assertEqual(
+            ['key keystone.database.user does not exist',
+             'key nothing does not exist'],
+            self.validate({'keystone.database.user': 'default',
+                           'nothing': 'raw'}))
+
+    def test_not_required(self):
+        self.assertEqual([], self.validate({
+            'keystone.database.user': {'type': 'default',
+                                       'required': False}}))
+
+    def test_list_wildcard(self):
+        self.assertEqual(
+            ["cannot interpret value 'big' of key bridges.1.mtu as"
+             " type int",
+             "cannot interpret value 'br ex' of key bridges.1.name as"
+             " type netdevice"],
+            self.validate({'bridges.*.name': 'netdevice',
+                           'bridges.*.mtu': 'int'}))
+
+    def test_dict_wildcard(self):
+        self.assertEqual(
+            ['key devices.eth1 does not exist'],
+            self.validate({'devices.*': 'netdevice'}))
+
+    def test_wildcard_not_container(self):
+        self.assertEqual(
+            ['key keystone.database.host.* does not exist'],
+            self.validate({'keystone.database.host.*': 'raw'}))
+
+    def test_reports_all_violations(self):
+        self.assertEqual(3, len(self.validate({
+            'keystone.database.host': 'int',
+            'bridges.*.name': 'netdevice',
+            'missing': 'raw'})))
+
+    def test_unknown_type(self):
+        self.assertRaises(exc.ConfigException, schema.compile_schema,
+                          {'keystone.database.host': 'badtype'})
+
+    def test_not_a_dict(self):
+        self.assertRaises(exc.ConfigException, schema.compile_schema,
+                          ['keystone.database.host'])
+
+    def test_mixed_key_types(self):
+        rules = schema.compile_schema(yaml.safe_load('1: int\na: int\n'
+                                                     'no: raw\n'))
+        self.assertEqual(['1', 'False', 'a'], [rule.path for rule in rules])
+
+    def test_bad_rule(self):
+        self.assertRaises(exc.ConfigException, schema.compile_schema,
+                          {'a': {'type': 'raw', 'default': 'x'}})
+        self.assertRaises(exc.ConfigException, schema.compile_schema,
+                          {'a': {'type': 'raw', 'required': 'no'}})
+        for spec in [['int'], {'type': ['int']}, {'type': {'x': 1}}]:
+            e = self.assertRaises(exc.ConfigException,
+                                  schema.compile_schema, {'a': spec})
+            self.assertIn('unknown type', str(e))
+
+    def test_load_schema(self):
+        tdir = self.useFixture(fixtures.TempDir())
+        path = os.path.join(tdir.path, 'schema.yaml')
+        with open(path, 'w') as f:
+            f.write('keystone.database.port: int\n')
+        rules = schema.load_schema(path)
+        self.assertEqual(['keystone.database.port'],
+                         [rule.path for rule in rules])
+        with open(path, 'w') as f:
+            f.write('{')
+        self.assertRaises(exc.ConfigException, schema.load_schema, path)
+        self.assertRaises(exc.ConfigException, schema.load_schema,
+                          os.path.join(tdir.path, 'missing.yaml'))
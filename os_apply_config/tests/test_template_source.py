@@ -0,0 +1,191 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+from unittest import mock
+import zipfile
+
+import fixtures
+import testtools
+
+from os_apply_config import apply_config
+from os_apply_config import config_exception as exc
+from os_apply_config import fingerprint
+from os_apply_config import oac_file
+from os_apply_config import template_source
+from os_apply_config.tests import test_apply_config
+
+TEMPLATES = test_apply_config.TEMPLATES
+CONFIG = test_apply_config.CONFIG
+OUTPUT = test_apply_config.OUTPUT
+
+FORMATS = ('zip', 'tar', 'gztar')
+
+
+class ArchiveSourceTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+
+    def archive(self, fmt, root=TEMPLATES):
+        return shutil.make_archive(os.path.join(self.tdir, 'templates'),
+                                   fmt, root)
+
+    def test_build_tree(self):
+        for fmt in FORMATS:
+            archive = self.archive(fmt)
+            with template_source.open_templates(archive) as source:
+                self.assertIsInstance(source, template_source.ArchiveSource)
+                tree = apply_config.build_tree(source.paths(), CONFIG,
+                                               source=source)
+            self.assertEqual(OUTPUT, tree)
+
+    def test_paths_selection(self):
+        archive = self.archive('tar')
+        with template_source.open_templates(archive) as source:
+            for only, exclude in [(None, None),
+                                  (['/etc/control'], None),
+                                  (['/etc/*/mode', '/etc/keystone/'], None),
+                                  (['*.conf'], None),
+                                  (['/usr/*'], None),
+                                  (['/'], None),
+                                  (None, ['/etc/control']),
+                                  (['/etc/control/*'], ['*empty'])]:
+                self.assertEqual(
+                    sorted(out for _, out in apply_config.template_paths(
+                        TEMPLATES, only, exclude)),
+                    sorted(out for _, out in source.paths(only, exclude)),
+                    (only, exclude))
+            self.assertIn((archive + '/etc/keystone/keystone.conf',
+                           '/etc/keystone/keystone.conf'), source.paths())
+
+    def test_install_config(self):
+        metadata = os.path.join(self.tdir, 'md.json')
+        with open(metadata, 'w') as f:
+            json.dump(CONFIG, f)
+        for fmt in FORMATS:
+            out = os.path.join(self.tdir, 'out-' + fmt)
+            apply_config.install_config([metadata], self.archive(fmt), out,
+                                        False)
+            for path, obj in OUTPUT.items():
+                full_path = os.path.join(out, path[1:])
+                if obj.allow_empty:
+                    self.assertEqual(obj.body, open(full_path).read())
+                else:
+                    self.assertFalse(os.path.exists(full_path))
+            self.assertEqual(0o100755, os.stat(os.path.join(
+                out, 'etc/control/mode')).st_mode)
+
+    def test_executable_extracted_while_run(self):
+        archive = self.archive('zip')
+        self.useFixture(fixtures.EnvironmentVariable('TMPDIR', self.tdir))
+        tempfile.tempdir = None
+        self.addCleanup(setattr, tempfile, 'tempdir', None)
+        run = []
+
+        def render_executable(path, config, exec_limits=None):
+            run.append(path)
+            self.assertTrue(os.access(path, os.X_OK))
+            return 'ok'
+        with template_source.open_templates(archive) as source, \
+                mock.patch.object(apply_config, 'render_executable',
+                                  render_executable):
+            self.assertFalse(source.is_executable(
+                archive + '/etc/keystone/keystone.conf'))
+            self.assertEqual('ok', apply_config.render_template(
+                archive + '/etc/glance/script.conf', CONFIG, source=source))
+        self.assertEqual('script.conf', os.path.basename(run[0]))
+        self.assertFalse(os.path.exists(os.path.dirname(run[0])))
+
+    def test_executable_extracted_in_exec_dir(self):
+        exec_dir = os.path.join(self.tdir, 'state', 'exec')
+        run = []
+
+        def render_executable(path, config, exec_limits=None):
+            run.append(path)
+            self.assertEqual(exec_dir,
+                             os.path.dirname(os.path.dirname(path)))
+            return 'ok'
+        with template_source.open_templates(self.archive('tar'),
+                                            exec_dir) as source, \
+                mock.patch.object(apply_config, 'render_executable',
+                                  render_executable):
+            apply_config.render_template(
+                source.root + '/etc/glance/script.conf', CONFIG,
+                source=source)
+        self.assertEqual(1, len(run))
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(exec_dir).st_mode))
+        self.assertEqual([], os.listdir(exec_dir))
+
+    def test_executable_extract_failed(self):
+        exec_dir = os.path.join(self.tdir, 'exec')
+        with open(exec_dir, 'w'):
+            pass
+        with template_source.open_templates(self.archive('tar'),
+                                            exec_dir) as source:
+            template = source.root + '/etc/glance/script.conf'
+            e = self.assertRaises(exc.ConfigException,
+                                  apply_config.render_template, template,
+                                  CONFIG, source=source)
+        self.assertIn('Could not extract executable template %s.'
+                      % template, str(e))
+
+    def test_install_config_state_dir(self):
+        metadata = os.path.join(self.tdir, 'md.json')
+        with open(metadata, 'w') as f:
+            json.dump(CONFIG, f)
+        out = os.path.join(self.tdir, 'out')
+        state_dir = os.path.join(self.tdir, 'state')
+        os.mkdir(state_dir)
+        apply_config.install_config([metadata], self.archive('tar'), out,
+                                    False, state_dir=state_dir)
+        with open(os.path.join(out, 'etc/glance/script.conf')) as f:
+            self.assertEqual(OUTPUT['/etc/glance/script.conf'].body,
+                             f.read())
+        self.assertEqual([], os.listdir(os.path.join(
+            state_dir, template_source.EXEC_DIR)))
+
+    def test_zip_without_modes(self):
+        archive = os.path.join(self.tdir, 'templates.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('etc/foo', 'foo')
+            zf.writestr('etc/foo.oac', 'mode: 0600')
+        with template_source.open_templates(archive) as source:
+            tree = apply_config.build_tree(source.paths(), CONFIG,
+                                           source=source)
+        self.assertEqual({'/etc/foo': oac_file.OacFile('foo', mode=0o600)},
+                         tree)
+        self.assertFalse(source.is_executable(archive + '/etc/foo'))
+
+    def test_bad_archive(self):
+        for content in (b'', b'not an archive'):
+            archive = os.path.join(self.tdir, 'templates.tar')
+            with open(archive, 'wb') as f:
+                f.write(content)
+            e = self.assertRaises(exc.ConfigException,
+                                  template_source.open_templates, archive)
+            self.assertIn('template archive %s' % archive, str(e))
+
+    def test_fingerprint(self):
+        archive = self.archive('tar')
+        before = fingerprint.compute([], archive, '/')
+        self.assertEqual(before, fingerprint.compute([], archive, '/'))
+        os.utime(archive, ns=(10 ** 9, 10 ** 9))
+        self.assertNotEqual(before, fingerprint.compute([], archive, '/'))
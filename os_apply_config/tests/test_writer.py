@@ -0,0 +1,241 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+from unittest import mock
+
+import fixtures
+import testtools
+
+from os_apply_config import oac_file
+from os_apply_config import writer
+
+
+class WriterTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(fixtures.FakeLogger('os-apply-config'))
+        self.tdir = self.useFixture(fixtures.TempDir()).path
+        self.writer = writer.Writer()
+        self.addCleanup(self.writer.close)
+
+    def path(self, *parts):
+        return os.path.join(self.tdir, *parts)
+
+    def test_group_by_dir(self):
+        self.assertEqual(
+            [('/a', ['/a/1', '/a/3']), ('/b', ['/b/2'])],
+            list(writer.group_by_dir(['/a/1', '/b/2', '/a/3']).items()))
+
+    def test_write_all(self):
+        outputs = [(self.path('a', '1'), oac_file.OacFile('1')),
+                   (self.path('b', 'c', '2'), oac_file.OacFile('2')),
+                   (self.path('a', '3'), oac_file.OacFile('3'))]
+        os.mkdir(self.path('a'))
+        with mock.patch('os.open', wraps=os.open) as os_open:
+            written = self.writer.write_all(outputs)
+        self.assertEqual(
+            [(self.path('a', '1'), 'created'),
+             (self.path('a', '3'), 'created'),
+             (self.path('b', 'c', '2'), 'created')],
+            [(path, status) for path, _obj, status in written])
+        for path, obj in outputs:
+            self.assertEqual(obj.body, open(path, 'rb').read())
+        opened = [c[0][0] for c in os_open.call_args_list]
+        self.assertEqual(1, opened.count(self.path('a')))
+
+    def test_write_all_workers(self):
+        outputs = [(self.path(d, sub, str(i)), oac_file.OacFile(d + str(i)))
+                   for i in range(5) for d in 'abcdefgh'
+                   for sub in ('', 'sub')]
+        serial = writer.Writer().write_all(
+            (self.path('serial', p[len(self.tdir) + 1:]), obj)
+            for p, obj in outputs)
+        w = writer.Writer(workers=4)
+        self.addCleanup(w.close)
+        w.MAX_OPEN_DIRS = 2
+        threads = {}
+        real_write = w.write
+
+        def write(path, obj):
+            threads.setdefault(os.path.dirname(path), []).append(
+                (threading.current_thread().name, path))
+            time.sleep(0.001)
+            return real_write(path, obj)
+        with mock.patch.object(w, 'write', side_effect=write):
+            written = w.write_all(outputs)
+        self.assertEqual(
+            [(p[len(self.path('serial')):], status)
+             for p, _obj, status in serial],
+            [(p[len(self.tdir):], status) for p, _obj, status in written])
+        for path, obj in outputs:
+            self.assertEqual(obj.body, open(path, 'rb').read())
+        for d, writes in threads.items():
+            # One thread per directory, writing in order.
+            self.assertEqual(1, len(set(name for name, _ in writes)))
+            self.assertEqual(sorted(p for _, p in writes),
+                             [p for _, p in writes])
+            self.assertEqual(['0', '1', '2', '3', '4'],
+                             sorted(f for f in os.listdir(d)
+                                    if f != 'sub'))
+        self.assertGreater(
+            len(set(name for writes in threads.values()
+                    for name, _ in writes)), 1)
+        self.assertLessEqual(len(w._dirs), 2)
+        self.assertEqual({}, dict(w._busy))
+
+    def test_no_tmpfile(self):
+        self.writer._tmpfile = False
+        path = self.path('etc', 'foo')
+        for body, status in [('foo', 'created'), ('bar', 'modified')]:
+            self.assertEqual(status, self.writer.write(
+                path, oac_file.OacFile(body).set('mode', 0o640)))
+            self.assertEqual(body, open(path).read())
+            self.assertEqual(0o100640, os.stat(path).st_mode)
+        self.assertEqual(['foo'], os.listdir(self.path('etc')))
+
+    def test_tmpfile_unsupported(self):
+        path = self.path('foo')
+        real_open = os.open
+
+        def fake_open(name, flags, *args, **kwargs):
+            if flags & getattr(os, 'O_TMPFILE', 0) == os.O_TMPFILE:
+                raise OSError(95, 'Operation not supported')
+            return real_open(name, flags, *args, **kwargs)
+        with mock.patch('os.open', side_effect=fake_open):
+            self.assertEqual('created', self.writer.write(
+                path, oac_file.OacFile('foo')))
+        self.assertFalse(self.writer._tmpfile)
+        self.assertEqual('foo', open(path).read())
+
+    def test_replace_existing(self):
+        path = self.path('foo')
+        with open(path, 'w') as f:
+            f.write('old')
+        self.assertEqual('modified', self.writer.write(
+            path, oac_file.OacFile('new')))
+        self.assertEqual('new', open(path).read())
+        self.assertEqual(['foo'], os.listdir(self.tdir))
+
+    def test_replace_symlink(self):
+        target = self.path('target')
+        with open(target, 'w') as f:
+            f.write('foo')
+        path = self.path('foo')
+        os.symlink(target, path)
+        self.assertEqual('modified', self.writer.write(
+            path, oac_file.OacFile('foo')))
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual('foo', open(path).read())
+
+    def test_replace_dangling_symlink(self):
+        path = self.path('foo')
+        os.symlink(self.path('missing'), path)
+        self.assertEqual('created', self.writer.write(
+            path, oac_file.OacFile('foo')))
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual('foo', open(path).read())
+
+    def test_delete_in_missing_dir(self):
+        path = self.path('missing', 'foo')
+        self.assertEqual('skipped', self.writer.write(
+            path, oac_file.OacFile('').set('allow_empty', False)))
+        self.assertFalse(os.path.exists(self.path('missing')))
+
+    def test_open_dirs_bounded(self):
+        self.writer.MAX_OPEN_DIRS = 2
+        for d in 'abc':
+            self.writer.write(self.path(d, 'foo'), oac_file.OacFile(d))
+        self.assertEqual([self.path('b'), self.path('c')],
+                         list(self.writer._dirs))
+        self.writer.close()
+        self.assertEqual({}, self.writer._dirs)
+
+    def test_new_file_needs_no_chmod_or_chown(self):
+        self.writer._umask = 0o022
+        with mock.patch('os.fchmod') as fchmod, \
+                mock.patch('os.fchown') as fchown:
+            self.writer.write(self.path('foo'),
+                              oac_file.OacFile('foo').set('mode', 0o640))
+            self.writer.write(self.path('bar'), oac_file.OacFile('bar'))
+        self.assertFalse(fchmod.called)
+        self.assertFalse(fchown.called)
+        self.assertEqual(0o100640, os.stat(self.path('foo')).st_mode)
+        self.assertEqual(0o100644, os.stat(self.path('bar')).st_mode)
+        self.assertEqual({'chmods_skipped': 2, 'chowns_skipped': 2},
+                         self.writer.counts)
+
+    def test_new_file_chmod_past_umask(self):
+        self.writer._umask = 0o022
+        self.writer.write(self.path('foo'),
+                          oac_file.OacFile('foo').set('mode', 0o666))
+        self.assertEqual(0o100666, os.stat(self.path('foo')).st_mode)
+        self.assertEqual(0, self.writer.counts['chmods_skipped'])
+
+    def test_new_file_chown(self):
+        self.writer._euid = self.writer._egid = 12345
+        with mock.patch('os.fchown') as fchown:
+            self.writer.write(self.path('foo'),
+                              oac_file.OacFile('foo').set('owner', 0))
+        fchown.assert_called_once_with(mock.ANY, 0, -1)
+
+    def test_setgid_dir_group(self):
+        os.mkdir(self.path('d'))
+        os.chmod(self.path('d'), 0o2755)
+        gid = os.stat(self.path('d')).st_gid
+        self.writer._egid = gid + 1
+        self.writer.write(self.path('d', 'foo'), oac_file.OacFile('foo'))
+        with mock.patch('os.fchown') as fchown:
+            self.writer.write(self.path('d', 'bar'),
+                              oac_file.OacFile('bar').set('group', gid))
+        self.assertFalse(fchown.called)
+
+    def test_reconcile_mode(self):
+        path = self.path('foo')
+        self.writer.write(path, oac_file.OacFile('foo'))
+        ino = os.stat(path).st_ino
+        self.assertEqual('modified', self.writer.write(
+            path, oac_file.OacFile('foo').set('mode', 0o600)))
+        self.assertEqual(ino, os.stat(path).st_ino)
+        self.assertEqual(0o100600, os.stat(path).st_mode)
+        self.assertEqual(1, self.writer.counts['metadata_updates'])
+        self.assertIn('changing mode of %s' % path, self.logger.output)
+        self.assertEqual('unchanged', self.writer.write(
+            path, oac_file.OacFile('foo').set('mode', 0o600)))
+
+    def test_reconcile_owner(self):
+        path = self.path('foo')
+        self.writer.write(path, oac_file.OacFile('foo'))
+        st = os.stat(path)
+        obj = oac_file.OacFile('foo')
+        obj._group = st.st_gid + 1
+        with mock.patch('os.chown') as chown:
+            self.assertEqual('modified', self.writer.write(path, obj))
+        chown.assert_called_once_with('foo', st.st_uid, obj.group,
+                                      dir_fd=mock.ANY)
+        self.assertEqual(1, self.writer.counts['metadata_updates'])
+
+    def test_reconcile_mode_and_owner_rewrites(self):
+        path = self.path('foo')
+        self.writer.write(path, oac_file.OacFile('foo'))
+        st = os.stat(path)
+        obj = oac_file.OacFile('foo').set('mode', 0o600)
+        obj._owner = st.st_uid + 1
+        with mock.patch.object(self.writer, '_replace') as replace:
+            self.assertEqual('modified', self.writer.write(path, obj))
+        replace.assert_called_once_with('foo', mock.ANY, b'foo', 0o600,
+                                        0o600, (st.st_uid + 1, st.st_gid))
@@ -32,12 +32,14 @@ TYPES = {
     "raw": ""
 }
 
+PATTERNS = {name: re.compile(pattern) for name, pattern in TYPES.items()}
+
 
 def ensure_type(string_value, type_name='default'):
     if type_name not in TYPES:
         raise ValueError(
             "requested validation of unknown type: %s" % type_name)
-    if not re.match(TYPES[type_name], string_value):
+    if not PATTERNS[type_name].match(string_value):
         exception = config_exception.ConfigException
         raise exception("cannot interpret value '{}' as type {}".format(
             string_value, type_name))
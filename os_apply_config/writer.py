@@ -0,0 +1,352 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writes rendered outputs relative to open directory descriptors.
+
+Outputs are grouped by directory, and each directory is opened once per
+run, so that every file is examined, written and renamed into place
+without resolving its full path again.  Where the kernel supports
+O_TMPFILE, new files are written unnamed and only linked into place once
+complete; existing files are replaced by renaming a temporary file over
+them.
+
+New files are created with their final mode, and only chmodded or
+chowned where the umask, or the owner a new file gets, differ from what
+the output needs.  An output whose content is already right but whose
+mode or ownership is not has just that changed in place.
+
+With more than one worker, directories are written concurrently from a
+thread pool, each by a single thread in order, so that on slow or
+network filesystems the round trips of one directory overlap those of
+others.  Every file is still written to a temporary and renamed, or
+linked, into place.
+"""
+
+import collections
+from concurrent import futures
+import errno
+import logging
+import os
+import secrets
+import stat
+import threading
+
+logger = logging.getLogger('os-apply-config')
+
+# errnos meaning O_TMPFILE is not supported by the kernel or filesystem
+_NO_TMPFILE = (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL, errno.ENOENT)
+
+
+def group_by_dir(paths):
+    """Return an OrderedDict of directory -> paths, in order of appearance."""
+    groups = collections.OrderedDict()
+    for path in paths:
+        groups.setdefault(os.path.dirname(path), []).append(path)
+    return groups
+
+
+class Writer:
+    """Writes the outputs of one run.
+
+    Directory descriptors are kept open for the life of the writer, up to
+    MAX_OPEN_DIRS of them besides those being written, so use it as a
+    context manager or call close().  write_all writes up to workers
+    directories at once.
+    """
+
+    MAX_OPEN_DIRS = 64
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._dirs = collections.OrderedDict()
+        # directory -> the group files created in it get
+        self._new_gids = {}
+        # directory -> how many write_all threads are writing in it
+        self._busy = collections.Counter()
+        self._lock = threading.Lock()
+        # Naming an O_TMPFILE file needs /proc to refer to it by.
+        self._tmpfile = (hasattr(os, 'O_TMPFILE') and
+                         os.path.isdir('/proc/self/fd'))
+        self._umask = _umask()
+        self._euid = os.geteuid()
+        self._egid = os.getegid()
+        # operations saved, for the run statistics
+        self.counts = collections.Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        while self._dirs:
+            os.close(self._dirs.popitem()[1])
+        self._new_gids.clear()
+
+    def _dir_fd(self, d, create):
+        """Return a descriptor for directory d, or None if it is missing."""
+        with self._lock:
+            fd = self._dirs.get(d)
+            if fd is not None:
+                self._dirs.move_to_end(d)
+                return fd
+        flags = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+        try:
+            fd = os.open(d or '.', flags)
+        except FileNotFoundError:
+            if not create:
+                return None
+            # Another thread may be creating it as a parent of its own.
+            os.makedirs(d, exist_ok=True)
+            fd = os.open(d, flags)
+        st = os.fstat(fd)
+        with self._lock:
+            self._new_gids[d] = (st.st_gid if st.st_mode & stat.S_ISGID
+                                 else self._egid)
+            self._dirs[d] = fd
+            self._trim()
+        return fd
+
+    def _trim(self):
+        """Close the least recently used directories past MAX_OPEN_DIRS.
+
+        Directories being written in by write_all are kept.  Call with
+        the lock held.
+        """
+        excess = len(self._dirs) - self.MAX_OPEN_DIRS
+        if excess > 0:
+            for old in [d for d in self._dirs
+                        if d not in self._busy][:excess]:
+                del self._new_gids[old]
+                os.close(self._dirs.pop(old))
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _fixups(self, d, mode, uid, gid):
+        """Return the chmod and chown a file created in d needs.
+
+        Either is None when the file will already be so.
+        """
+        chmod = mode if mode & self._umask else None
+        if chmod is None:
+            self._count('chmods_skipped')
+        chown = (uid, gid)
+        if uid in (-1, self._euid) and gid in (-1, self._new_gids[d]):
+            chown = None
+            self._count('chowns_skipped')
+        return chmod, chown
+
+    def write_all(self, outputs):
+        """Write each (path, obj) in outputs, a directory at a time.
+
+        Returns a list of (path, obj, status) in the order of outputs,
+        grouped by directory.
+        """
+        objs = collections.OrderedDict(outputs)
+        groups = list(group_by_dir(objs).items())
+        if self.workers <= 1 or len(groups) <= 1:
+            written = [self._write_dir(d, paths, objs) for d, paths in groups]
+        else:
+            with futures.ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(groups))) as pool:
+                written = list(pool.map(
+                    lambda group: self._write_dir(group[0], group[1], objs),
+                    groups))
+        return [w for dir_written in written for w in dir_written]
+
+    def _write_dir(self, d, paths, objs):
+        """Write paths, all in directory d, in order."""
+        with self._lock:
+            self._busy[d] += 1
+        try:
+            return [(path, objs[path], self.write(path, objs[path]))
+                    for path in paths]
+        finally:
+            with self._lock:
+                self._busy[d] -= 1
+                if not self._busy[d]:
+                    del self._busy[d]
+                    self._trim()
+
+    def write(self, path, obj):
+        """Write obj to path if it differs from what is there.
+
+        Returns 'created', 'modified', 'deleted', 'unchanged', or
+        'skipped' for an empty file which is not allowed and does not
+        exist.
+        """
+        d, name = os.path.split(path)
+        delete = not obj.allow_empty and len(obj.body) == 0
+        dfd = self._dir_fd(d, create=not delete)
+        st, link = None, False
+        if dfd is not None:
+            st, link = _stat(name, dfd)
+
+        if delete:
+            if st is not None:
+                logger.info("deleting %s", path)
+                os.unlink(name, dir_fd=dfd)
+                return 'deleted'
+            else:
+                logger.info("not creating empty %s", path)
+                return 'skipped'
+
+        if isinstance(obj.body, str):
+            obj.body = obj.body.encode('utf-8')
+        if st is not None:
+            mode, uid, gid = st.st_mode, st.st_uid, st.st_gid
+        else:
+            mode, uid, gid = 0o644, -1, -1
+        mode = obj.mode or mode
+        if obj.owner is not None:
+            uid = obj.owner
+        if obj.group is not None:
+            gid = obj.group
+
+        mode = stat.S_IMODE(mode)
+        if (st is not None and not link and
+                _has_body(name, dfd, st, obj.body)):
+            return self._reconcile(path, name, dfd, st, mode, uid, gid)
+
+        logger.info("writing %s", path)
+        chmod, chown = self._fixups(d, mode, uid, gid)
+        if st is None and not link and self._tmpfile:
+            self._create(name, dfd, obj.body, mode, chmod, chown)
+        else:
+            self._replace(name, dfd, obj.body, mode, chmod, chown)
+        return 'modified' if st is not None else 'created'
+
+    def _reconcile(self, path, name, dfd, st, mode, uid, gid):
+        """Give name, whose content is right, its mode and ownership.
+
+        Where both are wrong the file is rewritten instead, so that it
+        never has one without the other.
+        """
+        chmod = stat.S_IMODE(st.st_mode) != mode
+        chown = uid not in (-1, st.st_uid) or gid not in (-1, st.st_gid)
+        if not chmod and not chown:
+            logger.info("not writing unchanged %s", path)
+            return 'unchanged'
+        if chmod and chown:
+            logger.info("writing %s", path)
+            self._replace(name, dfd, _read(name, dfd), mode, mode, (uid, gid))
+            return 'modified'
+        if chmod:
+            logger.info("changing mode of %s", path)
+            os.chmod(name, mode, dir_fd=dfd)
+        else:
+            logger.info("changing ownership of %s", path)
+            os.chown(name, uid, gid, dir_fd=dfd)
+        self._count('metadata_updates')
+        return 'modified'
+
+    def _create(self, name, dfd, body, mode, chmod, chown):
+        """Create name from an O_TMPFILE file, linked once complete."""
+        try:
+            fd = os.open('.', os.O_TMPFILE | os.O_WRONLY | os.O_CLOEXEC,
+                         mode, dir_fd=dfd)
+        except OSError as e:
+            if e.errno not in _NO_TMPFILE:
+                raise
+            self._tmpfile = False
+            return self._replace(name, dfd, body, mode, chmod, chown)
+        try:
+            _fill(fd, body, chmod, chown)
+            os.link('/proc/self/fd/%d' % fd, name, dst_dir_fd=dfd,
+                    follow_symlinks=True)
+        except FileExistsError:
+            # Created since we looked.
+            return self._replace(name, dfd, body, mode, chmod, chown)
+        finally:
+            os.close(fd)
+
+    def _replace(self, name, dfd, body, mode, chmod, chown):
+        """Write a temporary file and rename it over name."""
+        fd, tmp_name = _create_temp(dfd, mode)
+        try:
+            _fill(fd, body, chmod, chown)
+            os.rename(tmp_name, name, src_dir_fd=dfd, dst_dir_fd=dfd)
+        except Exception:
+            os.unlink(tmp_name, dir_fd=dfd)
+            raise
+        finally:
+            os.close(fd)
+
+
+def _temp_name():
+    return 'tmp' + secrets.token_hex(4)
+
+
+def _create_temp(dfd, mode):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC
+    while True:
+        tmp_name = _temp_name()
+        try:
+            return os.open(tmp_name, flags, mode, dir_fd=dfd), tmp_name
+        except FileExistsError:
+            continue
+
+
+def _fill(fd, body, chmod, chown):
+    view = memoryview(body)
+    while view:
+        view = view[os.write(fd, view):]
+    if chmod is not None:
+        os.fchmod(fd, chmod)
+    if chown is not None:
+        os.fchown(fd, *chown)
+
+
+def _umask():
+    """Return the umask, without changing it where /proc shows it."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def _stat(name, dfd):
+    """Return (stat following symlinks or None, whether name is a link)."""
+    try:
+        st = os.stat(name, dir_fd=dfd, follow_symlinks=False)
+    except FileNotFoundError:
+        return None, False
+    if not stat.S_ISLNK(st.st_mode):
+        return st, False
+    try:
+        return os.stat(name, dir_fd=dfd), True
+    except FileNotFoundError:
+        return None, True
+
+
+def _read(name, dfd):
+    fd = os.open(name, os.O_RDONLY | os.O_CLOEXEC, dir_fd=dfd)
+    with open(fd, 'rb') as f:
+        return f.read()
+
+
+def _has_body(name, dfd, st, body):
+    """Whether name in dfd, last stat as st, already holds body."""
+    if not stat.S_ISREG(st.st_mode) or st.st_size != len(body):
+        return False
+    return _read(name, dfd) == body
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Differential test of os-apply-config against its reference paths.
+
+Generates random cases from a range of seeds and checks each of them
+against every optimized path, e.g.
+
+  tools/difftest.py --seeds 1000 --reproducers /tmp/oac-repro
+
+A failing case is minimized and written under the reproducers directory,
+from where it can be checked again with --replay.
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from os_apply_config.tests import differential
+
+
+def parse_opts(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seeds', type=int, default=200,
+                        help='Number of seeds to check.'
+                             ' (default: %(default)s)')
+    parser.add_argument('--start', type=int, default=0,
+                        help='First seed. (default: %(default)s)')
+    parser.add_argument('--variant', action='append',
+                        choices=list(differential.VARIANTS),
+                        help='Path to check, may be given more than once.'
+                             ' (default: all of them)')
+    parser.add_argument('--reproducers', default='.',
+                        help='Directory to write minimized reproducers to.'
+                             ' (default: %(default)s)')
+    parser.add_argument('--replay', metavar='CASE', default=None,
+                        help='Check the case.json of a reproducer instead.')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='Carry on after a failing seed.')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    opts = parse_opts(argv)
+    logging.getLogger('os-apply-config').setLevel(logging.ERROR)
+    if opts.replay:
+        with open(opts.replay) as f:
+            cases = [json.load(f)]
+    else:
+        cases = (differential.generate(seed) for seed in
+                 range(opts.start, opts.start + opts.seeds))
+    failures = 0
+    for case in cases:
+        try:
+            differential.run(case, opts.variant,
+                             None if opts.replay else opts.reproducers)
+        except differential.Mismatch as e:
+            failures += 1
+            print(e)
+            if not opts.keep_going:
+                break
+    print('%d failing case(s)' % failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Steady-state load test of os-apply-config.
+
+Simulates the os-collect-config loop: os-apply-config is run again and
+again, each time in a new process as os-collect-config runs it, against
+a generated template tree and metadata which a seeded script of
+mutations changes a little between runs:
+
+  noop      the metadata is rewritten with the same content
+  key       one key of one service changes
+  bulk      a key of every service changes
+  template  one template is edited
+
+For every run the wall time, CPU time (including executable templates),
+peak resident set size and files written are recorded, and a summary
+with latency percentiles per mutation is printed at the end.  With
+--in-process os-apply-config is instead called in this process, which
+leaves out interpreter start-up; its process-level caches are cleared
+before each run so that no run benefits from the one before.  Arguments
+after "--" are passed on to os-apply-config, e.g.
+
+  tools/loadtest.py --runs 500 -- --state-dir {state}
+
+where {state} is replaced by a state directory in the work directory.
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from os_apply_config import apply_config
+from os_apply_config import collect_config
+from os_apply_config import metrics
+from os_apply_config import oac_file
+from os_apply_config import plugins
+
+MUTATIONS = ('noop', 'key', 'bulk', 'template')
+
+# Runs os-apply-config as its console script does.
+ENTRY_POINT = ('import sys; from os_apply_config import apply_config;'
+               ' sys.exit(apply_config.main())')
+
+TEMPLATE = """[DEFAULT]
+host = {{%(svc)s.host}}
+port = {{%(svc)s.port}}
+region = {{region}}
+{{#%(svc)s.peers}}
+peer = {{.}}
+{{/%(svc)s.peers}}
+
+[%(name)s]
+{{#%(svc)s.options}}
+debug = {{opt0}}
+verbose = {{opt1}}
+{{/%(svc)s.options}}
+"""
+
+
+class Tree:
+    """A template tree and metadata, and the mutations made to them."""
+
+    def __init__(self, root, services, templates, seed):
+        self.rand = random.Random(seed)
+        self.services = ['svc%d' % i for i in range(services)]
+        self.templates = os.path.join(root, 'templates')
+        self.output = os.path.join(root, 'output')
+        self.state = os.path.join(root, 'state')
+        self.base = os.path.join(root, 'base.json')
+        self.deploy = os.path.join(root, 'deploy.json')
+        self.paths = []
+        for i in range(templates):
+            svc = self.services[i % services]
+            path = os.path.join(self.templates, 'etc', svc,
+                                'file%d.conf' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(TEMPLATE % {'svc': svc, 'name': 'file%d' % i})
+            self.paths.append(path)
+        self.write(self.base, dict(
+            (svc, {
+                'host': 'host-%d.example.com' % i,
+                'port': 8000 + i,
+                'peers': ['192.0.2.%d' % ((i + j) % 250) for j in range(5)],
+                'options': dict(('opt%d' % j, 'value%d' % j)
+                                for j in range(20)),
+            }) for i, svc in enumerate(self.services)))
+        self.overrides = {'region': 'regionOne'}
+        self.write(self.deploy, self.overrides)
+
+    @staticmethod
+    def write(path, doc):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(doc, f)
+        os.rename(path + '.tmp', path)
+
+    def mutate(self, mutation):
+        if mutation == 'noop':
+            self.write(self.deploy, self.overrides)
+        elif mutation == 'key':
+            svc = self.rand.choice(self.services)
+            self.overrides.setdefault(svc, {})['host'] = (
+                'host-%d.example.com' % self.rand.randrange(10 ** 6))
+            self.write(self.deploy, self.overrides)
+        elif mutation == 'bulk':
+            port = self.rand.randrange(1024, 65536)
+            for svc in self.services:
+                self.overrides.setdefault(svc, {})['port'] = port
+            self.write(self.deploy, self.overrides)
+        elif mutation == 'template':
+            with open(self.rand.choice(self.paths), 'a') as f:
+                f.write('# edited %d\n' % self.rand.randrange(10 ** 6))
+
+
+def script(spec, runs, seed):
+    """Return the mutation of each run, drawn by weight from spec."""
+    weights = collections.OrderedDict()
+    for item in spec.split(','):
+        name, _sep, weight = item.partition(':')
+        if name not in MUTATIONS:
+            raise ValueError('unknown mutation %r' % name)
+        weights[name] = float(weight or 1)
+    rand = random.Random(seed)
+    return rand.choices(list(weights), list(weights.values()), k=runs)
+
+
+def cpu_seconds():
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def read_report(report):
+    try:
+        with open(report) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def run_process(argv, report):
+    """Run os-apply-config in a new process.
+
+    Returns its exit code, report, CPU seconds and peak resident set
+    size.
+    """
+    env = dict(os.environ)
+    # Import this tree's os_apply_config, whatever the working directory.
+    package = os.path.dirname(os.path.dirname(
+        os.path.abspath(apply_config.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.Popen(
+        [sys.executable, '-c', ENTRY_POINT] + argv[1:] + ['--report', report],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    # wait4 gives the usage of this run alone, executable templates
+    # included, where getrusage(RUSAGE_CHILDREN) would only give the
+    # largest resident set size of any run so far.
+    _pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return (proc.returncode, read_report(report),
+            usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024)
+
+
+def clear_caches():
+    """Forget what earlier runs in this process left behind."""
+    collect_config.ParseCache._memory.clear()
+    plugins._modules.clear()
+    oac_file.clear_caches()
+
+
+def run_in_process(argv, report):
+    """Run os-apply-config in this process, starting from cold caches.
+
+    Returns its exit code, report, CPU seconds and resident set size.
+    """
+    clear_caches()
+    logger = logging.getLogger('os-apply-config')
+    handlers = list(logger.handlers)
+    cpu = cpu_seconds()
+    try:
+        # main() adds its log handlers on every call; keep them off the
+        # terminal and drop them again afterwards.
+        with contextlib.redirect_stderr(io.StringIO()):
+            rc = apply_config.main(argv + ['--report', report])
+    finally:
+        for handler in logger.handlers[len(handlers):]:
+            logger.removeHandler(handler)
+            handler.close()
+    return rc, read_report(report), cpu_seconds() - cpu, metrics.rss()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(records):
+    groups = collections.OrderedDict([('all', records)])
+    for mutation in MUTATIONS:
+        group = [r for r in records if r['mutation'] == mutation]
+        if group:
+            groups[mutation] = group
+    summary = collections.OrderedDict()
+    for name, group in groups.items():
+        wall = [r['wall_seconds'] for r in group]
+        summary[name] = {
+            'runs': len(group),
+            'failures': sum(1 for r in group if r['rc'] != 0),
+            'p50_seconds': percentile(wall, 50),
+            'p90_seconds': percentile(wall, 90),
+            'p99_seconds': percentile(wall, 99),
+            'max_seconds': max(wall),
+            'cpu_seconds': sum(r['cpu_seconds'] for r in group),
+            'mean_files_written': (sum(r['files_written'] for r in group) /
+                                   float(len(group))),
+        }
+    rss = [r['rss_bytes'] for r in records if r['rss_bytes']]
+    if rss:
+        summary['rss_bytes'] = {'first': rss[0], 'last': rss[-1],
+                                'max': max(rss)}
+    return summary
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write('%-10s %6s %5s %9s %9s %9s %9s %9s %8s\n' % (
+        'mutation', 'runs', 'fail', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'cpu s', 'written'))
+    for name, s in summary.items():
+        if name == 'rss_bytes':
+            continue
+        out.write('%-10s %6d %5d %9.1f %9.1f %9.1f %9.1f %9.2f %8.1f\n' % (
+            name, s['runs'], s['failures'], s['p50_seconds'] * 1000,
+            s['p90_seconds'] * 1000, s['p99_seconds'] * 1000,
+            s['max_seconds'] * 1000, s['cpu_seconds'],
+            s['mean_files_written']))
+    if 'rss_bytes' in summary:
+        rss = summary['rss_bytes']
+        out.write('rss MiB: first %.1f last %.1f max %.1f\n' % (
+            rss['first'] / 2.0 ** 20, rss['last'] / 2.0 ** 20,
+            rss['max'] / 2.0 ** 20))
+
+
+def parse_opts(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=200,
+                        help='Number of runs after the initial apply.'
+                             ' (default: %(default)s)')
+    parser.add_argument('--templates', type=int, default=500,
+                        help='Number of templates. (default: %(default)s)')
+    parser.add_argument('--services', type=int, default=50,
+                        help='Number of services the templates are spread'
+                             ' over. (default: %(default)s)')
+    parser.add_argument('--script', default='noop:70,key:20,bulk:5,'
+                                            'template:5',
+                        help='Comma separated MUTATION:WEIGHT pairs from'
+                             ' which each run\'s mutation is drawn.'
+                             ' (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the script and the mutations.')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory to generate the tree in, kept'
+                             ' afterwards. (default: a temporary directory)')
+    parser.add_argument('--in-process', action='store_true', default=False,
+                        help='Call os-apply-config in this process rather'
+                             ' than starting a new one for every run.')
+    parser.add_argument('--json', metavar='FILE', default=None,
+                        help='Write every run and the summary to FILE.')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='Arguments for os-apply-config, after "--".')
+    opts = parser.parse_args(argv[1:])
+    if opts.args and opts.args[0] == '--':
+        opts.args = opts.args[1:]
+    return opts
+
+
+def main(argv=sys.argv):
+    opts = parse_opts(argv)
+    root = opts.workdir or tempfile.mkdtemp(prefix='oac-loadtest-')
+    try:
+        tree = Tree(root, opts.services, opts.templates, opts.seed)
+        report = os.path.join(root, 'report.json')
+        oac_argv = ['os-apply-config', '--templates', tree.templates,
+                    '--output', tree.output, '--metadata', tree.base,
+                    '--metadata', tree.deploy]
+        oac_argv += [arg.replace('{state}', tree.state) for arg in opts.args]
+        run_once = run_in_process if opts.in_process else run_process
+        records = []
+        mutations = ['initial'] + script(opts.script, opts.runs, opts.seed)
+        for i, mutation in enumerate(mutations):
+            if mutation != 'initial':
+                tree.mutate(mutation)
+            start = time.perf_counter()
+            rc, doc, cpu, rss = run_once(oac_argv, report)
+            wall = time.perf_counter() - start
+            records.append({
+                'run': i,
+                'mutation': mutation,
+                'rc': rc,
+                'wall_seconds': wall,
+                'cpu_seconds': cpu,
+                'rss_bytes': rss,
+                'files_written': (len(doc.get('created', [])) +
+                                  len(doc.get('modified', []))),
+                'files_deleted': len(doc.get('deleted', [])),
+            })
+        # The initial apply writes everything, so leave it out of the
+        # steady state figures.
+        summary = summarize(records[1:])
+        print_summary(summary)
+        if opts.json:
+            with open(opts.json, 'w') as f:
+                json.dump({'runs': records, 'summary': summary}, f,
+                          indent=2)
+        return 1 if any(r['rc'] for r in records) else 0
+    finally:
+        if not opts.workdir:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    sys.exit(main())